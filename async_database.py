@@ -0,0 +1,136 @@
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from database import Database, DBState, VersionID, BranchID, RecordID, Record
+import ids
+
+
+class AsyncDatabase:
+    """An asyncio front end for a Database, so that one process can serve many editors at once.
+
+    Database is not safe to use from several threads at once, so every call runs in a single worker thread,
+    one at a time and in the order the calls were made. The event loop stays free while files are read and written
+    and while states are computed.
+    Calls to compute_state for the same state that overlap share one computation.
+    """
+
+    def __init__(self, database: Database, executor: Optional[concurrent.futures.Executor] = None):
+        """executor: where the database calls run; it must run one call at a time (by default, a new single worker thread)"""
+
+        self.database = database
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._executor = executor
+
+        # Goes up with every call that can change the database, so a read never shares a computation that started before an edit
+        self._generation = 0
+        # The compute_state calls in progress, and how many callers are waiting on each
+        self._pending_states: Dict[tuple, List[Any]] = {}
+
+    async def _run(self, function: Callable, *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+    async def _edit(self, function: Callable, *args, **kwargs) -> Any:
+        self._generation += 1
+        return await self._run(function, *args, **kwargs)
+
+    async def run(self, function: Callable[[Database], Any]) -> Any:
+        """Run a function of the database in the worker, for anything without its own method here (a transaction, say).
+
+            await async_db.run(lambda db: ...)
+        """
+
+        return await self._edit(function, self.database)
+
+    async def compute_state(self, id: ids.ID, revision_state: Optional[Dict[VersionID, VersionID]] = None,
+                            records: Optional[List[RecordID]] = None, attributes: Optional[List[str]] = None) -> DBState:
+        key = (self._generation, id,
+               None if revision_state is None else frozenset(revision_state.items()),
+               None if records is None else frozenset(records),
+               None if attributes is None else frozenset(attributes))
+
+        if key not in self._pending_states:
+            future = asyncio.ensure_future(self._run(self.database.compute_state, id, revision_state, records, attributes))
+            self._pending_states[key] = [future, 0]
+            future.add_done_callback(lambda _: self._pending_states.pop(key, None))
+        pending = self._pending_states[key]
+
+        pending[1] += 1
+        # One caller giving up shouldn't cancel the computation for the others
+        state = await asyncio.shield(pending[0])
+        pending[1] -= 1
+
+        # The last caller to get the state can have the computed object itself; the others get copies,
+        # so that no caller sees another's edits to it
+        if pending[1] == 0:
+            return state
+        return state.copy()
+
+    async def record_history(self, record_id: RecordID, id: ids.ID) -> List[Tuple[VersionID, List[str]]]:
+        return await self._run(self.database.record_history, record_id, id)
+
+    async def log(self, id: ids.ID, limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[VersionID], Optional[str]]:
+        return await self._run(self.database.log, id, limit, cursor)
+
+    async def compute_state_at(self, branch_id: BranchID, timestamp: float | datetime.datetime, records: Optional[List[RecordID]] = None,
+                               attributes: Optional[List[str]] = None) -> DBState:
+        return await self._run(self.database.compute_state_at, branch_id, timestamp, records, attributes)
+
+    async def versions_between(self, start_timestamp: float | datetime.datetime, end_timestamp: float | datetime.datetime, branch_id: Optional[BranchID] = None) -> List[VersionID]:
+        return await self._run(self.database.versions_between, start_timestamp, end_timestamp, branch_id)
+
+    def metrics(self, reset: bool = False) -> dict:
+        # The metrics are safe to read from any thread, so there's no need to wait for the worker
+        return self.database.metrics(reset)
+
+    async def load(self, workers: Optional[int] = None, threads: bool = False) -> None:
+        await self._edit(self.database.load, workers, threads)
+
+    async def setup(self, user_str: Optional[str] = None) -> None:
+        await self._edit(self.database.setup, user_str)
+
+    async def save(self, full: bool = False) -> None:
+        await self._run(self.database.save, full)
+
+    async def compact(self) -> None:
+        await self._run(self.database.compact)
+
+    async def pack(self) -> None:
+        await self._run(self.database.pack)
+
+    async def collect_blobs(self) -> int:
+        return await self._run(self.database.collect_blobs)
+
+    async def gc(self, archive_unreachable: bool = False, archive_depth: Optional[int] = None) -> Tuple[List[VersionID], List[VersionID]]:
+        return await self._edit(self.database.gc, archive_unreachable, archive_depth)
+
+    async def commit(self, branch_id: BranchID, message: Optional[str] = None) -> VersionID:
+        return await self._edit(self.database.commit, branch_id, message)
+
+    async def update(self, id: ids.ID, deltas: Record) -> None:
+        await self._edit(self.database.update, id, deltas)
+
+    async def new_branch(self, version_id: VersionID, branch_name: str) -> BranchID:
+        return await self._edit(self.database.new_branch, version_id, branch_name)
+
+    async def start_merge(self, primary_branch_id: BranchID, tributary_version_id: VersionID,
+                          default_rules: dict, record_rules: dict) -> VersionID:
+        return await self._edit(self.database.start_merge, primary_branch_id, tributary_version_id, default_rules, record_rules)
+
+    async def edit_merge(self, id: ids.ID, default_rules: dict, record_rules: dict) -> None:
+        await self._edit(self.database.edit_merge, id, default_rules, record_rules)
+
+    async def setup_revision(self, prev_id: VersionID) -> VersionID:
+        return await self._edit(self.database.setup_revision, prev_id)
+
+    async def revise(self, revision_id: VersionID, new_id: ids.ID) -> None:
+        await self._edit(self.database.revise, revision_id, new_id)
+
+    async def close(self) -> None:
+        await self._run(self.database.close)
+        if self._owns_executor:
+            self._executor.shutdown()
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from database import Database, VersionID, BranchID, VersionType
+import ids
+
+
+def random_text(random_generator: random.Random, words: int) -> str:
+    vocabulary = ['the', 'class', 'of', 'year', 'team', 'club', 'always', 'remember', 'friends', 'teacher',
+                  'science', 'music', 'fair', 'trip', 'captain', 'award', 'quote', 'best', 'future', 'summer']
+    return ' '.join(random_generator.choice(vocabulary) for _ in range(words))
+
+
+def print_results(results: List[dict]) -> None:
+    columns = list(results[0].keys())
+    print('  '.join(f'{column:>19}' for column in columns))
+    for result in results:
+        print('  '.join(f'{result[column]:>19.4f}' if isinstance(result[column], float) else f'{str(result[column]):>19}'
+                        for column in columns))
+
+
+def _committed_versions(db: Database, branch_id: BranchID) -> List[VersionID]:
+    """The committed versions on a branch, oldest first"""
+
+    branch = db._get_branch(branch_id)
+    version_ids = []
+    version_id = db._get_version(branch.end).previous
+    while version_id is not None and db._get_version(version_id).branch == branch_id:
+        version_ids.append(version_id)
+        version_id = db._get_version(version_id).previous
+    version_ids.reverse()
+    return version_ids
+
+
+def generate_history(db: Database, records: int = 100, branches: int = 3, changes_per_branch: int = 20, merges: int = 2,
+                     revisions: int = 2, field_size: int = 50, seed: int = 0) -> Dict[str, List[str]]:
+    """Build a synthetic history in a database that has just been set up.
+
+    The trunk starts with records records, each with a text field of about field_size characters.
+    Then branches branches are made off the trunk, and the trunk and every branch get changes_per_branch commits each,
+    in turns, each editing a few records. Then the last commits of merges of the branches are merged into the trunk,
+    and revisions revisions are inserted into the trunk's history, each selecting the version two before it.
+    The same arguments and seed always make the same history.
+
+    Returns the IDs of the branches, merges, and revisions made.
+    """
+
+    random_generator = random.Random(seed)
+    record_ids = [db._next_record_id() for _ in range(records)]
+    words = max(1, field_size // 6)
+    db.update(ids.trunk_branch_id, {record_id: {'text': random_text(random_generator, words), 'number': 0} for record_id in record_ids})
+    db.commit(ids.trunk_branch_id)
+
+    branch_ids = [db.new_branch(_committed_versions(db, ids.trunk_branch_id)[-1], f'branch {i}') for i in range(branches)]
+    edits_per_commit = max(1, records // 20)
+    for commit_number in range(changes_per_branch):
+        for branch_id in [ids.trunk_branch_id] + branch_ids:
+            deltas = {}
+            for record_id in random_generator.sample(record_ids, edits_per_commit):
+                if random_generator.random() < 0.5:
+                    deltas[record_id] = {'text': random_text(random_generator, words)}
+                else:
+                    deltas[record_id] = {'number': commit_number}
+            db.update(branch_id, deltas)
+            db.commit(branch_id)
+
+    merge_ids = []
+    for branch_id in branch_ids[:merges]:
+        merge_ids.append(db.start_merge(ids.trunk_branch_id, _committed_versions(db, branch_id)[-1], {'all': 'p'}, {}))
+        db.commit(ids.trunk_branch_id)
+
+    revision_ids = []
+    trunk_version_ids = _committed_versions(db, ids.trunk_branch_id)
+    for revision_number in range(revisions):
+        # Spread the revisions out over the first part of the trunk, away from its start and its merges
+        index = 2 + (revision_number + 1) * (changes_per_branch - 2) // (revisions + 1)
+        if index >= len(trunk_version_ids) - merges - 1:
+            break
+        revision_id = db.setup_revision(trunk_version_ids[index])
+        db.revise(revision_id, trunk_version_ids[index - 2])
+        revision_ids.append(revision_id)
+    db.save()
+
+    return {'branches': branch_ids, 'merges': merge_ids, 'revisions': revision_ids}
+
+
+def _timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def benchmark_history(directory: str, settings: dict, seed: int = 0) -> Dict[str, float]:
+    """Time the main operations on a history made by generate_history with the given settings (its keyword arguments).
+
+    States are computed by a freshly loaded database, so the first computation of each state starts with nothing cached,
+    as it would in a new process.
+    """
+
+    path = os.path.join(directory, 'history_' + '_'.join(f'{value}' for value in settings.values()))
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    results: Dict[str, float] = {}
+    db = Database(path)
+    start = time.perf_counter()
+    db.setup()
+    history = generate_history(db, seed=seed, **settings)
+    results['generate seconds'] = time.perf_counter() - start
+    results['save seconds'] = _timed(db.save, True)
+    db.close()
+
+    db = Database(path)
+    results['load seconds'] = _timed(db.load)
+
+    tip_ids = [ids.trunk_branch_id] + history['branches']
+    results['tip state seconds'] = sum(_timed(db.compute_state, tip_id) for tip_id in tip_ids)
+    results['warm tip state seconds'] = sum(_timed(db.compute_state, tip_id) for tip_id in tip_ids)
+    trunk_version_ids = _committed_versions(db, ids.trunk_branch_id)
+    deep_version_ids = [version_id for version_id in trunk_version_ids[:len(trunk_version_ids) // 2]
+                        if db._version_type(db._get_version(version_id)) != VersionType.revision]
+    results['deep state seconds'] = _timed(db.compute_state, deep_version_ids[-1])
+
+    def commit():
+        db.update(ids.trunk_branch_id, {db._next_record_id(): {'text': 'new', 'number': 0}})
+        db.commit(ids.trunk_branch_id)
+    results['commit seconds'] = _timed(commit)
+
+    def merge():
+        branch_id = db.new_branch(trunk_version_ids[-1], 'merged branch')
+        db.update(branch_id, {db._next_record_id(): {'text': 'merged', 'number': 0}})
+        db.commit(branch_id)
+        db.start_merge(ids.trunk_branch_id, _committed_versions(db, branch_id)[-1], {'all': 't'}, {})
+        db.compute_state(ids.trunk_branch_id)
+    results['merge seconds'] = _timed(merge)
+
+    def revise():
+        revision_id = db.setup_revision(trunk_version_ids[1])
+        db.revise(revision_id, trunk_version_ids[0])
+        db.save()
+        db.compute_state(history['branches'][0] if history['branches'] != [] else ids.trunk_branch_id)
+    results['revise seconds'] = _timed(revise)
+    db.close()
+
+    return results
+
+
+# The report the suite's times are compared against by default, kept with the code so changes to it are measured against it
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# The histories the suite is run on, from small to large, so that the report shows how each operation scales
+suite_settings = [
+    {'records': 100, 'branches': 2, 'changes_per_branch': 20, 'merges': 1, 'revisions': 1, 'field_size': 50},
+    {'records': 1000, 'branches': 4, 'changes_per_branch': 50, 'merges': 2, 'revisions': 2, 'field_size': 50},
+    {'records': 1000, 'branches': 4, 'changes_per_branch': 200, 'merges': 3, 'revisions': 3, 'field_size': 200},
+]
+
+
+def run_suite(directory: str, settings: Optional[List[dict]] = None) -> dict:
+    """Run benchmark_history on each of the settings, and return a report that can be saved as JSON"""
+
+    if settings is None:
+        settings = suite_settings
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'runs': [{'settings': run_settings, 'results': benchmark_history(directory, run_settings)} for run_settings in settings]}
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float = 1.5, minimum_seconds: float = 0.01) -> List[str]:
+    """Returns a description of each time in report that is more than tolerance times the same time in baseline.
+
+    Times under minimum_seconds in both are ignored, since they are mostly noise.
+    Runs are matched up by their settings, so runs only in one of the reports are skipped.
+    """
+
+    regressions = []
+    baseline_runs = {json.dumps(run['settings'], sort_keys=True): run['results'] for run in baseline['runs']}
+    for run in report['runs']:
+        baseline_results = baseline_runs.get(json.dumps(run['settings'], sort_keys=True))
+        if baseline_results is None:
+            continue
+        for name, seconds in run['results'].items():
+            baseline_seconds = baseline_results.get(name)
+            if baseline_seconds is None or max(seconds, baseline_seconds) < minimum_seconds:
+                continue
+            if seconds > tolerance * baseline_seconds:
+                regressions.append(f'{name} with {run["settings"]}: {seconds:.4f}s, up from {baseline_seconds:.4f}s')
+    return regressions
+
+
+if __name__ == '__main__':
+    # Run from a folder with a folders.json, like the other tools, since database directories are found through it
+    parser = argparse.ArgumentParser(description='Benchmark the database on synthetic histories')
+    parser.add_argument('--report', help='where to write the report, as JSON')
+    parser.add_argument('--baseline', default=baseline_path,
+                        help='a report to compare against; written from this run if it doesn\'t exist')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='how many times slower than the baseline counts as a regression')
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = run_suite(directory)
+    print_results([{**run['settings'], **run['results']} for run in report['runs']])
+    if arguments.report is not None:
+        with open(arguments.report, 'w') as file:
+            json.dump(report, file, indent=4)
+    if not os.path.exists(arguments.baseline):
+        with open(arguments.baseline, 'w') as file:
+            json.dump(report, file, indent=4)
+        print(f'Wrote a new baseline to {arguments.baseline}')
+    else:
+        with open(arguments.baseline) as file:
+            regressions = compare_to_baseline(report, json.load(file), arguments.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions != []:
+            raise SystemExit(1)
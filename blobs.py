@@ -0,0 +1,67 @@
+import hashlib
+import json
+from typing import Any, Callable, Dict, Iterator
+
+
+# A record delta stored as a blob is replaced by a dict with just this key, whose value is the blob's ID
+reference_key = '$blob'
+
+
+def canonical_json(value: Any) -> str:
+    """The one JSON text of a value that its blob ID is computed from, so equal values always get the same ID"""
+
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def blob_id(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def is_reference(value: Any) -> bool:
+    return isinstance(value, dict) and len(value) == 1 and reference_key in value
+
+
+def references(version_data: dict) -> Iterator[str]:
+    """The IDs of the blobs a stored version refers to, once for each reference"""
+
+    change = version_data.get('change')
+    if change is None or change.get('deltas') is None:
+        return
+    for record_delta in change['deltas'].values():
+        if is_reference(record_delta):
+            yield record_delta[reference_key]
+
+
+def store_values(version_data: dict, threshold: int, new_blobs: Dict[str, str]) -> dict:
+    """Returns the data to store for a version, with each record delta whose JSON is at least threshold long replaced by a reference.
+
+    The version's own data is left alone. The blobs referred to are added to new_blobs, by ID, as canonical JSON.
+    """
+
+    change = version_data.get('change')
+    if change is None or change.get('deltas') is None:
+        return version_data
+
+    stored_deltas = {}
+    for record_id, record_delta in change['deltas'].items():
+        if isinstance(record_delta, dict):
+            text = canonical_json(record_delta)
+            if len(text) >= threshold:
+                id = blob_id(text)
+                new_blobs[id] = text
+                record_delta = {reference_key: id}
+        stored_deltas[record_id] = record_delta
+
+    return {**version_data, 'change': {**change, 'deltas': stored_deltas}}
+
+
+def load_values(version_data: dict, read_blob: Callable[[str], Any]) -> None:
+    """Replaces the references in a stored version's data with the values of the blobs they refer to, in place"""
+
+    change = version_data.get('change')
+    if change is None or change.get('deltas') is None:
+        return
+    deltas = change['deltas']
+    for record_id, record_delta in deltas.items():
+        if is_reference(record_delta):
+            deltas[record_id] = read_blob(record_delta[reference_key])
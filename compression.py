@@ -0,0 +1,50 @@
+import json
+import lzma
+import zlib
+from typing import Any, Optional
+
+
+methods = ['zlib', 'lzma']
+
+# Compressed data is recognized by how it starts, so files written with and without compression can be mixed freely:
+# JSON starts with '{' (or whitespace), a zlib stream with 'x', and lzma's xz format with its magic bytes
+_xz_magic = b'\xfd7zXZ\x00'
+
+
+def compress(data: bytes, method: Optional[str], level: Optional[int] = None) -> bytes:
+    """Compress data with one of the methods (or return it as it is, if method is None).
+
+    level: the zlib level (0-9) or lzma preset (0-9), or None for the method's default
+    """
+
+    if method is None:
+        return data
+    elif method == 'zlib':
+        return zlib.compress(data, -1 if level is None else level)
+    elif method == 'lzma':
+        return lzma.compress(data, preset=level)
+    else:
+        raise ValueError(f'Unknown compression method {method}')
+
+
+def decompress(data: bytes) -> bytes:
+    """Undo compress, whichever method it used (data that isn't compressed is returned as it is)"""
+
+    if data[:len(_xz_magic)] == _xz_magic:
+        return lzma.decompress(data)
+    elif data[:1] == b'x':
+        return zlib.decompress(data)
+    else:
+        return data
+
+
+def dumps(data: Any, method: Optional[str], level: Optional[int] = None, indent: Optional[int] = None) -> bytes:
+    """JSON, compressed with method; compressed JSON is written compactly, since indenting it would only cost space"""
+
+    if method is None:
+        return json.dumps(data, indent=indent).encode()
+    return compress(json.dumps(data, separators=(',', ':')).encode(), method, level)
+
+
+def loads(data: bytes) -> Any:
+    return json.loads(decompress(data))
@@ -0,0 +1,85 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import List, Optional
+
+from benchmark import print_results, random_text
+from database import Database, StorageOptions
+
+
+def _directory_size(path: str) -> int:
+    size = 0
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(directory, filename))
+    return size
+
+
+def write_text_history(db: Database, commits: int, records_per_commit: int = 5, seed: int = 0) -> None:
+    """Commit a history of records with long text fields (bios, quotes, and captions) to the trunk"""
+
+    random_generator = random.Random(seed)
+    for _ in range(commits):
+        deltas = {}
+        for _ in range(records_per_commit):
+            deltas[db._next_record_id()] = {'bio': random_text(random_generator, 120), 'quote': random_text(random_generator, 20),
+                                            'caption': random_text(random_generator, 30)}
+        db.update('b,TRUNK', deltas)
+        db.commit('b,TRUNK')
+
+
+def benchmark_compression(directory: str, commits: int = 200,
+                          settings: Optional[List[tuple]] = None) -> List[dict]:
+    """Write, pack, and read back the same text-heavy history with each compression setting.
+
+    For each (method, level), reports the bytes on disk with loose version files and after packing,
+    and the seconds taken to write the history, to load it, and to read every version lazily.
+    """
+
+    if settings is None:
+        settings = [(None, None), ('zlib', 1), ('zlib', 6), ('zlib', 9), ('lzma', 0), ('lzma', 6)]
+
+    results = []
+    for method, level in settings:
+        path = os.path.join(directory, f'compression_{method}_{level}')
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+        db = Database(path, storage_options=StorageOptions(compression_method=method, compression_level=level))
+        start = time.perf_counter()
+        db.setup()
+        write_text_history(db, commits)
+        write_seconds = time.perf_counter() - start
+        loose_bytes = _directory_size(db._database_path('versions'))
+
+        start = time.perf_counter()
+        Database(path).load()
+        load_seconds = time.perf_counter() - start
+
+        lazy_db = Database(path, storage_options=StorageOptions(lazy=True))
+        lazy_db.load()
+        start = time.perf_counter()
+        for version_id in list(lazy_db._unloaded_versions):
+            lazy_db._get_version(version_id)
+        lazy_seconds = time.perf_counter() - start
+
+        db.pack()
+        packed_bytes = _directory_size(db._database_path('packs')) + _directory_size(db._database_path('versions'))
+        start = time.perf_counter()
+        Database(path).load()
+        packed_load_seconds = time.perf_counter() - start
+        for database in [db, lazy_db]:
+            database.close()
+
+        results.append({'method': method, 'level': level, 'loose bytes': loose_bytes, 'packed bytes': packed_bytes,
+                        'write seconds': write_seconds, 'load seconds': load_seconds,
+                        'lazy read seconds': lazy_seconds, 'packed load seconds': packed_load_seconds})
+    return results
+
+
+if __name__ == '__main__':
+    # Run from a folder with a folders.json, like the other tools, since database directories are found through it
+    with tempfile.TemporaryDirectory() as directory:
+        print_results(benchmark_compression(directory))
@@ -8,11 +8,27 @@ import json
 from json_interface import *
 from yearbook_setup import core_path, construct_path, PS
 import ids
-from typing import Dict, List, Tuple, NewType
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, NewType
 from enum import Enum, StrEnum
 import view
+import packs
+import storage
+from storage import StorageOptions
+import locks
+import blobs
+import compression
+from metrics import Metrics, measured
+import tracing
 import os
 import datetime
+import concurrent.futures
+import contextlib
+import copy
+import bisect
+import heapq
+import itertools
+import time
+from copy import deepcopy
 
 Record = NewType('Record', JSONDict)
 Version = NewType('Version', JSONDict)
@@ -25,6 +41,18 @@ BranchID = NewType('BranchID', ids.ID)
 ViewID = NewType('ViewID', ids.ID)
 
 
+# How many times load reads the files while another process is saving, and how long it waits before the first retry
+# (doubling each time), before giving up with a ConflictError
+load_attempts = 10
+load_retry_seconds = 0.01
+
+# How many commits a branch's stored snapshot can fall behind before it is rewritten (see _update_tip_snapshot)
+snapshot_lag_limit = 16
+
+# Beside each archive pack, the links of the versions in it (see _links_from_data)
+archive_links_extension = '.links'
+
+
 class VersionType(Enum):
     change = 0
     merge = 1
@@ -36,9 +64,308 @@ class YBDBException(Exception):
     pass
 
 
+class ConflictError(YBDBException):
+    """Another process saved the database after this one last loaded or saved it"""
+    pass
+
+
+# Giving these strings names so it's easier to know what I'm writing
+class MergeRule(StrEnum):
+    inherit = ''
+    inherit_prioritizing_field = 'f'
+    inherit_prioritizing_record = 'r'
+    primary_if_conflict = 'p'
+    tributary_if_conflict = 't'
+    primary_always = 'p!'
+    tributary_always = 't!'
+MR = MergeRule
+explicit_rules = [MR.primary_if_conflict, MR.tributary_if_conflict, MR.primary_always, MR.tributary_always]
+
+
+class MergeRuleTable:
+    """A merge version's rules, resolved down to one explicit rule for each (record, field).
+
+    There are four levels of rules that could apply to a field of a record:
+    - default_rule: the default rule for the whole merge
+    - field_rule: the default rule for this field across all records
+    - record_rule: the default rule for all fields of this record
+    - record_field_rule: the rule for this specific field of this record
+    Each row maps fields to the rule that wins out. Records without rules of their own all share the default row,
+    so looking up a rule is just a dict lookup. Rows are filled in the first time each field is looked up.
+    """
+
+    def __init__(self, rules: Union[JSONDict, dict]):
+        self.record_rules: Dict[RecordID, dict] = {}
+        self.record_rows: Dict[RecordID, Dict[str, MergeRule]] = {}
+        self.set_default_rules(as_raw(rules).get('default'))
+        for record_id, record_rules in (as_raw(rules).get('records') or {}).items():
+            self.set_record_rules(record_id, record_rules)
+
+    def set_default_rules(self, default_rules: Optional[dict]) -> None:
+        """Change the merge-wide rules; every row has to be resolved again"""
+
+        default_rules = default_rules or {}
+        self.default_rule = MR(default_rules['all']) if default_rules.get('all') is not None else MR.primary_if_conflict
+        self.field_rules: Dict[str, str] = default_rules.get('fields') or {}
+        self.inherit_priority = default_rules.get('inherit priority')
+        self.default_row: Dict[str, MergeRule] = {}
+        for record_row in self.record_rows.values():
+            record_row.clear()
+
+    def set_record_rules(self, record_id: RecordID, record_rules: Optional[dict]) -> None:
+        """Change the rules for one record; only that record's row has to be resolved again"""
+
+        if record_rules is None or record_rules == {}:
+            self.record_rules.pop(record_id, None)
+            self.record_rows.pop(record_id, None)
+        else:
+            self.record_rules[record_id] = record_rules
+            self.record_rows[record_id] = {}
+
+    def record_rule(self, record_id: RecordID) -> MergeRule:
+        """The rule for whether to take a record that only exists in one of the inputs"""
+
+        record_rules = self.record_rules.get(record_id)
+        if record_rules is not None and record_rules.get('all') in explicit_rules:
+            return MR(record_rules['all'])
+        return self.default_rule
+
+    def row(self, record_id: RecordID) -> Dict[str, MergeRule]:
+        return self.record_rows.get(record_id, self.default_row)
+
+    def field_rule(self, record_id: RecordID, field: str) -> MergeRule:
+        row = self.row(record_id)
+        if field not in row:
+            row[field] = self._resolve(record_id, field)
+        return row[field]
+
+    def _resolve(self, record_id: RecordID, field: str) -> MergeRule:
+        field_rule = self.field_rules.get(field) or MR.inherit
+
+        record_rule = MR.inherit
+        record_field_rule = MR.inherit
+        record_rules = self.record_rules.get(record_id)
+        if record_rules is not None:
+            if record_rules.get('all') is not None:
+                record_rule = record_rules['all']
+            if record_rules.get('fields') is not None and record_rules['fields'].get(field) is not None:
+                record_field_rule = record_rules['fields'][field]
+
+        # From these four rules, figure out what rule to apply in this case
+        if record_field_rule in explicit_rules:
+            rule = record_field_rule
+        else:
+            if field_rule in explicit_rules:
+                if record_rule in explicit_rules and field_rule != record_rule:
+                    if record_field_rule == MR.inherit_prioritizing_field:
+                        rule = field_rule
+                    elif record_field_rule == MR.inherit_prioritizing_record:
+                        rule = record_rule
+                    elif self.inherit_priority == MR.inherit_prioritizing_field:
+                        rule = field_rule
+                    else:
+                        rule = record_rule
+                else:
+                    rule = field_rule
+            else:
+                if record_rule in explicit_rules:
+                    rule = record_rule
+                else:
+                    rule = self.default_rule
+        return MR(rule)
+
+
+def _parse_thing_files(thing_template: dict, file_paths: List[str]) -> List[Optional[dict]]:
+    """Reads a list of version, branch, or view files and checks each one against the template.
+
+    Returns the data of each file, or None for files that don't match the template.
+    This is a module-level function so that Database.load can run it in worker processes.
+    """
+
+    output = []
+    for file_path in file_paths:
+        # Another process's save may have removed the file since the directory was listed
+        try:
+            with open(file_path, 'rb') as file:
+                thing_data = compression.loads(file.read())
+        except FileNotFoundError:
+            output.append(None)
+            continue
+        try:
+            JSONDict('', thing_template, thing_data)
+        except:
+            thing_data = None
+        output.append(thing_data)
+    return output
+
+
+def _parse_pack_records(thing_template: dict, pack_path: str, record_ids: List[str]) -> List[Optional[dict]]:
+    """The same as _parse_thing_files, but for records stored in a pack"""
+
+    pack = packs.Pack(pack_path)
+    output = []
+    for id in record_ids:
+        thing_data = pack.read(id)
+        try:
+            JSONDict('', thing_template, thing_data)
+        except:
+            thing_data = None
+        output.append(thing_data)
+    pack.close()
+    return output
+
+
+def _write_json(file_path: str, data: Any, indent: Optional[int] = None,
+                compression_method: Optional[str] = None, compression_level: Optional[int] = None) -> int:
+    """Write a JSON file (compressed, if a method is given) atomically (see locks.write_atomically), and return the number of bytes written"""
+
+    data_bytes = compression.dumps(data, compression_method, compression_level, indent=indent)
+    locks.write_atomically(file_path, data_bytes)
+    return len(data_bytes)
+
+
+def _links_from_data(version_data: dict) -> dict:
+    """What gc follows from a version, and the blobs it refers to, which are kept beside each archive so gc never has to read it.
+
+    The parents are the versions the version's state depends on directly, which for a revision is only what it selects now,
+    and selected is what revisions selected before (the revision's original selection, and those its commits recorded),
+    which only the states of older commits depend on. Revision selections that are branches are left as branch IDs.
+    """
+
+    parents = [] if version_data.get('previous') is None else [version_data['previous']]
+    selected = []
+    merge = version_data.get('merge')
+    if merge is not None:
+        parents.append(merge['tributary'])
+    revision = version_data.get('revision')
+    if revision is not None:
+        parents.append(revision['current'])
+        selected.append(revision['original'])
+    for edit in [version_data.get('change'), merge]:
+        if edit is not None and edit.get('revision changes') is not None:
+            selected += edit['revision changes'].values()
+    return {'parents': parents, 'selected': selected, 'next': version_data.get('next'),
+            'merged to': version_data.get('merged to') or [], 'revisions using': version_data.get('revisions using') or [],
+            'blobs': sorted(set(blobs.references(version_data)))}
+
+
+def convert_database(source_path: str, destination_path: str, record_template: Optional[dict] = None) -> None:
+    """Copy a database to a new path, converting between the directory and SQLite formats according to the paths.
+
+    Only the versions, branches, views, and id info are copied: tip snapshots are left behind (to be rebuilt by a database
+    with tip_snapshots), and values kept in the blob store are written inline, since the destination has no blob_threshold.
+    """
+
+    source = Database(source_path, record_template)
+    source.load()
+    source._load_all_versions()
+
+    destination = Database(destination_path, record_template)
+    destination._id_info.set_data(source._id_info.as_raw())
+    for database_dir_key in ['versions', 'branches', 'views']:
+        destination_attr = destination._attr_for_dir(database_dir_key)
+        for id, thing_data in source._attr_for_dir(database_dir_key)._data.items():
+            destination_attr[id] = thing_data
+    destination.save(full=True)
+
+
+def _compute_merge_chunk(state_template: dict, primary_data: dict, tributary_data: dict, lca_data: dict,
+                         rules_type_name: str, rules_template: dict, rules_data: dict) -> dict:
+    """Merges one chunk of records; the raw data in and out can be sent to and from a worker process"""
+
+    primary = JSONDict('database state', state_template, primary_data)
+    tributary = JSONDict('database state', state_template, tributary_data)
+    lca = JSONDict('database state', state_template, lca_data)
+    rules = JSONDict(rules_type_name, rules_template, rules_data)
+    return Database._compute_merge(primary, tributary, lca, rules)._data
+
+
 class Database:
-    def __init__(self, path: Optional[str], record_template: Optional[dict] = None):
+    def __init__(self, path: Optional[str], record_template: Optional[dict] = None, storage_options: Optional[StorageOptions] = None,
+                 merge_workers: Optional[int] = None, merge_chunk_size: int = 500, tip_snapshots: bool = False, snapshot_reads: bool = False,
+                 collect_metrics: bool = False, metrics_log: Optional[str] = None, trace: bool = False):
+        """path: the database directory (or SQLite file), or None for a database that is only kept in memory
+        record_template: the template that every record in the database state must match
+        storage_options: how the database is stored and loaded (see StorageOptions)
+        merge_workers: if more than 1, merges of at least merge_chunk_size records a worker are split across this many processes
+        tip_snapshots: store the state at each branch's last commit, so recent states are read rather than rebuilt (see _update_tip_snapshot)
+        snapshot_reads: publish a read-only copy of the database after every edit, for other threads to read (see snapshot)
+        collect_metrics, metrics_log, trace: count and time what the database does, logging each call to metrics_log if given,
+            and with trace, record nested spans (see metrics and write_trace)
+        """
+
+        if storage_options is None:
+            storage_options = StorageOptions()
         self.path = path
+        self.journal = storage_options.journal
+        self.fsync = storage_options.fsync
+        self.compact_every = storage_options.compact_every
+        self.lazy = storage_options.lazy
+        self.merge_workers = merge_workers
+        self.merge_chunk_size = merge_chunk_size
+        self.tip_snapshots = tip_snapshots
+        self.snapshot_reads = snapshot_reads
+        self.blob_threshold = storage_options.blob_threshold
+        if storage_options.compression_method is not None and storage_options.compression_method not in compression.methods:
+            raise YBDBException(f'Unknown compression method {storage_options.compression_method}')
+        self.compression_method = storage_options.compression_method
+        self.compression_level = storage_options.compression_level
+        self._merge_executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._metrics: Optional[Metrics] = Metrics(metrics_log) if collect_metrics or metrics_log is not None else None
+        self._tracer: Optional[tracing.Tracer] = tracing.Tracer() if trace else None
+
+        # The compiled rules of each merge version that has been computed (see MergeRuleTable)
+        self._merge_rule_tables: Dict[VersionID, MergeRuleTable] = {}
+
+        # Composed deltas of runs of committed change versions, so compute_state can skip over them (see _delta_block)
+        # For each version, maps a level to the versions the run covers and the composed delta of that run
+        self._delta_blocks: Dict[VersionID, Dict[int, Tuple[Tuple[VersionID, ...], dict]]] = {}
+
+        # With tip_snapshots, each branch's last committed version and its state, and for each change or merge version,
+        # the reverse delta back to the state of the version before it (see _update_tip_snapshot)
+        # Each is read from storage the first time it is needed; None means there isn't one
+        self._tip_snapshots: Dict[BranchID, Optional[Tuple[VersionID, DBState]]] = {}
+        self._reverse_deltas: Dict[VersionID, Optional[dict]] = {}
+        # The snapshots and reverse deltas that have changed since the last save
+        self._snapshots_dirty: Dict[str, Set[ids.ID]] = {'snapshots': set(), 'reverse deltas': set()}
+        # How many commits each branch's snapshot in memory is ahead of the stored one
+        self._snapshot_lags: Dict[BranchID, int] = {}
+
+        # The database's epoch as of this object's last load or save, or None before either (see _writing)
+        self._epoch: Optional[int] = None
+        # While writing to SQLite, the epoch the write will leave the database at
+        self._next_epoch: Optional[int] = None
+        # How many writes are in progress, since save, compact, and pack call each other and only the outermost one takes the lock
+        self._write_depth = 0
+        # While writing to a directory, the epoch the write started at, and whether the epoch has been made odd yet
+        self._write_start_epoch: Optional[int] = None
+        self._epoch_odd = False
+
+        # With snapshot_reads, the last published snapshot, and the versions, branches, and views changed since it was published
+        self._published: Optional[Database] = None
+        self._unpublished: Dict[str, Set[ids.ID]] = {'versions': set(), 'branches': set(), 'views': set()}
+        if snapshot_reads and self.lazy:
+            raise YBDBException('A database with snapshot reads can\'t load versions lazily')
+
+        # The blobs known to be stored already, so they aren't written again, and while loading,
+        # the JSON of each blob read so far, so that blobs referred to by many versions are only read once
+        self._stored_blobs: Set[str] = set()
+        self._blob_cache: Optional[Dict[str, str]] = None
+
+        backend = storage_options.backend
+        if backend is None:
+            backend = 'sqlite' if storage.is_sqlite_path(path) else 'directory'
+        if backend == 'sqlite':
+            self._storage: Optional[storage.Storage] = storage.SQLiteStorage(path)
+        elif backend == 'directory':
+            self._storage = None
+        else:
+            raise YBDBException(f'Unknown database backend {backend}')
+        if self._storage is not None:
+            # SQLite does its own journaling and stores its rows uncompressed, so these would do nothing
+            for option_name in ['journal', 'fsync', 'compact_every', 'compression_method']:
+                if getattr(self, option_name) not in [None, False]:
+                    raise YBDBException(f'The {option_name} option only applies to the directory format')
 
         with open(core_path('version template')) as file:
             self._version_template: dict = json.load(file)
@@ -54,85 +381,1241 @@ class Database:
         self._branches = JSONDict('versions', {'': self._branch_template}, {})
         self._views = JSONDict('versions', {'': self._view_template}, {})
         
-        self._id_info = JSONDict('id info', self._id_info_template, {})
+        self._id_info = JSONDict('id info', self._id_info_template, {}, callback=self._mark_id_info_dirty)
+
+        # The IDs of the versions, branches, and views that have been changed or deleted since the last save,
+        # keyed by the name of the directory they are saved in
+        self._dirty: Dict[str, Set[ids.ID]] = {'versions': set(), 'branches': set(), 'views': set()}
+        self._deleted: Dict[str, Set[ids.ID]] = {'versions': set(), 'branches': set(), 'views': set()}
+        self._id_info_dirty = False
+
+        # The same information for changes that have been appended to the journal but not yet compacted into the files
+        self._journaled: Dict[str, Set[ids.ID]] = {'versions': set(), 'branches': set(), 'views': set()}
+        self._journal_deleted: Dict[str, Set[ids.ID]] = {'versions': set(), 'branches': set(), 'views': set()}
+        self._journal_entries = 0
+
+        # Packs of version records, newest first (see pack)
+        self._packs: List[packs.Pack] = []
+        # Packs of archived versions, newest first, which are only read from when a version in them is used (see gc)
+        self._archives: List[packs.Pack] = []
+        # The handles on those packs that published snapshots read through, by the pack each is on (see _publish)
+        self._pack_handles: Dict[packs.Pack, packs.Pack] = {}
+        # For each archived version, what its archive's links file says about it (see _links_from_data)
+        self._archive_links: Dict[VersionID, dict] = {}
+
+        # In lazy mode, where to read each version that has not been read yet: the path of its file, the pack it is in, or the storage backend
+        self._unloaded_versions: Dict[VersionID, Union[str, packs.Pack, storage.Storage]] = {}
+
+        # While a transaction is open, the data each version, branch, and view had before the transaction touched it
+        # (None for things the transaction created), keyed by the name of the directory they are saved in
+        self._transaction_originals: Optional[Dict[str, Dict[ids.ID, Optional[dict]]]] = None
+
+        # For each record, the versions whose deltas or merge rules touch it, and which of its fields they touch
+        # (an empty list of fields means the whole record was set or deleted)
+        # Built on load (or the first time it is needed, in lazy mode), then kept up to date as versions are edited
+        self._record_index: Optional[Dict[RecordID, Dict[VersionID, List[str]]]] = None
+        self._version_records: Dict[VersionID, Set[RecordID]] = {}
+
+        # For each branch, the timestamps of its committed versions in order, and the versions with those timestamps
+        # Built the first time it is needed, then kept up to date on commit (see compute_state_at)
+        self._time_index: Optional[Dict[BranchID, Tuple[List[float], List[VersionID]]]] = None
+
+        # The walks back through history that log has stopped partway through, by the cursor that carries each on
+        self._log_walks: Dict[str, Iterator[VersionID]] = {}
 
         # self.view_objects: List[view.EditableVersionView] = []
 
         self._state_template = {"": record_template}
+
+        # The revision states of each branch's last commit and of its open version, each traced back when needed and then kept
+        # until an edit could change it: revise drops the current states that use the revision, a commit that records
+        # revision changes drops its branch's committed state, and setup_revision drops them all
+        self._committed_revisions: Dict[BranchID, Dict[VersionID, VersionID]] = {}
+        self._current_revisions: Dict[BranchID, Dict[VersionID, VersionID]] = {}
     
     def _database_path(self, key: str, *args: List[str]) -> str:
         return construct_path(self.path, (PS.core, key), *args)
     
-    def load(self) -> None:
+    @measured
+    def load(self, workers: Optional[int] = None, threads: bool = False) -> None:
         """Load the data from the database directory
         
         Anytime you create a Database object based on a file, you must next call eiter load or setup.
+
+        workers: if more than 1, the files are read and checked in chunks spread across this many worker processes
+        threads: use worker threads instead of worker processes (only the file reading happens in parallel then)
+
+        Loading never takes the lock. If the epoch shows that a save happened while the files were being read,
+        they are read again, after a short wait that doubles each time, up to load_attempts times (see _writing).
+        In lazy mode, each version is read when it is first used, so a version saved by another process in the meantime
+        is read as it is then.
         """
 
+        if self._storage is not None:
+            with self._storage.reading():
+                epoch = self._storage.read_epoch()
+                self._load_from_storage()
+            self._epoch = epoch
+            self._publish(full=True)
+            return
+
+        for attempt in range(load_attempts):
+            epoch = locks.read_epoch(self._database_path('epoch'))
+            try:
+                self._load_files(workers, threads)
+                error = None
+            except Exception as e:
+                # Files caught halfway through another process's save can fail to read; that only counts if no save was happening
+                error = e
+            # An odd epoch means a save was in progress, unless no process holds the lock, because that save was interrupted
+            if locks.read_epoch(self._database_path('epoch')) == epoch and \
+                    (epoch % 2 == 0 or not locks.is_locked(self._database_path('lock'))):
+                break
+            if attempt < load_attempts - 1:
+                time.sleep(load_retry_seconds * 2 ** attempt)
+        else:
+            raise ConflictError(f'{self.path} was being saved by another process each of the {load_attempts} times it was read')
+        if error is not None:
+            raise error
+        self._epoch = epoch
+        self._publish(full=True)
+
+    def _load_files(self, workers: Optional[int], threads: bool) -> None:
+        """Read the database directory's files, packs, and journal"""
+
+        if workers is not None and workers > 1:
+            if threads:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            else:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            executor = None
+
+        def parse_in_chunks(parse_function, items, *args):
+            if executor is None or len(items) == 0:
+                return parse_function(*args, items)
+            # A few chunks per worker, so that one slow chunk doesn't hold up the rest
+            chunk_size = max(1, -(-len(items) // (workers * 4)))
+            chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+            # map returns the results in the order of the chunks, so the output doesn't depend on which worker finishes first
+            results = executor.map(parse_function, *[[arg] * len(chunks) for arg in args], chunks)
+            return [thing_data for chunk_result in results for thing_data in chunk_result]
+
         def load_dir_to_attr(database_dir_key, thing_template, thing_name, attr):
-            for file_info in os.scandir(self._database_path(database_dir_key)):
+            # A database that has only ever been saved to its journal has no directories yet
+            if not os.path.exists(self._database_path(database_dir_key)):
+                return
+            roots = []
+            file_paths = []
+            for file_info in sorted(os.scandir(self._database_path(database_dir_key)), key=lambda file_info: file_info.name):
                 if not file_info.is_file():
                     continue
                 filename = file_info.name
                 root, extension = os.path.splitext(filename)
                 if extension != '.json':
                     continue
-                with open(self._database_path(database_dir_key, filename)) as file:
-                    thing_data = json.load(file)
-                try:
-                    JSONDict('', thing_template, thing_data)
-                except:
+                roots.append(root)
+                file_paths.append(self._database_path(database_dir_key, filename))
+            self._count('files read', len(file_paths))
+            for root, thing_data in zip(roots, parse_in_chunks(_parse_thing_files, file_paths, thing_template)):
+                if thing_data is None:
                     continue
                 id = thing_data['id']
                 if id != root:
                     raise Exception(f'Encountered a {thing_name} whose filename {root} is different from its id {id}')
+                if database_dir_key == 'versions':
+                    blobs.load_values(thing_data, self._read_blob)
                 attr[id] = thing_data
         
-        with open(self._database_path('id info')) as file:
-            self._id_info.set_data(json.load(file))
-        load_dir_to_attr('versions', self._version_template, 'version', self._versions)
-        load_dir_to_attr('branches', self._branch_template, 'branch', self._branches)
-        load_dir_to_attr('views', self._view_template, 'view', self._views)
+        def load_packs_to_attr(thing_template, thing_name, attr):
+            # Loose files take precedence over packs, and newer packs take precedence over older ones
+            for pack in self._packs:
+                record_ids = [id for id in pack.ids() if id not in attr]
+                self._count('pack records read', len(record_ids))
+                for id, thing_data in zip(record_ids, parse_in_chunks(_parse_pack_records, record_ids, thing_template, pack.path)):
+                    if thing_data is None:
+                        continue
+                    if thing_data['id'] != id:
+                        raise Exception(f'Encountered a packed {thing_name} whose index entry {id} is different from its id {thing_data["id"]}')
+                    blobs.load_values(thing_data, self._read_blob)
+                    attr[id] = thing_data
         
-    def save(self) -> None:
-        """Save this object's data to the database"""
+        try:
+            self._committed_revisions = {}
+            self._current_revisions = {}
+            self._stored_blobs = set()
+            self._blob_cache = {}
+
+            for pack in self._packs + self._archives:
+                pack.close()
+            self._packs = [packs.Pack(pack_path) for pack_path in reversed(packs.pack_paths(self._database_path('packs')))]
+            self._archives = [packs.Pack(pack_path) for pack_path in reversed(packs.pack_paths(self._database_path('archive')))]
+
+            if os.path.exists(self._database_path('id info')):
+                with open(self._database_path('id info')) as file:
+                    self._id_info.set_data(json.load(file))
+            self._unloaded_versions = {}
+            if self.lazy:
+                self._index_versions()
+            else:
+                load_dir_to_attr('versions', self._version_template, 'version', self._versions)
+                load_packs_to_attr(self._version_template, 'version', self._versions)
+            self._archive_links = {}
+            for archive in self._archives:
+                # Archives written before links files were kept have none, and their versions are read when gc needs them
+                if os.path.exists(archive.path + archive_links_extension):
+                    with open(archive.path + archive_links_extension) as file:
+                        archive_links = json.load(file)
+                    for id in archive.ids():
+                        if id in archive_links and id not in self._archive_links:
+                            self._archive_links[id] = archive_links[id]
+            # Archived versions are never read on load, even when every other version is
+            for archive in self._archives:
+                for id in archive.ids():
+                    if id not in self._versions._data and id not in self._unloaded_versions:
+                        self._unloaded_versions[id] = archive
+            load_dir_to_attr('branches', self._branch_template, 'branch', self._branches)
+            load_dir_to_attr('views', self._view_template, 'view', self._views)
+            self._clear_dirty()
+            self._replay_journal()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self._blob_cache = None
+
+        self._after_load()
+
+    def _load_from_storage(self) -> None:
+        """Load the data from a storage backend rather than the database directory"""
+
+        self._committed_revisions = {}
+        self._current_revisions = {}
+        self._unloaded_versions = {}
+        self._stored_blobs = set()
+
+        id_info = self._storage.read_id_info()
+        if id_info is not None:
+            self._id_info.set_data(id_info)
+
+        for database_dir_key, thing_template in [('versions', self._version_template), ('branches', self._branch_template), ('views', self._view_template)]:
+            if database_dir_key == 'versions' and self.lazy:
+                for id in self._storage.list_ids(database_dir_key):
+                    self._unloaded_versions[id] = self._storage
+                continue
+
+            attr = self._attr_for_dir(database_dir_key)
+            for id, thing_data in self._storage.read_all(database_dir_key):
+                try:
+                    JSONDict('', thing_template, thing_data)
+                except:
+                    continue
+                if database_dir_key == 'versions':
+                    blobs.load_values(thing_data, self._read_blob)
+                attr[id] = thing_data
+
+        self._clear_dirty()
+        self._after_load()
+
+    def _after_load(self) -> None:
+        """Rebuild or drop everything worked out from the data before it was loaded again"""
+
+        self._record_index = None
+        self._time_index = None
+        self._log_walks = {}
+        # Building the index reads every version, so with versions left unread, it waits until it's needed
+        if self._unloaded_versions == {}:
+            self._build_record_index()
+        self._merge_rule_tables = {}
+        self._delta_blocks = {}
+        self._clear_snapshots()
+
+    def _index_versions(self) -> None:
+        """Find out where each version is stored, without reading any of them"""
+
+        versions_path = self._database_path('versions')
+        if os.path.exists(versions_path):
+            for file_info in os.scandir(versions_path):
+                root, extension = os.path.splitext(file_info.name)
+                if file_info.is_file() and extension == '.json':
+                    self._unloaded_versions[root] = file_info.path
+
+        for pack in self._packs:
+            for id in pack.ids():
+                if id not in self._unloaded_versions:
+                    self._unloaded_versions[id] = pack
+
+    def _load_version(self, version_id: VersionID) -> None:
+        """Read, check, and cache a version that has not been read yet"""
+
+        source = self._unloaded_versions.pop(version_id, None)
+        if source is None:
+            # Another thread reading the same snapshot got to it first
+            return
+        if isinstance(source, packs.Pack):
+            version_data = source.read(version_id)
+            self._count('pack records read')
+        elif isinstance(source, storage.Storage):
+            version_data = source.read('versions', version_id)
+        else:
+            with open(source, 'rb') as file:
+                version_data = compression.loads(file.read())
+            self._count('files read')
+
+        try:
+            JSONDict('', self._version_template, version_data)
+        except:
+            raise YBDBException(f'The stored data for version {version_id} does not match the version template')
+        if version_data['id'] != version_id:
+            raise Exception(f'Encountered a version whose filename {version_id} is different from its id {version_data["id"]}')
+        blobs.load_values(version_data, self._read_blob)
+        # Straight into the data, since a snapshot's versions are static (and the data has just been checked)
+        self._versions._data[version_id] = version_data
+
+    def _load_all_versions(self) -> None:
+        for version_id in list(self._unloaded_versions.keys()):
+            self._load_version(version_id)
+
+    def _has_version(self, version_id: VersionID) -> bool:
+        return version_id in self._versions or version_id in self._unloaded_versions
+
+    def _attr_for_dir(self, database_dir_key: str) -> JSONDict:
+        return {'versions': self._versions, 'branches': self._branches, 'views': self._views}[database_dir_key]
+
+    def _mark_dirty(self, database_dir_key: str, id: ids.ID) -> None:
+        """Record that a version, branch, or view has changed and needs to be written on the next save"""
+
+        self._dirty[database_dir_key].add(id)
+        self._deleted[database_dir_key].discard(id)
+        self._unpublished[database_dir_key].add(id)
+
+    def _mark_id_info_dirty(self) -> None:
+        self._id_info_dirty = True
+
+    def _clear_dirty(self) -> None:
+        for database_dir_key in self._dirty:
+            self._dirty[database_dir_key] = set()
+            self._deleted[database_dir_key] = set()
+        self._id_info_dirty = False
+
+    def _remember_original(self, database_dir_key: str, id: ids.ID) -> None:
+        """If a transaction is open, keep a copy of a version, branch, or view before the transaction first changes it"""
+
+        if self._transaction_originals is None:
+            return
+        originals = self._transaction_originals[database_dir_key]
+        if id not in originals:
+            attr = self._attr_for_dir(database_dir_key)
+            originals[id] = deepcopy(attr._data[id]) if id in attr else None
+
+    def _delete(self, database_dir_key: str, id: ids.ID) -> None:
+        """Remove a version, branch, or view, and record that its file needs to be deleted on the next save"""
+
+        self._remember_original(database_dir_key, id)
+        attr = self._attr_for_dir(database_dir_key)
+        if id in attr:
+            del attr[id]
+        if database_dir_key == 'versions':
+            self._unloaded_versions.pop(id, None)
+            self._unindex_version_records(id)
+            self._time_index = None
+            self._log_walks = {}
+            self._merge_rule_tables.pop(id, None)
+            self._delta_blocks.pop(id, None)
+            if self.tip_snapshots:
+                self._reverse_deltas[id] = None
+                self._snapshots_dirty['reverse deltas'].add(id)
+                for branch_id, snapshot in self._tip_snapshots.items():
+                    if snapshot is not None and snapshot[0] == id:
+                        self._tip_snapshots[branch_id] = None
+                        self._snapshots_dirty['snapshots'].add(branch_id)
+        self._dirty[database_dir_key].discard(id)
+        self._deleted[database_dir_key].add(id)
+        self._unpublished[database_dir_key].add(id)
+        
+    @measured
+    def save(self, full: bool = False) -> None:
+        """Save this object's data to the database
+
+        Only the versions, branches, and views that have changed since the last save are written,
+        and only the ones that have been deleted since then are removed.
+        If the database uses a journal, the changes are appended to the journal instead (see compact).
+        If full is True, every version, branch, and view is written to its file, along with the id info.
+        Inside a transaction, this does nothing; everything is saved when the transaction finishes.
+        """
+
+        if self._transaction_originals is not None:
+            return
 
         if self.path is None:
+            self._clear_dirty()
+            self._write_snapshots()
+            self._publish()
             return
         
-        if not os.path.exists(self.path):
+        if self._storage is None and not os.path.exists(self.path):
             os.mkdir(self.path)
-        
-        def save_attr_to_dir(database_dir_key, thing_template, attr):
+
+        # Snapshot files are rewritten even then, but a snapshot's state never changes, so a reader can't be misled by a new one
+        with self._writing(appending=self._storage is None and self.journal and not full):
+            # Writing files directly while older changes are still in the journal would let the journal overwrite them on the next load
+            if self._storage is None and (full or not self.journal):
+                self.compact()
+
+            if full:
+                self._load_all_versions()
+                self._id_info_dirty = True
+                for database_dir_key in self._dirty:
+                    self._dirty[database_dir_key] = set(self._attr_for_dir(database_dir_key).keys())
+
+            if self._storage is not None:
+                self._write_storage()
+            elif self.journal and not full:
+                self._append_journal()
+            else:
+                self._write_files()
+
+            self._clear_dirty()
+            self._write_snapshots()
+        self._publish()
+
+    @contextlib.contextmanager
+    def _writing(self, appending: bool = False):
+        """Hold the database's lock while writing to it, so that only one process writes at a time.
+
+        Each write moves the database's epoch on by two. Writing to a directory makes the epoch odd while the files are
+        being written, so that a process loading at the same time knows to read them again (see load).
+        If the epoch has moved since this object last loaded or saved, another process has saved in between, and this
+        raises a ConflictError rather than overwrite what that process saved; load again and redo the changes
+        (or use retry_on_conflict).
+        appending: the write only appends to the journal, whose torn last line a reader ignores anyway,
+            so the epoch only has to move once the append is done (unless something inside goes on to rewrite files)
+        """
+
+        if self._write_depth > 0:
+            if not appending:
+                self._start_rewriting()
+            self._write_depth += 1
+            try:
+                yield
+            finally:
+                self._write_depth -= 1
+            return
+
+        lock_path = self.path + '.lock' if self._storage is not None else self._database_path('lock')
+        self._write_depth += 1
+        try:
+            with locks.exclusive_lock(lock_path):
+                epoch = self._read_epoch()
+                if self._epoch is not None and epoch != self._epoch:
+                    raise ConflictError(f'{self.path} was saved by another process after it was loaded here')
+
+                if self._storage is not None:
+                    # SQLite stores the new epoch in the same transaction as the changes (see _write_storage)
+                    self._next_epoch = epoch + 2
+                    yield
+                    self._epoch = epoch + 2
+                    return
+
+                # An odd epoch with nobody holding the lock is left by a write that was interrupted, which this one finishes
+                epoch += epoch % 2
+                self._write_start_epoch = epoch
+                self._epoch_odd = False
+                if not appending:
+                    self._start_rewriting()
+                try:
+                    yield
+                finally:
+                    # Even if writing failed partway, the files have changed, and this object has the changes
+                    locks.write_epoch(self._database_path('epoch'), epoch + 2)
+                    self._epoch = epoch + 2
+                    self._write_start_epoch = None
+        finally:
+            self._write_depth -= 1
+
+    def _start_rewriting(self) -> None:
+        """Make the epoch odd, if this write hasn't already, before it changes files in place (see _writing)"""
+
+        if self._write_start_epoch is not None and not self._epoch_odd:
+            locks.write_epoch(self._database_path('epoch'), self._write_start_epoch + 1)
+            self._epoch_odd = True
+
+    def _read_epoch(self) -> int:
+        if self._storage is not None:
+            return self._storage.read_epoch()
+        return locks.read_epoch(self._database_path('epoch'))
+
+    def retry_on_conflict(self, edit: Callable[['Database'], Any], attempts: int = 3) -> Any:
+        """Make an edit in a transaction, and if another process saved the database first, load it again and redo the edit.
+
+            db.retry_on_conflict(lambda db: db.commit(db.new_branch(version_id, 'name')))
+
+        Returns what the edit returns. Raises the ConflictError if every attempt conflicts.
+        """
+
+        for attempt in range(attempts):
+            try:
+                with self.transaction():
+                    return edit(self)
+            except ConflictError:
+                if attempt == attempts - 1:
+                    raise
+                self.load()
+
+    def _write_files(self) -> None:
+        """Write the dirty versions, branches, views, and id info to their files, and remove the deleted ones"""
+
+        def save_attr_to_dir(database_dir_key):
             if not os.path.exists(self._database_path(database_dir_key)):
                 os.mkdir(self._database_path(database_dir_key))
-            
-            for file_info in os.scandir(self._database_path(database_dir_key)):
-                if not file_info.is_file():
-                    continue
-                filename = file_info.name
-                extension = os.path.splitext(filename)[1]
-                if extension != '.json':
+
+            for id in self._deleted[database_dir_key]:
+                file_path = self._database_path(database_dir_key, f'{id}.json')
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                if database_dir_key == 'versions':
+                    for pack in self._packs + self._archives:
+                        pack.remove(id)
+
+            # Only versions are compressed, since branches and views are small
+            compression_method = self.compression_method if database_dir_key == 'versions' else None
+            for id, thing_data in self._stored_data(database_dir_key).items():
+                self._count_written(_write_json(self._database_path(database_dir_key, f'{id}.json'), thing_data, indent=4,
+                                                compression_method=compression_method, compression_level=self.compression_level))
+        
+        if self._id_info_dirty:
+            self._count_written(_write_json(self._database_path('id info'), self._id_info.as_raw(), indent=4))
+        save_attr_to_dir('versions')
+        save_attr_to_dir('branches')
+        save_attr_to_dir('views')
+
+    def _write_storage(self) -> None:
+        """Write the dirty versions, branches, views, and id info to the storage backend in one transaction"""
+
+        changed = {database_dir_key: self._stored_data(database_dir_key) for database_dir_key in self._dirty}
+        id_info = self._id_info.as_raw() if self._id_info_dirty else None
+        self._storage.write(id_info, changed, self._deleted, self._next_epoch)
+        self._count('storage writes')
+
+    def _stored_data(self, database_dir_key: str, thing_ids: Optional[Iterable[ids.ID]] = None) -> Dict[ids.ID, dict]:
+        """The data to store for the dirty versions, branches, or views (or for thing_ids, if given).
+
+        With blob_threshold, large record deltas of committed versions are moved into blobs, and any blobs
+        not stored yet are written first, so that a stored version never refers to a missing blob.
+        Open versions keep their deltas inline, since they change with every update.
+        """
+
+        attr = self._attr_for_dir(database_dir_key)
+        # The raw data, since as_raw drops the None values that mark deleted records in deltas
+        if thing_ids is None:
+            thing_ids = self._dirty[database_dir_key]
+        stored = {id: attr._data[id] for id in thing_ids if id in attr}
+        if database_dir_key != 'versions' or self.blob_threshold is None:
+            return stored
+
+        new_blobs: Dict[str, str] = {}
+        for version_id, version_data in stored.items():
+            if version_data.get('next') is not None:
+                stored[version_id] = blobs.store_values(version_data, self.blob_threshold, new_blobs)
+        self._write_blobs({id: text for id, text in new_blobs.items() if id not in self._stored_blobs})
+        return stored
+
+    def _write_blobs(self, new_blobs: Dict[str, str]) -> None:
+        if new_blobs == {}:
+            return
+        if self._storage is not None:
+            self._storage.write(None, {'blobs': {id: json.loads(text) for id, text in new_blobs.items()}}, {})
+        else:
+            blobs_path = self._database_path('blobs')
+            if not os.path.exists(blobs_path):
+                os.mkdir(blobs_path)
+            for id, text in new_blobs.items():
+                # A blob's ID is the hash of its JSON, so one that already exists is already right
+                file_path = self._database_path('blobs', f'{id}.json')
+                if not os.path.exists(file_path):
+                    blob_bytes = compression.compress(text.encode(), self.compression_method, self.compression_level)
+                    locks.write_atomically(file_path, blob_bytes)
+                    self._count_written(len(blob_bytes))
+        self._stored_blobs |= set(new_blobs.keys())
+
+    def _read_blob(self, id: str) -> Any:
+        if self._storage is not None:
+            return self._storage.read('blobs', id)
+        if self._blob_cache is not None and id in self._blob_cache:
+            text = self._blob_cache[id]
+            self._count('blob cache hits')
+        else:
+            with open(self._database_path('blobs', f'{id}.json'), 'rb') as file:
+                text = compression.decompress(file.read()).decode()
+            self._count('files read')
+            if self._blob_cache is not None:
+                self._blob_cache[id] = text
+        self._stored_blobs.add(id)
+        # Parsed afresh for each reference, so that versions never share (and so never edit) each other's values
+        return json.loads(text)
+
+    def collect_blobs(self) -> int:
+        """Remove the blobs that no stored version refers to any more, and return how many were removed.
+
+        Counts the references to each blob in every stored version, including the journal, packs, and archive,
+        so blobs left behind by deleted versions (or by a save that was interrupted) are freed.
+        """
+
+        if self.path is None:
+            return 0
+        self.save()
+
+        with self._writing():
+            reference_counts: Dict[str, int] = {}
+            def count_references(version_data: dict) -> None:
+                for id in blobs.references(version_data):
+                    reference_counts[id] = reference_counts.get(id, 0) + 1
+
+            if self._storage is not None:
+                for _, version_data in self._storage.read_all('versions'):
+                    count_references(version_data)
+                blob_ids = self._storage.list_ids('blobs')
+            else:
+                versions_path = self._database_path('versions')
+                if os.path.exists(versions_path):
+                    for file_info in os.scandir(versions_path):
+                        if file_info.is_file() and file_info.name.endswith('.json'):
+                            with open(file_info.path, 'rb') as file:
+                                count_references(compression.loads(file.read()))
+                for pack in self._packs:
+                    for id in pack.ids():
+                        count_references(pack.read(id))
+                for archive in self._archives:
+                    for id in archive.ids():
+                        if id in self._archive_links:
+                            for blob_id in self._archive_links[id]['blobs']:
+                                reference_counts[blob_id] = reference_counts.get(blob_id, 0) + 1
+                        else:
+                            count_references(archive.read(id))
+                journal_path = self._database_path('journal')
+                if os.path.exists(journal_path):
+                    with open(journal_path) as file:
+                        for line in file:
+                            try:
+                                entry = json.loads(line)
+                            except json.JSONDecodeError:
+                                continue
+                            for version_data in entry.get('versions', {}).values():
+                                count_references(version_data)
+                blobs_path = self._database_path('blobs')
+                blob_ids = [os.path.splitext(file_info.name)[0] for file_info in os.scandir(blobs_path)
+                            if file_info.is_file() and file_info.name.endswith('.json')] if os.path.exists(blobs_path) else []
+
+            unreferenced = {id for id in blob_ids if reference_counts.get(id, 0) == 0}
+            if self._storage is not None:
+                self._storage.write(None, {}, {'blobs': unreferenced}, self._next_epoch)
+            else:
+                for id in unreferenced:
+                    os.remove(self._database_path('blobs', f'{id}.json'))
+            self._stored_blobs -= unreferenced
+        return len(unreferenced)
+
+    def _write_snapshots(self) -> None:
+        """Write the snapshots and reverse deltas that have changed, and remove the deleted ones.
+
+        These are always written after the versions they describe, so a snapshot never refers to a version that was never saved.
+        A stored snapshot that is older than its branch's last commit is still correct, since a committed version's state never changes.
+        """
+
+        if self.path is not None and self._snapshots_dirty != {'snapshots': set(), 'reverse deltas': set()}:
+            changed: Dict[str, Dict[ids.ID, dict]] = {'snapshots': {}, 'reverse deltas': {}}
+            deleted: Dict[str, Set[ids.ID]] = {'snapshots': set(), 'reverse deltas': set()}
+            for branch_id in self._snapshots_dirty['snapshots']:
+                snapshot = self._tip_snapshots.get(branch_id)
+                if snapshot is None:
+                    deleted['snapshots'].add(branch_id)
+                else:
+                    changed['snapshots'][branch_id] = {'version': snapshot[0], 'state': snapshot[1].as_raw()}
+            for version_id in self._snapshots_dirty['reverse deltas']:
+                reverse_delta = self._reverse_deltas.get(version_id)
+                if reverse_delta is None:
+                    deleted['reverse deltas'].add(version_id)
+                else:
+                    changed['reverse deltas'][version_id] = reverse_delta
+
+            if self._storage is not None:
+                self._storage.write(None, changed, deleted, self._next_epoch)
+            else:
+                for kind in changed:
+                    if not os.path.exists(self._database_path(kind)):
+                        os.mkdir(self._database_path(kind))
+                    for id in deleted[kind]:
+                        file_path = self._database_path(kind, f'{id}.json')
+                        if os.path.exists(file_path):
+                            os.remove(file_path)
+                    for id, data in changed[kind].items():
+                        self._count_written(_write_json(self._database_path(kind, f'{id}.json'), data,
+                                                        compression_method=self.compression_method, compression_level=self.compression_level))
+
+        self._snapshots_dirty = {'snapshots': set(), 'reverse deltas': set()}
+
+    def _read_snapshot_data(self, kind: str, id: ids.ID) -> Optional[dict]:
+        """Read a stored snapshot or reverse delta, or return None if there isn't one"""
+
+        if self.path is None:
+            return None
+        if self._storage is not None:
+            try:
+                return self._storage.read(kind, id)
+            except KeyError:
+                return None
+        file_path = self._database_path(kind, f'{id}.json')
+        if not os.path.exists(file_path):
+            return None
+        self._count('files read')
+        with open(file_path, 'rb') as file:
+            return compression.loads(file.read())
+
+    def _clear_snapshots(self) -> None:
+        self._tip_snapshots = {}
+        self._reverse_deltas = {}
+        self._snapshot_lags = {}
+        self._snapshots_dirty = {'snapshots': set(), 'reverse deltas': set()}
+
+    def _append_journal(self) -> None:
+        """Append the dirty versions, branches, views, and id info to the journal as a single line.
+
+        Each line holds the full data of every object changed by one save, so replaying the lines in order
+        (on top of the files) reproduces the database.
+        """
+
+        entry = {}
+        if self._id_info_dirty:
+            entry['id info'] = self._id_info.as_raw()
+        for database_dir_key in self._dirty:
+            changed = dict(sorted(self._stored_data(database_dir_key).items()))
+            if changed != {}:
+                entry[database_dir_key] = changed
+            if self._deleted[database_dir_key] != set():
+                entry.setdefault('deleted', {})[database_dir_key] = sorted(self._deleted[database_dir_key])
+
+        if entry == {}:
+            return
+
+        journal_path = self._database_path('journal')
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r+b') as file:
+                # If the last append was interrupted, cut it off so that this one starts on a fresh line
+                if file.seek(0, os.SEEK_END) > 0:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b'\n':
+                        file.seek(0)
+                        file.truncate(file.read().rfind(b'\n') + 1)
+
+        line = json.dumps(entry) + '\n'
+        with open(journal_path, 'a') as file:
+            file.write(line)
+            if self.fsync:
+                file.flush()
+                os.fsync(file.fileno())
+
+        self._count_written(len(line.encode()))
+        self._note_journaled(entry)
+
+        if self.compact_every is not None and self._journal_entries >= self.compact_every:
+            self.compact()
+
+    def _note_journaled(self, entry: dict) -> None:
+        """Keep track of what a journal entry changed, so that compact knows which files to rewrite"""
+
+        for database_dir_key in self._journaled:
+            for id in entry.get(database_dir_key, {}):
+                self._journaled[database_dir_key].add(id)
+                self._journal_deleted[database_dir_key].discard(id)
+            for id in entry.get('deleted', {}).get(database_dir_key, []):
+                self._journaled[database_dir_key].discard(id)
+                self._journal_deleted[database_dir_key].add(id)
+        self._journal_entries += 1
+
+    def _replay_journal(self) -> None:
+        """Apply the journal's entries, in order, on top of the data loaded from the files"""
+
+        self._journaled = {database_dir_key: set() for database_dir_key in self._journaled}
+        self._journal_deleted = {database_dir_key: set() for database_dir_key in self._journal_deleted}
+        self._journal_entries = 0
+
+        journal_path = self._database_path('journal')
+        if not os.path.exists(journal_path):
+            return
+
+        with open(journal_path, 'rb') as file:
+            lines = file.read().split(b'\n')
+
+        for line in lines:
+            if line.strip() == b'':
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last append is unfinished (or was interrupted), so that save hasn't happened.
+                # The next append cuts it off (see _append_journal)
+                break
+
+            if 'id info' in entry:
+                self._id_info.set_data(entry['id info'])
+            for database_dir_key in self._journaled:
+                attr = self._attr_for_dir(database_dir_key)
+                for id, thing_data in entry.get(database_dir_key, {}).items():
+                    if database_dir_key == 'versions':
+                        blobs.load_values(thing_data, self._read_blob)
+                    attr[id] = thing_data
+                    if database_dir_key == 'versions':
+                        self._unloaded_versions.pop(id, None)
+                for id in entry.get('deleted', {}).get(database_dir_key, []):
+                    if id in attr:
+                        del attr[id]
+                    if database_dir_key == 'versions':
+                        self._unloaded_versions.pop(id, None)
+            self._note_journaled(entry)
+
+    @measured
+    def compact(self) -> None:
+        """Fold the journal back into the version, branch, and view files, then empty the journal"""
+
+        if self.path is None or self._journal_entries == 0 or self._transaction_originals is not None:
+            return
+
+        with self._writing():
+            # Anything that is dirty but not yet journaled can be written at the same time
+            for database_dir_key in self._dirty:
+                self._dirty[database_dir_key] |= self._journaled[database_dir_key]
+                self._dirty[database_dir_key] -= self._journal_deleted[database_dir_key]
+                self._deleted[database_dir_key] |= self._journal_deleted[database_dir_key]
+            self._id_info_dirty = True
+            self._write_files()
+            self._clear_dirty()
+
+            with open(self._database_path('journal'), 'w') as file:
+                if self.fsync:
+                    os.fsync(file.fileno())
+
+        self._journaled = {database_dir_key: set() for database_dir_key in self._journaled}
+        self._journal_deleted = {database_dir_key: set() for database_dir_key in self._journal_deleted}
+        self._journal_entries = 0
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group several edits so they are checked and saved once, all together, when the with block finishes.
+
+            with db.transaction():
+                branch_id = db.new_branch(version_id, 'name')
+                db.update(branch_id, deltas)
+                db.commit(branch_id)
+
+        If the block raises an exception (or the edits are not well formed), every edit made inside it is undone
+        and nothing is saved. Transactions inside a transaction are part of the outer one.
+        """
+
+        if self._transaction_originals is not None:
+            yield self
+            return
+
+        # Tip snapshots hold states, which are copied with them; reverse deltas are only ever replaced, never edited in place
+        saved_state = (deepcopy(self._id_info._data), self._id_info_dirty,
+                       deepcopy(self._dirty), deepcopy(self._deleted), deepcopy(self._unpublished),
+                       deepcopy(self._committed_revisions), deepcopy(self._current_revisions),
+                       self._unloaded_versions.copy(), self._stored_blobs.copy(),
+                       deepcopy(self._tip_snapshots), self._reverse_deltas.copy(), self._snapshot_lags.copy(), deepcopy(self._snapshots_dirty))
+        self._transaction_originals = {'versions': {}, 'branches': {}, 'views': {}}
+
+        try:
+            yield self
+            self._check_dirty()
+        except BaseException:
+            self._roll_back(saved_state)
+            raise
+        finally:
+            self._transaction_originals = None
+
+        self._save_transaction()
+
+    def _roll_back(self, saved_state: tuple) -> None:
+        """Undo everything done since a transaction started"""
+
+        for database_dir_key, originals in self._transaction_originals.items():
+            attr = self._attr_for_dir(database_dir_key)
+            for id, original_data in originals.items():
+                if original_data is None:
+                    attr._data.pop(id, None)
+                else:
+                    attr._data[id] = original_data
+
+        id_info_data, self._id_info_dirty, self._dirty, self._deleted, self._unpublished, \
+            self._committed_revisions, self._current_revisions, self._unloaded_versions, self._stored_blobs, \
+            self._tip_snapshots, self._reverse_deltas, self._snapshot_lags, self._snapshots_dirty = saved_state
+        self._id_info._data = id_info_data
+
+        # Cheaper to rebuild the record index, merge rule tables, and delta blocks the next time they're needed than to copy them for every transaction
+        self._record_index = None
+        self._time_index = None
+        self._log_walks = {}
+        self._merge_rule_tables = {}
+        self._delta_blocks = {}
+
+    def _check_dirty(self) -> None:
+        """Check every changed version, branch, and view against its template, and check that the IDs it refers to exist"""
+
+        templates = {'versions': self._version_template, 'branches': self._branch_template, 'views': self._view_template}
+        for database_dir_key, template in templates.items():
+            attr = self._attr_for_dir(database_dir_key)
+            for id in self._dirty[database_dir_key]:
+                if id not in attr:
                     continue
-                file_path = self._database_path(database_dir_key, filename)
-                with open(file_path) as file:
-                    thing_data = json.load(file)
                 try:
-                    JSONDict('', thing_template, thing_data)
-                except:
+                    JSONDict('', template, attr._data[id])
+                except Exception as e:
+                    raise YBDBException(f'{id} does not match the template: {e}')
+
+        for version_id in self._dirty['versions']:
+            if version_id not in self._versions:
+                continue
+            version = self._versions[version_id]
+            referenced_versions = [version.previous, version.next]
+            if version.merge is not None:
+                referenced_versions.append(version.merge.tributary)
+            for referenced_id in referenced_versions:
+                if referenced_id is not None and not self._has_version(referenced_id):
+                    raise YBDBException(f'{version_id} refers to a version {referenced_id} that does not exist')
+            if version.branch is not None and version.branch not in self._branches:
+                raise YBDBException(f'{version_id} refers to a branch {version.branch} that does not exist')
+
+        for branch_id in self._dirty['branches']:
+            if branch_id not in self._branches:
+                continue
+            branch = self._branches[branch_id]
+            for referenced_id in [branch.start, branch.end]:
+                if referenced_id is not None and not self._has_version(referenced_id):
+                    raise YBDBException(f'{branch_id} refers to a version {referenced_id} that does not exist')
+
+    def _save_transaction(self) -> None:
+        """Save everything a transaction changed as a single unit"""
+
+        if self.path is None or self._storage is not None or self.journal:
+            # In memory there is nothing to do, SQLite writes a save in one transaction, and the journal appends it in one line
+            self.save()
+            return
+
+        # Without a journal, each file is written separately; appending the transaction to the journal first
+        # means that if writing the files is interrupted, the next load replays the whole transaction
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        with self._writing():
+            self._append_journal()
+            self.compact()
+            self._clear_dirty()
+            self._write_snapshots()
+        self._publish()
+
+    def snapshot(self) -> 'Database':
+        """The database as of the end of the last edit, for reading from other threads while this thread goes on editing.
+
+        A snapshot is a read-only Database: compute_state, record_history, and views work on it as usual, and editing it
+        raises an error. It never changes, so a thread holding one sees a single consistent version graph, however long it reads;
+        call snapshot again to see later edits. Only the thread that edits the database should call anything else on it.
+        """
+
+        if self._published is None:
+            raise YBDBException('Snapshots need a database with snapshot_reads that has been loaded or set up')
+        return self._published
+
+    def _publish(self, full: bool = False) -> None:
+        """Publish a new snapshot (see snapshot) once an edit is finished and saved.
+
+        The snapshot has its own copy of every version, branch, and view changed since the last one, and shares the rest
+        with it, so publishing only copies what the edit touched (plus the dicts of IDs).
+        It is swapped in as a single assignment, so a reader gets either the old snapshot or the new one, never a mix.
+        """
+
+        if not self.snapshot_reads or self._transaction_originals is not None:
+            return
+
+        published = copy.copy(self)
+        for database_dir_key, attr_name, template in [('versions', '_versions', self._version_template),
+                                                      ('branches', '_branches', self._branch_template),
+                                                      ('views', '_views', self._view_template)]:
+            live_data = self._attr_for_dir(database_dir_key)._data
+            if full or self._published is None:
+                data = deepcopy(live_data)
+            else:
+                data = self._published._attr_for_dir(database_dir_key)._data.copy()
+                for id in self._unpublished[database_dir_key]:
+                    if id in live_data:
+                        data[id] = deepcopy(live_data[id])
+                    else:
+                        data.pop(id, None)
+            # Static, so that any attempt to edit the snapshot raises an error instead of changing what other readers see
+            setattr(published, attr_name, JSONDict('versions', {'': template}, data, static=True))
+        published._id_info = JSONDict('id info', self._id_info_template, deepcopy(self._id_info._data), static=True)
+
+        # Readers don't touch storage, since a SQLite connection can't be shared between threads;
+        # tip snapshots not already read are computed instead
+        published.path = None
+        published._storage = None
+        published.journal = False
+        published.snapshot_reads = False
+        published._published = None
+        published.merge_workers = None
+        published._merge_executor = None
+        published._packs = []
+        published._archives = []
+        published._pack_handles = {}
+        # Only archived versions are left unread (snapshot_reads rules out lazy), and those are read from packs, which any thread can do.
+        # The snapshot reads them through its own handles, which keep the files open even once a reload closes this object's packs
+        self._pack_handles = {source: self._pack_handles.get(source) or source.handle()
+                              for source in set(self._unloaded_versions.values()) if isinstance(source, packs.Pack)}
+        published._unloaded_versions = {version_id: self._pack_handles.get(source, source) for version_id, source in self._unloaded_versions.items()}
+        published._dirty = {database_dir_key: set() for database_dir_key in self._dirty}
+        published._deleted = {database_dir_key: set() for database_dir_key in self._deleted}
+        published._unpublished = {database_dir_key: set() for database_dir_key in self._unpublished}
+        published._snapshots_dirty = {'snapshots': set(), 'reverse deltas': set()}
+
+        # Caches that edits change in place get fresh copies, and the snapshot fills in the rest itself
+        published._committed_revisions = deepcopy(self._committed_revisions)
+        published._current_revisions = deepcopy(self._current_revisions)
+        published._record_index = None
+        published._version_records = {}
+        published._time_index = None
+        published._log_walks = {}
+        published._merge_rule_tables = {}
+        published._delta_blocks = {version_id: blocks.copy() for version_id, blocks in self._delta_blocks.items()}
+        published._tip_snapshots = self._tip_snapshots.copy()
+        published._reverse_deltas = self._reverse_deltas.copy()
+        published._snapshot_lags = {}
+
+        self._published = published
+        self._unpublished = {database_dir_key: set() for database_dir_key in self._unpublished}
+
+    @measured
+    def pack(self) -> None:
+        """Move all the loose version files into a new pack.
+
+        Loading a pack is a single open and mmap, rather than one open and read for every version file.
+        """
+
+        if self.path is None or self._storage is not None:
+            return
+
+        with self._writing():
+            self._pack()
+
+    def _pack(self) -> None:
+        self.save()
+        self.compact()
+
+        versions_path = self._database_path('versions')
+        if not os.path.exists(versions_path):
+            return
+
+        records: Dict[VersionID, bytes] = {}
+        loose_paths: List[str] = []
+        for file_info in os.scandir(versions_path):
+            root, extension = os.path.splitext(file_info.name)
+            if not file_info.is_file() or extension != '.json':
+                continue
+            with open(file_info.path, 'rb') as file:
+                version_data = compression.loads(file.read())
+            try:
+                JSONDict('', self._version_template, version_data)
+            except:
+                continue
+            if version_data['id'] != root:
+                raise Exception(f'Encountered a version whose filename {root} is different from its id {version_data["id"]}')
+            records[root] = compression.compress(json.dumps(version_data, separators=(',', ':')).encode(),
+                                                 self.compression_method, self.compression_level)
+            loose_paths.append(file_info.path)
+
+        if records == {}:
+            return
+
+        packs_path = self._database_path('packs')
+        if not os.path.exists(packs_path):
+            os.mkdir(packs_path)
+        new_pack = packs.write_pack(packs.next_pack_path(packs_path), records)
+        self._count_written(os.path.getsize(new_pack.path + packs.pack_extension))
+        self._packs.insert(0, new_pack)
+
+        # Versions that haven't been read yet need to be read from the pack now that their files are gone
+        for version_id in records:
+            if version_id in self._unloaded_versions:
+                self._unloaded_versions[version_id] = new_pack
+
+        # Only remove the loose files once the pack and its index are safely written
+        for loose_path in loose_paths:
+            os.remove(loose_path)
+
+    def gc(self, archive_unreachable: bool = False, archive_depth: Optional[int] = None) -> Tuple[List[VersionID], List[VersionID]]:
+        """Remove the versions that no branch, view, or revision's current selection can reach any more.
+
+        Versions that only what revisions selected before can reach, like superseded revision targets, are archived instead,
+        since the commits that recorded those selections still need them (in SQLite and in-memory databases, they are kept).
+
+        archive_unreachable: move the unreachable versions into the archive instead of removing them
+        archive_depth: also move into the archive every version that is more than this many versions back from
+            the nearest branch tip (and so is only needed by walks through deep history)
+
+        The archive is a set of packs, compressed with lzma, that are never read on load: an archived version is read
+        the first time something uses it, the same way versions are in lazy mode. Archiving needs the directory format.
+        Returns the IDs of the removed versions and of the newly archived ones.
+        """
+
+        if self._transaction_originals is not None:
+            raise YBDBException('Cannot collect garbage inside a transaction')
+        archiving = archive_unreachable or archive_depth is not None
+        if archiving and (self.path is None or self._storage is not None):
+            raise YBDBException('Archiving versions needs a database directory')
+
+        # Versions that are already archived (even those read since) go back to the archive they came from, rather than into a new one
+        archive_sources = {version_id: archive for archive in reversed(self._archives) for version_id in archive.ids()}
+        # Archived versions stay unread, since what gc needs of them is in their archives' links files
+        for version_id in [version_id for version_id in self._unloaded_versions if version_id not in archive_sources]:
+            self._load_version(version_id)
+        depths = self._version_depths()
+        reachable = self._reachable_versions(depths.keys())
+        # What revisions selected before, like a superseded revision target, is still needed for the states of the commits that
+        # recorded those selections, so it's archived rather than removed (or kept, where the database can't archive)
+        selected = self._reachable_versions(reachable, selected=True) - reachable
+        unreachable = [version_id for version_id in [*self._versions._data, *self._unloaded_versions]
+                       if version_id not in reachable and version_id not in selected]
+
+        archived: List[VersionID] = []
+        if archive_unreachable:
+            archived += unreachable
+            removed = []
+        else:
+            removed = unreachable
+        if self.path is not None and self._storage is None:
+            archived += sorted(selected)
+        if archive_depth is not None:
+            # Versions reachable only some other way, like the versions after a view's on its branch, are kept
+            archived += [version_id for version_id in reachable if depths.get(version_id, 0) > archive_depth]
+
+        removed_set = set(removed)
+        for version_id in removed:
+            self._delete('versions', version_id)
+        # Only links forward in history can point at a removed version, from versions it merged into or revised
+        for version_id in list(self._versions._data) + list(self._unloaded_versions):
+            links = self._version_links(version_id)
+            for link in ['merged to', 'revisions using']:
+                if any(id in removed_set for id in links[link]):
+                    version = self._get_version(version_id)
+                    kept_ids = [id for id in version[link] if id not in removed_set]
+                    if kept_ids == []:
+                        del version[link]
+                    else:
+                        version[link] = kept_ids
+        changed = set(self._dirty['versions'])
+        self.save()
+        # Archived versions shouldn't come back from the journal when the database is next loaded
+        self.compact()
+
+        newly_archived = [version_id for version_id in archived if version_id not in archive_sources or version_id in changed]
+        for version_id in archived:
+            if version_id not in newly_archived and version_id in self._versions._data:
+                del self._versions._data[version_id]
+                self._unloaded_versions[version_id] = archive_sources[version_id]
+        if newly_archived != []:
+            with self._writing():
+                self._archive(newly_archived)
+        if self.path is not None:
+            self.collect_blobs()
+        return removed, newly_archived
+
+    def _version_depths(self) -> Dict[VersionID, int]:
+        """For every version any branch tip or view descends from, how many versions back from the nearest of them it is"""
+
+        depths: Dict[VersionID, int] = {}
+        # A view is a tip too, of sorts, since it shows its version's state
+        edge = [branch_data['end'] for branch_data in self._branches._data.values()]
+        edge += [view_data['version'] for view_data in self._views._data.values() if view_data.get('version') is not None]
+        depth = 0
+        while edge != []:
+            new_edge = []
+            for version_id in edge:
+                if version_id in depths:
                     continue
+                depths[version_id] = depth
+                new_edge += self._version_parents(version_id)
+            edge = new_edge
+            depth += 1
+        return depths
+
+    def _version_links(self, version_id: VersionID) -> dict:
+        """What gc follows from a version (see _links_from_data), from its archive's links file if it is archived and unread"""
+
+        if version_id in self._archive_links and self._unloaded_versions.get(version_id) in self._archives:
+            return self._archive_links[version_id]
+        return _links_from_data(self._get_version(version_id)._data)
+
+    def _version_parents(self, version_id: VersionID, selected: bool = False) -> List[VersionID]:
+        """Every version a version's state depends on directly, and with selected, what its revisions selected before as well"""
+
+        links = self._version_links(version_id)
+        parents = []
+        # Links files written before selections were kept apart have them all among the parents
+        for parent_id in links['parents'] + (links.get('selected', []) if selected else []):
+            if ids.id_type(parent_id) == ids.IDType.branch:
+                parent_id = self._get_branch(parent_id).end
+            parents.append(parent_id)
+        return parents
+
+    def _reachable_versions(self, tip_ancestors: Iterable[VersionID], selected: bool = False) -> Set[VersionID]:
+        """The versions reachable from any branch, view, or revision's current selection.
+
+        Besides the ancestors of the branch tips, that's every branch's start and the versions views show,
+        along with their ancestors, and every version after a reachable one on the same branch
+        (so a version never links forward to one that was removed).
+        selected: also follow what revisions selected before (see _links_from_data)
+        """
+
+        edge = list(tip_ancestors) + [branch_data['start'] for branch_data in self._branches._data.values()]
+        edge += [view_data['version'] for view_data in self._views._data.values() if view_data.get('version') is not None]
+        reachable: Set[VersionID] = set()
+        while edge != []:
+            new_edge = []
+            for version_id in edge:
+                if version_id in reachable or not self._has_version(version_id):
+                    continue
+                reachable.add(version_id)
+                new_edge += self._version_parents(version_id, selected)
+                next_id = self._version_links(version_id)['next']
+                if next_id is not None:
+                    new_edge.append(next_id)
+            edge = new_edge
+        return reachable
+
+    def _archive(self, version_ids: List[VersionID]) -> None:
+        """Move versions out of memory, their files, and the packs, into a new archive pack"""
+
+        records: Dict[VersionID, bytes] = {}
+        links: Dict[VersionID, dict] = {}
+        for version_id, version_data in self._stored_data('versions', version_ids).items():
+            records[version_id] = compression.compress(json.dumps(version_data, separators=(',', ':')).encode(), 'lzma')
+            links[version_id] = _links_from_data(version_data)
+
+        archive_path = self._database_path('archive')
+        if not os.path.exists(archive_path):
+            os.mkdir(archive_path)
+        new_archive = packs.write_pack(packs.next_pack_path(archive_path), records)
+        self._count_written(os.path.getsize(new_archive.path + packs.pack_extension))
+        self._count_written(_write_json(new_archive.path + archive_links_extension, links))
+        self._archives.insert(0, new_archive)
+        self._archive_links.update(links)
+
+        # Only remove the other copies once the archive is safely written
+        for version_id in version_ids:
+            file_path = self._database_path('versions', f'{version_id}.json')
+            if os.path.exists(file_path):
                 os.remove(file_path)
-            
-            for id, value in attr.items():
-                with open(self._database_path(database_dir_key, f'{id}.json'), 'w') as file:
-                    json.dump(value._template_order(), file, indent=4)
-        
-        with open(self._database_path('id info'), 'w') as file:
-            json.dump(self._id_info.as_dict(), file, indent=4)
-        save_attr_to_dir('versions', self._version_template, self._versions)
-        save_attr_to_dir('branches', self._branch_template, self._branches)
-        save_attr_to_dir('views', self._view_template, self._views)
-    
+        for pack in self._packs + self._archives[1:]:
+            pack.remove_all(version_ids)
+        for version_id in version_ids:
+            self._versions._data.pop(version_id, None)
+            self._unloaded_versions[version_id] = new_archive
+
     @staticmethod
     def _timestamp():
         return datetime.datetime.now(datetime.timezone.utc).timestamp()
@@ -151,12 +1634,14 @@ class Database:
         self._id_info.next_branch_id = ids.compose_id(ids.IDType.branch, user_str, ids.start_sequence)
         self._id_info.next_view_id = ids.compose_id(ids.IDType.view, user_str, ids.start_sequence)
 
+        self._remember_original('branches', ids.trunk_branch_id)
         self._branches[ids.trunk_branch_id] = {}
-        main_branch = self._branches[ids.trunk_branch_id]
+        main_branch = self._get_branch(ids.trunk_branch_id)
         main_branch.id = ids.trunk_branch_id
         main_branch.name = 'trunk'
         main_branch.start = ids.root_version_id
 
+        self._remember_original('versions', ids.root_version_id)
         self._versions[ids.root_version_id] = {}
         root_version = self._get_version(ids.root_version_id)
         root_version.id = ids.root_version_id
@@ -171,6 +1656,8 @@ class Database:
         end_version.branch = ids.trunk_branch_id
         main_branch.end = end_version_id
 
+        self._build_record_index()
+
         self.save()
     
     def sync_from_view(self, view: view.EditableView) -> None:
@@ -222,15 +1709,24 @@ class Database:
         """Get the branch with a given ID, or error if there is no such branch"""
 
         if branch_id in self._branches:
-            return self._branches[branch_id]
+            branch = self._branches[branch_id]
+            branch._callback = lambda: self._mark_dirty('branches', branch_id)
+            branch._before_change = lambda: self._remember_original('branches', branch_id)
+            return branch
         else:
             raise YBDBException(f'There is no branch with id {branch_id}')
     
     def _get_version(self, version_id: VersionID) -> Version:
         """Get the version with a given ID, or error if there is no such branch"""
 
+        if version_id not in self._versions and version_id in self._unloaded_versions:
+            self._load_version(version_id)
+
         if version_id in self._versions:
-            return self._versions[version_id]
+            version = self._versions[version_id]
+            version._callback = lambda: self._mark_dirty('versions', version_id)
+            version._before_change = lambda: self._remember_original('versions', version_id)
+            return version
         else:
             raise YBDBException(f'There is no version with id {version_id}')
     
@@ -257,9 +1753,11 @@ class Database:
         "Create a new empty version, and return the version's ID and the version itself"
 
         id = self._next_version_id()
+        self._remember_original('versions', id)
         self._versions[id] = {}
-        self._versions[id].id = id
-        return id, self._versions[id]
+        version = self._get_version(id)
+        version.id = id
+        return id, version
 
     @staticmethod
     def _is_open(version: Version) -> bool:
@@ -269,6 +1767,7 @@ class Database:
         # TODO
         pass
 
+    @measured
     def _trace_back(self, version_id: VersionID, include_revisions=False, revision_state: Optional[Dict[VersionID, VersionID]] = None) -> Tuple[List[VersionID], Dict[VersionID, VersionID], Dict[VersionID, List[VersionID]]]:
         """Traverses backward through the versions to find every version that contributes to the input version.
 
@@ -293,53 +1792,77 @@ class Database:
             revisions: Dict[VersionID, VersionID] = revision_state.copy()
         graph: Dict[VersionID, List[VersionID]] = {}
 
+        for ancestor_id, parent_ids, is_revision in self._walk_back(version_id, revisions, revision_state):
+            if include_revisions or not is_revision:
+                ancestors.append(ancestor_id)
+                graph[ancestor_id] = parent_ids
+
+        assert(ids.root_version_id in ancestors)
+
+        if not include_revisions:
+            for version_id, parents in graph.items():
+                new_parents = []
+                for parent_id in parents:
+                    # A revision can select another revision, so follow the selections to a version in the graph
+                    while parent_id in revisions:
+                        parent_id = revisions[parent_id]
+                    new_parents.append(parent_id)
+                graph[version_id] = new_parents
+
+        return ancestors, revisions, graph
+
+    def _walk_back(self, version_id: VersionID, revisions: Dict[VersionID, VersionID],
+                   revision_state: Optional[Dict[VersionID, VersionID]] = None,
+                   current_selections: Optional[bool] = None) -> Iterator[Tuple[VersionID, List[VersionID], bool]]:
+        """Walks backward from a version, yielding each version it reaches as soon as it reaches it, in the order of _trace_back.
+
+        Yields (version ID, its parents, whether it is a revision) for each version, once. A revision's one parent is its selection.
+        revisions: the selection of each revision reached so far, filled in as the walk goes
+        revision_state: see _trace_back
+        current_selections: whether to follow what revisions select now rather than what they selected when the version was committed;
+            by default, only for an open version
+        Since it is a generator, a caller that only wants the first few ancestors (like log) only reads that far back.
+        """
+
+        # Breadth-first, a level at a time, with a merge's primary input before its tributary
         edge: List[VersionID] = [version_id]
+        visited: Set[VersionID] = set()
 
-        open_version = self._is_open(self._get_version(version_id))
+        open_version = self._is_open(self._get_version(version_id)) if current_selections is None else current_selections
 
         while edge != []:
             new_edge = []
 
             for edge_version_id in edge:
+                if edge_version_id in visited:
+                    continue
+                visited.add(edge_version_id)
                 edge_version = self._get_version(edge_version_id)
                 edge_version_type = self._version_type(edge_version)
-                
+
                 if edge_version_type == VersionType.revision:
-                    if include_revisions and edge_version_id not in ancestors:
-                        ancestors.append(edge_version_id)
-
-                    selection = edge_version
-                    while self._version_type(selection) == VersionType.revision:
-                        if revision_state is not None:
-                            selection_id = revision_state[edge_version]
-                        elif open_version:
-                            selection_id = self._to_version_id(edge_version.revision.current, allow_open=False)
-                        elif edge_version_id in revisions:
-                            selection_id = revisions[edge_version_id]
-                        else:
-                            selection_id = edge_version.revision.original
-                        selection = self._get_version(selection_id)
-                        
+                    # A selection that is itself a revision is followed when the walk reaches it, on the next level
+                    if revision_state is not None:
+                        selection_id = revision_state[edge_version_id]
+                    elif open_version:
+                        selection_id = self._to_version_id(edge_version.revision.current, allow_open=False)
+                    elif edge_version_id in revisions:
+                        selection_id = revisions[edge_version_id]
+                    else:
+                        selection_id = edge_version.revision.original
+
                     if edge_version_id not in revisions:
                         revisions[edge_version_id] = selection_id
 
                     new_edge.append(selection_id)
-                    if include_revisions:
-                        graph[edge_version_id] = [selection_id]
+                    yield edge_version_id, [selection_id], True
                 else:
-                    if edge_version_id not in ancestors:
-                        ancestors.append(edge_version_id)
-
-                    if edge_version_type != VersionType.root:
+                    if edge_version_type == VersionType.root:
                         parents = []
-
-                        previous_id = edge_version.previous
-                        parents.append(previous_id)
-
+                    else:
+                        parents = [edge_version.previous]
                         if edge_version_type == VersionType.merge:
                             parents.append(edge_version.merge.tributary)
-                        
-                        graph[edge_version_id] = parents
                         new_edge += parents
 
                         if revision_state is None and not open_version and edge_version_type in [VersionType.change, VersionType.merge]:
@@ -347,30 +1870,64 @@ class Database:
                                 edge_version_revision_changes = edge_version.change.revision_changes
                             else:
                                 edge_version_revision_changes = edge_version.merge.revision_changes
-                        
+
                             if edge_version_revision_changes is not None:
                                 for revision_id, selection in edge_version_revision_changes.items():
                                     if revision_id not in revisions:
                                         revisions[revision_id] = selection
 
-            edge = new_edge
-
-        assert(ids.root_version_id in ancestors)
+                    yield edge_version_id, parents, False
 
-        if not include_revisions:
-            for version_id, parents in graph.items():
-                new_parents = []
-                for parent_id in parents:
-                    if parent_id in revisions:
-                        new_parents.append(revisions[parent_id])
-                    else:
-                        new_parents.append(parent_id)
-                graph[version_id] = new_parents
-
-        return ancestors, revisions, graph
+            edge = new_edge
 
     def _ancestry(self, version_id: VersionID, include_revisions=False, revision_state: Optional[Dict[VersionID, VersionID]] = None) -> List[VersionID]:
-        return self._trace_back(version_id, include_revisions=include_revisions, revision_state=revision_state)[0]
+        revisions = {} if revision_state is None else revision_state.copy()
+        return [ancestor_id for ancestor_id, _, is_revision in self._walk_back(version_id, revisions, revision_state)
+                if include_revisions or not is_revision]
+
+    def log(self, id: ids.ID, limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[VersionID], Optional[str]]:
+        """A page of the history leading up to a version (or a branch's last commit), most recent first,
+        in the same order as _ancestry.
+
+        Only the versions on the page (and the ones before them) are read, so the first pages of a long history are cheap.
+        Returns the versions on the page, and a cursor to pass in to get the next page (or None if this is the last page).
+        cursor: from the previous page of the same id's log; the log carries on from where that page stopped,
+            and from the version the first page started at, even if the branch has had commits since
+        """
+
+        if limit <= 0:
+            raise YBDBException('The log needs a limit of at least 1')
+        if cursor is not None:
+            cursor_id, start_id, offset_text = cursor.split(':')
+            if cursor_id != id:
+                raise YBDBException(f'The cursor is for the log of {cursor_id}, not {id}')
+            offset = int(offset_text)
+        else:
+            if ids.id_type(id) == ids.IDType.branch:
+                # The open version at the end of a branch isn't part of its history yet
+                start_id = self._get_version(self._get_branch(id).end).previous
+            else:
+                start_id = id
+            offset = 0
+
+        walk = self._log_walks.pop(cursor, None) if cursor is not None else None
+        if walk is None:
+            # A cursor from another Database object (or one evicted) starts the walk again and skips what was already seen
+            walk = (ancestor_id for ancestor_id, _, is_revision in self._walk_back(start_id, {}) if not is_revision)
+            for _ in itertools.islice(walk, offset):
+                pass
+
+        # One more than the page, to know whether there is a next page, which is then put back for it
+        page = list(itertools.islice(walk, limit + 1))
+        if len(page) <= limit:
+            return page, None
+        walk = itertools.chain([page.pop()], walk)
+        next_cursor = f'{id}:{start_id}:{offset + len(page)}'
+        self._log_walks[next_cursor] = walk
+        # Only the most recent walks are kept going, since each holds on to everything it has walked through
+        while len(self._log_walks) > 16:
+            del self._log_walks[next(iter(self._log_walks))]
+        return page, next_cursor
 
     def _revision_state(self, version_id: VersionID) -> Dict[VersionID, VersionID]:
         return self._trace_back(version_id)[1]
@@ -378,17 +1935,210 @@ class Database:
     def _graph(self, version_id: VersionID, revision_state: Optional[Dict[VersionID, VersionID]] = None) -> Dict[VersionID, List[VersionID]]:
         return self._trace_back(version_id, revision_state=revision_state)[2]
 
+    @measured
     def _find_LCA(self, v1_id: VersionID, v2_id: VersionID) -> VersionID:
         """Finds the latest common ancestor of two versions."""
 
-        v1_ancestors = self._ancestry(v1_id)
-        v2_ancestors = self._ancestry(v2_id)
-        for ancestor_id in v1_ancestors:
-            if ancestor_id in v2_ancestors:
+        # The first of v1's ancestors that v2 also has, so v1's are only walked as far back as that
+        v2_ancestors = set(self._ancestry(v2_id))
+        for ancestor_id, _, is_revision in self._walk_back(v1_id, {}):
+            if not is_revision and ancestor_id in v2_ancestors:
                 return ancestor_id
         
         raise YBDBException(f'Unable to find LCA of {v1_id} and {v2_id}')
 
+    def _branch_revision_changes(self, branch_id: BranchID) -> Dict[VersionID, VersionID]:
+        """Returns the revision selections that have changed since the branch was last committed.
+
+        This is the difference between the revision states of the branch's open version and its last commit, as traced back in full,
+        but each state is kept until an edit could change it, so a commit with no revisions changed since the last one doesn't trace back at all.
+        """
+
+        branch = self._get_branch(branch_id)
+        if branch_id not in self._committed_revisions:
+            previous_id = self._get_version(branch.end).previous
+            self._committed_revisions[branch_id] = self._revision_state(previous_id) if previous_id is not None else {}
+        if branch_id not in self._current_revisions:
+            self._current_revisions[branch_id] = self._revision_state(branch.end)
+
+        committed = self._committed_revisions[branch_id]
+        return {revision_id: selection_id for revision_id, selection_id in self._current_revisions[branch_id].items()
+                if committed.get(revision_id) != selection_id}
+
+    def _forget_revision_states(self, revision_id: VersionID) -> None:
+        """Drops the current revision state of every branch that uses a revision whose selection has changed.
+
+        A branch that doesn't use the revision can't reach it, so what it selects doesn't change that branch's state.
+        """
+
+        for branch_id in [branch_id for branch_id, revisions in self._current_revisions.items() if revision_id in revisions]:
+            del self._current_revisions[branch_id]
+
+    def _build_record_index(self) -> None:
+        """Index every version by the records its deltas and merge rules touch"""
+
+        self._load_all_versions()
+        # Built on the side and put in place once complete, since several threads may be reading a snapshot at once
+        record_index: Dict[RecordID, Dict[VersionID, List[str]]] = {}
+        version_records: Dict[VersionID, Set[RecordID]] = {}
+        for version_id, version_data in self._versions._data.items():
+            touched = self._touched_records(version_data)
+            for record_id, fields in touched.items():
+                record_index.setdefault(record_id, {})[version_id] = sorted(fields)
+            if touched != {}:
+                version_records[version_id] = set(touched.keys())
+        self._version_records = version_records
+        self._record_index = record_index
+
+    def _unindex_version_records(self, version_id: VersionID) -> None:
+        if self._record_index is None:
+            return
+        for record_id in self._version_records.pop(version_id, set()):
+            record_versions = self._record_index[record_id]
+            del record_versions[version_id]
+            if record_versions == {}:
+                del self._record_index[record_id]
+
+    def _index_version_records(self, version_id: VersionID) -> None:
+        """(Re)index a version by the records it touches, replacing whatever it was indexed under before"""
+
+        if self._record_index is None:
+            return
+        self._unindex_version_records(version_id)
+
+        touched = self._touched_records(self._versions._data[version_id])
+        for record_id, fields in touched.items():
+            self._record_index.setdefault(record_id, {})[version_id] = sorted(fields)
+        if touched != {}:
+            self._version_records[version_id] = set(touched.keys())
+
+    @staticmethod
+    def _touched_records(version_data: dict) -> Dict[RecordID, Set[str]]:
+        """The records a version's deltas or merge rules touch, and which of their fields"""
+
+        # Work with the raw data, since this runs over every version on load
+        touched: Dict[RecordID, Set[str]] = {}
+
+        change = version_data.get('change')
+        if change is not None and change.get('deltas') is not None:
+            for record_id, record_delta in change['deltas'].items():
+                fields = touched.setdefault(record_id, set())
+                if isinstance(record_delta, dict):
+                    fields.update(record_delta.keys())
+
+        merge = version_data.get('merge')
+        if merge is not None and merge.get('records') is not None:
+            for record_id, record_rules in merge['records'].items():
+                fields = touched.setdefault(record_id, set())
+                if record_rules.get('fields') is not None:
+                    fields.update(record_rules['fields'].keys())
+        return touched
+
+    def _build_time_index(self) -> None:
+        """Index every committed version by its branch and timestamp"""
+
+        self._load_all_versions()
+        committed: Dict[BranchID, List[Tuple[float, VersionID]]] = {}
+        for version_id, version_data in self._versions._data.items():
+            # Only committed versions have timestamps, apart from revisions, which have none
+            if version_data.get('timestamp') is not None and version_data.get('next') is not None and version_data.get('branch') is not None:
+                committed.setdefault(version_data['branch'], []).append((version_data['timestamp'], version_id))
+        time_index = {}
+        for branch_id, branch_versions in committed.items():
+            branch_versions.sort()
+            time_index[branch_id] = ([timestamp for timestamp, _ in branch_versions], [version_id for _, version_id in branch_versions])
+        self._time_index = time_index
+
+    @staticmethod
+    def _as_timestamp(time: float | datetime.datetime) -> float:
+        # A datetime without a timezone is taken to be local time, as datetime.timestamp does
+        return time.timestamp() if isinstance(time, datetime.datetime) else time
+
+    def version_at(self, branch_id: BranchID, timestamp: float | datetime.datetime) -> VersionID:
+        """The last version committed on a branch at or before a time
+        (a datetime, or a timestamp in seconds since the epoch, like the versions' own timestamps).
+
+        If nothing had been committed on the branch yet, that's the version the branch started from.
+        """
+
+        timestamp = self._as_timestamp(timestamp)
+        if self._time_index is None:
+            self._build_time_index()
+        branch = self._get_branch(branch_id)
+        timestamps, version_ids = self._time_index.get(branch_id, ([], []))
+        index = bisect.bisect_right(timestamps, timestamp)
+        if index > 0:
+            return version_ids[index - 1]
+
+        # A branch started from a revision, which has no timestamp of its own, started from the version the revision follows
+        branched_from_id = self._get_version(branch.start).previous
+        while branched_from_id is not None and (branched_from := self._get_version(branched_from_id)).timestamp is None:
+            branched_from_id = branched_from.previous
+        if branched_from_id is not None and branched_from.timestamp <= timestamp:
+            return branched_from_id
+        raise YBDBException(f'Nothing had been committed to {branch_id} by {timestamp}')
+
+    def compute_state_at(self, branch_id: BranchID, timestamp: float | datetime.datetime, records: Optional[List[RecordID]] = None,
+                         attributes: Optional[List[str]] = None) -> DBState:
+        """Computes the state of a branch as it was committed at a timestamp (see version_at).
+
+        The state is computed with the revision selections as they are now, the same as compute_state of that version.
+        """
+
+        return self.compute_state(self.version_at(branch_id, timestamp), records=records, attributes=attributes)
+
+    def versions_between(self, start_timestamp: float | datetime.datetime, end_timestamp: float | datetime.datetime, branch_id: Optional[BranchID] = None) -> List[VersionID]:
+        """The versions committed from start_timestamp up to and including end_timestamp, in the order they were committed.
+
+        branch_id: if given, only the versions committed on this branch
+        """
+
+        if self._time_index is None:
+            self._build_time_index()
+        start_timestamp = self._as_timestamp(start_timestamp)
+        end_timestamp = self._as_timestamp(end_timestamp)
+        branch_ids = self._time_index.keys() if branch_id is None else [branch_id]
+
+        branch_versions = []
+        for indexed_branch_id in branch_ids:
+            timestamps, version_ids = self._time_index.get(indexed_branch_id, ([], []))
+            start = bisect.bisect_left(timestamps, start_timestamp)
+            end = bisect.bisect_right(timestamps, end_timestamp)
+            branch_versions.append(zip(timestamps[start:end], version_ids[start:end]))
+        return [version_id for _, version_id in heapq.merge(*branch_versions)]
+
+    def record_history(self, record_id: RecordID, id: ids.ID) -> List[Tuple[VersionID, List[str]]]:
+        """Finds the versions in the ancestry of a version (or the end of a branch) that change a given record.
+
+        Returns a list of (version ID, fields touched) pairs, in the same order as _ancestry (most recent first).
+        An empty list of fields means the version set or deleted the whole record.
+        The record index gives the versions that touched the record, and the history is only walked back
+        until it has passed all of them, so a record that was changed recently doesn't read the older history.
+        """
+
+        if self._record_index is None:
+            self._build_record_index()
+
+        record_versions = self._record_index.get(record_id, {})
+        if record_versions == {}:
+            return []
+
+        version_id = self._to_version_id(id)
+        # Other branches' open versions can't be in the ancestry, and waiting for them would walk back through everything
+        unfound = {touching_id for touching_id in record_versions
+                   if touching_id == version_id or not self._is_open(self._get_version(touching_id))}
+        history = []
+        if unfound == set():
+            return history
+        for ancestor_id, _, is_revision in self._walk_back(version_id, {}):
+            if not is_revision and ancestor_id in unfound:
+                unfound.remove(ancestor_id)
+                history.append((ancestor_id, record_versions[ancestor_id]))
+                if unfound == set():
+                    break
+        return history
+
+    @measured
     def commit(self, branch_id: BranchID, message: Optional[str] = None) -> VersionID:
         """Commit the changes that have been made to a branch.
         
@@ -418,11 +2168,10 @@ class Database:
                 current_version.merge.revision_changes = revision_changes
         else:
             if current_version.previous is not None:
-                revisions = self._revision_state(current_version_id)
-                previous_revisions = self._revision_state(current_version.previous)
-                revisions_have_changed = revisions != previous_revisions
+                revision_changes = self._branch_revision_changes(branch_id)
             else:
-                revisions_have_changed = False
+                revision_changes = {}
+            revisions_have_changed = revision_changes != {}
 
             if current_version_type is None and not revisions_have_changed:
                 # If nothing has changed, don't create a new version
@@ -432,21 +2181,18 @@ class Database:
                 current_version.change = {}
             
             if revisions_have_changed:
-                revision_changes = {}
-                for revision_id in revisions:
-                    if revision_id not in previous_revisions or revisions[revision_id] != previous_revisions[revision_id]:
-                        revision_changes[revision_id] = revisions[revision_id]
                 current_version.change.revision_changes = revision_changes
             
-        previous_revisions_using = self._get_version(current_version.previous).revisions_using
-        previous_revisions_using_copy = previous_revisions_using.copy()
         current_version.revisions_using = []
-        for revision_id in previous_revisions_using_copy:
-            revision = self._get_version(revision_id)
-            if ids.id_type(revision.revision.current) == ids.IDType.branch:
-                previous_revisions_using.remove(revision_id)
-                current_version.revisions_using.append(revision_id)
-        if current_version.revisions_using == []:
+        previous_revisions_using = self._get_version(current_version.previous).revisions_using
+        if previous_revisions_using is not None:
+            for revision_id in previous_revisions_using.copy():
+                revision = self._get_version(revision_id)
+                if revision.revision.current == branch_id:
+                    previous_revisions_using.remove(revision_id)
+                    current_version.revisions_using.append(revision_id)
+        branch_revisions_using = current_version.revisions_using.as_raw()
+        if branch_revisions_using == []:
             del current_version.revisions_using
                 
         current_version.timestamp = self._timestamp()
@@ -458,9 +2204,38 @@ class Database:
         new_version.previous = current_version_id
         branch.end = new_version_id
 
+        # The new open version selects the same as the version just committed. If that recorded no changes, it also resolves
+        # its revisions the same as the commit before it, and otherwise its revision state is traced back when it's next needed
+        if current_version_type == VersionType.merge:
+            self._committed_revisions.pop(branch_id, None)
+            self._current_revisions.pop(branch_id, None)
+        elif revision_changes != {}:
+            self._committed_revisions.pop(branch_id, None)
+
+        # Revisions that follow this branch now select the version that was just committed
+        for revision_id in branch_revisions_using:
+            self._forget_revision_states(revision_id)
+
+        if self._time_index is not None:
+            timestamps, version_ids = self._time_index.setdefault(branch_id, ([], []))
+            # Normally at the end, unless the clock has gone back since the last commit
+            index = bisect.bisect_right(timestamps, current_version.timestamp)
+            timestamps.insert(index, current_version.timestamp)
+            version_ids.insert(index, current_version_id)
+
         self.save()
+
+        # Only once the commit is saved, so that a snapshot which can't be computed doesn't leave the commit half done.
+        # The snapshot is only a cache, so a failure drops it (to be read back from its stored copy), and it's stored with the next save
+        if self.tip_snapshots:
+            try:
+                self._update_tip_snapshot(branch_id, current_version_id)
+            except Exception:
+                self._count('snapshot failures')
+                self._tip_snapshots.pop(branch_id, None)
         return current_version_id
     
+    @measured
     def update(self, id: ids.ID, deltas: Record) -> None:
         """Incorporates edits to the version at the end of a branch.
         
@@ -482,6 +2257,7 @@ class Database:
             # If the open version has not had any edits yet, need to mark that this version is a change rather than a merge
             version.change = {}
         version.change.deltas = deltas
+        self._index_version_records(version.id)
 
         self.save()
 
@@ -493,8 +2269,10 @@ class Database:
             raise YBDBException('Cannot make a branch from an open version')
 
         new_branch_id = self._next_branch_id()
+        self._remember_original('branches', new_branch_id)
         self._branches[new_branch_id] = {}
         new_branch = self._get_branch(new_branch_id)
+        new_branch.id = new_branch_id
         new_branch.name = branch_name
 
         new_version_id, new_version = self._make_new_version()
@@ -511,6 +2289,7 @@ class Database:
         self.save()
         return new_branch_id
 
+    @measured
     def start_merge(self, primary_branch_id: BranchID, tributary_version_id: VersionID,
                        default_rules: dict, record_rules: dict) -> VersionID:
         """Merges a given version into the end of a given branch."""
@@ -534,6 +2313,15 @@ class Database:
         merge_info.tributary = tributary_version_id
         merge_info.default = default_rules
         merge_info.records = record_rules
+        self._index_version_records(merge_version_id)
+        self._merge_rule_tables.pop(merge_version_id, None)
+        # The version graph has a new edge, which logs part way through shouldn't have to account for
+        self._log_walks = {}
+        self._current_revisions.pop(primary_branch_id, None)
+
+        if tributary_version.merged_to is None:
+            tributary_version.merged_to = []
+        tributary_version.merged_to.append(merge_version_id)
 
         self.save()
         return merge_version_id
@@ -543,11 +2331,26 @@ class Database:
             version = self._get_version(self._to_version_id(id))
         else:
             version = self._get_version(id)
-        if (not self._is_open(version)) or (self._version_type(version) != VersionType.change):
+        if (not self._is_open(version)) or (self._version_type(version) != VersionType.merge):
             raise YBDBException('Invalid version input to edit_merge')
+
+        old_default_rules = as_raw(version.merge.default) or {}
+        old_record_rules = as_raw(version.merge.records) or {}
         
         version.merge.default = default_rules
         version.merge.records = record_rules
+        self._index_version_records(version.id)
+
+        # Only re-resolve the parts of the compiled rules that these edits affect
+        rule_table = self._merge_rule_tables.get(version.id)
+        if rule_table is not None:
+            new_default_rules = as_raw(default_rules) or {}
+            new_record_rules = as_raw(record_rules) or {}
+            if new_default_rules != old_default_rules:
+                rule_table.set_default_rules(new_default_rules)
+            for record_id in old_record_rules.keys() | new_record_rules.keys():
+                if old_record_rules.get(record_id) != new_record_rules.get(record_id):
+                    rule_table.set_record_rules(record_id, new_record_rules.get(record_id))
 
         self.save()
 
@@ -576,7 +2379,7 @@ class Database:
             revision_version.branches_out = prev_version.branches_out
             for branch_id in revision_version.branches_out:
                 branch_start_version = self._get_version(self._get_branch(branch_id).start)
-                branch_start_version.prev = revision_id
+                branch_start_version.previous = revision_id
             del prev_version.branches_out
         
         if prev_version.merged_to is not None:
@@ -592,20 +2395,37 @@ class Database:
             revision_version.revisions_using = prev_version.revisions_using
             for other_revision_id in revision_version.revisions_using:
                 other_revision = self._get_version(other_revision_id)
-                other_revision.current = revision_id
-            prev_version.revisions_using = [revision_id]
+                # Revisions that follow a branch keep following it, through the new revision until the branch's next commit
+                if ids.id_type(other_revision.revision.current) != ids.IDType.branch:
+                    other_revision.revision.current = revision_id
+        prev_version.revisions_using = [revision_id]
+
+        # Runs of versions that go through the new revision depend on what it selects, so their composed deltas can't be reused
+        # (and logs that were part way through them would miss it)
+        self._log_walks = {}
+        for blocks in self._delta_blocks.values():
+            for level in [level for level, (covered_ids, _) in blocks.items() if revision_version.next in covered_ids[1:]]:
+                del blocks[level]
 
         revision_version.revision = {}
         revision_version.revision.current = prev_id
         revision_version.revision.original = prev_id
 
+        # The new revision can be reached from branches that are downstream of it through other revisions' selections,
+        # and revisions that used prev_id now select it, so every branch's revision states are traced back again
+        self._committed_revisions = {}
+        self._current_revisions = {}
+
         self.save()
         return revision_id
 
+    @measured
     def revise(self, revision_id: VersionID, new_id: ids.ID) -> None:
         new_version_id = self._to_version_id(new_id, allow_open=False)
         
-        if revision_id in self._ancestry(new_version_id, include_revisions=True):
+        # Open versions follow what revisions select now, which can lead somewhere else than what they selected when committed
+        if revision_id in self._ancestry(new_version_id, include_revisions=True) \
+           or any(ancestor_id == revision_id for ancestor_id, _, _ in self._walk_back(new_version_id, {}, current_selections=True)):
             raise YBDBException('Cannot make a revision select a version downstream of the revision')
         
         revision_version = self._get_version(revision_id)
@@ -627,20 +2447,17 @@ class Database:
         new_current.revisions_using.append(revision_id)
 
         revision_version.revision.current = new_id
+        self._log_walks = {}
+
+        self._forget_revision_states(revision_id)
 
     @staticmethod
-    def _compute_merge(primary: DBState, tributary: DBState, lca: DBState, rules: JSONDict) -> DBState:
-        # Giving these strings names so it's easier to know what I'm writing
-        class MergeRule(StrEnum):
-            inherit = ''
-            inherit_prioritizing_field = 'f'
-            inherit_prioritizing_record = 'r'
-            primary_if_conflict = 'p'
-            tributary_if_conflict = 't'
-            primary_always = 'p!'
-            tributary_always = 't!'
-        MR = MergeRule
-        explicit_rules = [MR.primary_if_conflict, MR.tributary_if_conflict, MR.primary_always, MR.tributary_always]
+    def _compute_merge(primary: DBState, tributary: DBState, lca: DBState, rules: JSONDict,
+                       rule_table: Optional[MergeRuleTable] = None) -> DBState:
+        """Merges two database states, given the state at their LCA and the merge rules.
+
+        rule_table: the merge rules already compiled into a MergeRuleTable; if not given, they are compiled from rules
+        """
 
         # Used for selecting which version to take from
         class MergeChoice(Enum):
@@ -670,21 +2487,16 @@ class Database:
         # Create the output db state
         output = primary.new()
 
-        # The rules input will be the merge field of a version. Get the subfields for ease of use:
-        default_rule = rules.default.all
-        field_rules = rules.default.fields
-        inherit_priority = rules.default.inherit_priority
-        record_rules = rules.records
-
-        if default_rule is None:
-            default_rule = MR.primary_if_conflict
+        # Resolve the four levels of rules (merge default, field, record, record field) once, rather than for every field of every record
+        if rule_table is None:
+            rule_table = MergeRuleTable(rules)
 
         # Figure out what fields have been edited
         primary_deltas = calculate_delta(lca, primary)
         tributary_deltas = calculate_delta(lca, tributary)
 
-        # Build up the resulting version, record by record
-        for record_id in primary.keys() | tributary.keys():
+        # Build up the resulting version, record by record, in sorted order so the result doesn't depend on how the merge was split up
+        for record_id in sorted(primary.keys() | tributary.keys()):
             # See which input(s) have made edits to this version since the LCA
             primary_edit = record_id in primary_deltas
             tributary_edit = record_id in tributary_deltas
@@ -697,14 +2509,8 @@ class Database:
             # either because it was there in the LCA and one of the inputs deleted it
             # or because it was not in the LCA and one of the inputs created it
 
-            # Figure out what rule to use here
-            if record_rules is not None and record_id in record_rules and (r := record_rules[record_id].all) is not None:
-                record_general_rule = r
-            else:
-                record_general_rule = default_rule
-            
             # Decide what to do based on which inputs have made edits
-            record_choice = apply_rule(primary_edit, tributary_edit, record_general_rule)
+            record_choice = apply_rule(primary_edit, tributary_edit, rule_table.record_rule(record_id))
             if primary_record == None:
                 # If this record is not in the primary input
                 if record_choice == MC.tributary:
@@ -731,54 +2537,19 @@ class Database:
                 
             # Create the record to be added in the output db
             output_record = primary_record.new()
+
+            # The resolved rule for each field of this record (shared with every other record that has no rules of its own)
+            record_field_rules = rule_table.row(record_id)
             
             # Now build up the record, field by field
-            for field in output_record._template:
-                # Get the four rules that are relevant here
-                # default_rule: the default rule for the whole merge
-                # field_rule: the default rule for this field across all records
-                # record_rule: the default rule for all fields of this record
-                # record_field_rule: the rule for this specific field of this record
-
-                if field_rules is not None and field in field_rules:
-                    field_rule = field_rules[field]
-                else:
-                    field_rule = MR.inherit
-
-                if record_rules is not None and record_id in record_rules:
-                    this_record_rules = record_rules[record_id]
-
-                    if (r := this_record_rules.all) is not None:
-                        record_rule = r
-                    else:
-                        record_rule = MR.inherit
-                    
-                    if (a := this_record_rules.fields) is not None and (r := a[field]) is not None:
-                        record_field_rule = r
-                    else:
-                        record_field_rule = MR.inherit
-                
-                # From these four rules, figure out what rule to apply in this case
-                if record_field_rule in explicit_rules:
-                    rule = record_field_rule
-                else:
-                    if field_rule in explicit_rules:
-                        if record_rule in explicit_rules and field_rule != record_rule:
-                            if record_field_rule == MR.inherit_prioritizing_field:
-                                rule = field_rule
-                            elif record_field_rule == MR.inherit_prioritizing_record:
-                                rule = record_rule
-                            elif inherit_priority == MR.inherit_prioritizing_field:
-                                rule = field_rule
-                            else:
-                                rule = record_rule
-                        else:
-                            rule = field_rule
-                    else:
-                        if record_rule in explicit_rules:
-                            rule = record_rule
-                        else:
-                            rule = default_rule
+            if output_record._template is not None:
+                record_fields = list(output_record._template.keys())
+            else:
+                record_fields = sorted(primary_record._data.keys() | tributary_record._data.keys())
+            for field in record_fields:
+                rule = record_field_rules.get(field)
+                if rule is None:
+                    rule = rule_table.field_rule(record_id, field)
                 
                 # See which inputs made edits
                 primary_edit = field in primary_record_delta
@@ -799,14 +2570,416 @@ class Database:
         
         return output
 
-    def compute_state(self, id: ids.ID, revision_state: Optional[Dict[VersionID, VersionID]] = None) -> DBState:
+    @staticmethod
+    def _project_deltas(deltas: dict, records: Optional[Set[RecordID]], attributes: Optional[Set[str]]) -> dict:
+        """Keep only the parts of a version's deltas that affect the given records and attributes.
+
+        A record whose changes are all to other attributes is kept as an empty dict,
+        so a delta that creates a record still creates it.
+        """
+
+        if records is None:
+            record_deltas = deltas.items()
+        else:
+            record_deltas = [(record_id, deltas[record_id]) for record_id in records if record_id in deltas]
+
+        if attributes is None:
+            return dict(record_deltas)
+
+        output = {}
+        for record_id, record_delta in record_deltas:
+            if isinstance(record_delta, dict):
+                record_delta = {field: value for field, value in record_delta.items() if field in attributes}
+            elif isinstance(record_delta, ReplacedValue):
+                record_delta = ReplacedValue({field: value for field, value in record_delta.value.items() if field in attributes})
+            output[record_id] = record_delta
+        return output
+
+    def _delta_block(self, run: List[VersionID], index: int, level: int) -> dict:
+        """The composed delta of the 2 ** level versions of a run that end at run[index].
+
+        Blocks are only ever made for versions whose depth (see _run_deltas) is a multiple of 2 ** level,
+        so each is made out of two blocks of the level below, and the same blocks are reused by every later computation.
+        A stored block remembers which versions it covers, and is only used if the run still has those same versions:
+        a revision can change which version comes before another.
+        """
+
+        version_id = run[index]
+        if level == 0:
+            deltas = self._get_version(version_id).change.deltas
+            return deltas._data if deltas is not None else {}
+
+        covered_ids = tuple(run[index - 2 ** level + 1:index + 1])
+        blocks = self._delta_blocks.setdefault(version_id, {})
+        if level in blocks and blocks[level][0] == covered_ids:
+            self._count('delta block hits')
+            return blocks[level][1]
+        self._count('delta block misses')
+
+        composed = compose_deltas(self._delta_block(run, index - 2 ** (level - 1), level - 1), self._delta_block(run, index, level - 1))
+        blocks[level] = (covered_ids, composed)
+        return composed
+
+    def _run_deltas(self, run: List[VersionID], start_depth: int) -> List[dict]:
+        """Returns composed deltas that, applied in order, take the state at run[0] to the state at run[-1].
+
+        run: a version followed by committed change versions, each the only parent of the next
+        start_depth: the depth of run[0], meaning the number of committed change versions in a row that end at it
+
+        Uses the largest blocks that fit, so a run of n versions takes O(log n) deltas.
+        """
+
+        pieces = []
+        index = len(run) - 1
+        while index > 0:
+            depth = start_depth + index
+            level = 0
+            while depth % 2 ** (level + 1) == 0 and index >= 2 ** (level + 1):
+                level += 1
+            pieces.append(self._delta_block(run, index, level))
+            index -= 2 ** level
+        pieces.reverse()
+        return pieces
+
+    def _merge_rule_table(self, merge_version_id: VersionID) -> MergeRuleTable:
+        if merge_version_id not in self._merge_rule_tables:
+            self._merge_rule_tables[merge_version_id] = MergeRuleTable(self._get_version(merge_version_id).merge)
+        return self._merge_rule_tables[merge_version_id]
+
+    @measured
+    def _merge(self, primary: DBState, tributary: DBState, lca: DBState, rules: JSONDict,
+               rule_table: Optional[MergeRuleTable] = None) -> DBState:
+        """Computes a merge, splitting it across worker processes by record if the database is set up to and the merge is big enough.
+
+        The result is identical to _compute_merge, records in the same order included, since each record is merged
+        independently of the others and the chunks are split off and put back together in _compute_merge's sorted order.
+        """
+
+        self._count('merges computed')
+        record_ids = sorted(primary._data.keys() | tributary._data.keys())
+        if self.merge_workers is None or self.merge_workers <= 1 or len(record_ids) < 2 * self.merge_chunk_size:
+            return self._compute_merge(primary, tributary, lca, rules, rule_table)
+
+        if self._merge_executor is None:
+            self._merge_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.merge_workers)
+
+        chunk_size = max(self.merge_chunk_size, -(-len(record_ids) // (self.merge_workers * 4)))
+        rules_data = rules.as_raw()
+        record_rules = rules_data.pop('records', {})
+
+        futures = []
+        for i in range(0, len(record_ids), chunk_size):
+            chunk = record_ids[i:i + chunk_size]
+            chunk_rules_data = dict(rules_data)
+            chunk_record_rules = {record_id: record_rules[record_id] for record_id in chunk if record_id in record_rules}
+            if chunk_record_rules != {}:
+                chunk_rules_data['records'] = chunk_record_rules
+            futures.append(self._merge_executor.submit(
+                _compute_merge_chunk, self._state_template,
+                {record_id: primary._data[record_id] for record_id in chunk if record_id in primary._data},
+                {record_id: tributary._data[record_id] for record_id in chunk if record_id in tributary._data},
+                {record_id: lca._data[record_id] for record_id in chunk if record_id in lca._data},
+                rules._type_name, rules._template, chunk_rules_data))
+
+        # Put the chunks back together in record order, regardless of which finishes first
+        output = primary.new()
+        output_data = {}
+        for future in futures:
+            output_data.update(future.result())
+        output.set_data(output_data)
+        return output
+
+    def close(self) -> None:
+        """Release the worker processes, open packs, and storage connections this database holds"""
+
+        if self._merge_executor is not None:
+            self._merge_executor.shutdown()
+            self._merge_executor = None
+        for pack in self._packs + self._archives:
+            pack.close()
+        if self._storage is not None:
+            self._storage.close()
+        if self._metrics is not None:
+            self._metrics.close()
+
+    def metrics(self, reset: bool = False) -> dict:
+        """What this database has done since it was created (or the metrics were last reset).
+
+        Returns 'counters', the totals of the work done: versions replayed and deltas applied by compute_state,
+        merges computed, files (or pack records) read, files written and bytes written, and hits and misses of
+        the delta block, tip snapshot, and blob caches; and 'timings', for each timed method,
+        its number of calls, total, mean, and longest time in seconds, and a histogram of call times
+        (with the buckets' upper bounds in 'histogram bounds').
+        reset: start counting again from zero once these are returned
+        """
+
+        if self._metrics is None:
+            raise YBDBException('Metrics are only collected by a database created with collect_metrics=True')
+        output = self._metrics.as_dict()
+        if reset:
+            self._metrics.reset()
+        return output
+
+    def write_trace(self, path: str, clear: bool = True) -> None:
+        """Write the spans recorded so far to a Chrome trace file (see tracing.Tracer)
+
+        clear: start recording afresh once they are written
+        """
+
+        if self._tracer is None:
+            raise YBDBException('Spans are only recorded by a database created with trace=True')
+        self._tracer.write(path)
+        if clear:
+            self._tracer.clear()
+
+    @contextlib.contextmanager
+    def tracing(self, path: str):
+        """Record the spans of everything done within the with block, and write them to a Chrome trace file at the end.
+
+            with db.tracing('compute_state.json'):
+                db.compute_state('b,TRUNK')
+        """
+
+        previous_tracer = self._tracer
+        self._tracer = tracing.Tracer()
+        try:
+            yield
+        finally:
+            self._tracer.write(path)
+            self._tracer = previous_tracer
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        if self._metrics is not None:
+            self._metrics.count(name, amount)
+
+    def _count_written(self, byte_count: int) -> None:
+        if self._metrics is not None:
+            self._metrics.count('files written')
+            self._metrics.count('bytes written', byte_count)
+
+    def _tip_snapshot(self, branch_id: BranchID) -> Optional[Tuple[VersionID, DBState]]:
+        if branch_id not in self._tip_snapshots:
+            snapshot_data = self._read_snapshot_data('snapshots', branch_id)
+            if snapshot_data is not None and self._has_version(snapshot_data['version']):
+                version_id = snapshot_data['version']
+                state = JSONDict('database state', self._state_template, snapshot_data['state'])
+                # The stored snapshot can be a few commits behind (see _update_tip_snapshot), which their deltas make up
+                lag = 0
+                while (next_id := self._get_version(version_id).next) is not None:
+                    next_version = self._get_version(next_id)
+                    if self._is_open(next_version) or self._version_type(next_version) != VersionType.change \
+                       or next_version.change.revision_changes is not None:
+                        break
+                    if next_version.change.deltas is not None:
+                        state = add_delta(state, next_version.change.deltas)
+                    version_id = next_id
+                    lag += 1
+                self._tip_snapshots[branch_id] = (version_id, state)
+                self._snapshot_lags[branch_id] = lag
+            else:
+                self._tip_snapshots[branch_id] = None
+        return self._tip_snapshots[branch_id]
+
+    def _reverse_delta(self, version_id: VersionID) -> Optional[dict]:
+        if version_id not in self._reverse_deltas:
+            self._reverse_deltas[version_id] = self._read_snapshot_data('reverse deltas', version_id)
+        return self._reverse_deltas[version_id]
+
+    def _update_tip_snapshot(self, branch_id: BranchID, version_id: VersionID) -> None:
+        """Move a branch's snapshot to a version that was just committed, and store the reverse delta leading back from it.
+
+        A change with no revision selections of its own is the state before it plus its deltas, and a merge with none,
+        in a history without revisions, is the merge of the state before it with its tributary; anything else is computed from scratch.
+        The stored snapshot is only rewritten every snapshot_lag_limit commits (or after a merge or a rebuild),
+        since the commits in between bring it up to date again when it is read (see _tip_snapshot).
+        """
+
+        version = self._get_version(version_id)
+        version_type = self._version_type(version)
+        snapshot = self._tip_snapshot(branch_id)
+        old_state = snapshot[1] if snapshot is not None and snapshot[0] == version.previous else None
+
+        # Reading the stored snapshot can only catch up through changes, so it is rewritten after anything else
+        write_snapshot = version_type != VersionType.change
+        if version_type == VersionType.change and version.change.revision_changes is None:
+            if old_state is None:
+                # Such as the first commit on a new branch, whose previous version is on the branch it came from
+                old_state = self.compute_state(version.previous)
+            deltas = version.change.deltas
+            new_state = old_state if deltas is None else add_delta(old_state, deltas)
+            changed_ids = [] if deltas is None else list(deltas._data)
+        elif version_type == VersionType.merge and version.merge.revision_changes is None and old_state is not None \
+             and not any(is_revision for _, _, is_revision in self._walk_back(version_id, {})):
+            tributary_id = version.merge.tributary
+            new_state = self._merge(old_state, self.compute_state(tributary_id),
+                                    self.compute_state(self._find_LCA(version.previous, tributary_id)),
+                                    version.merge, self._merge_rule_table(version_id))
+            changed_ids = list(old_state._data.keys() | new_state._data.keys())
+        else:
+            self._count('snapshot rebuilds')
+            self._tip_snapshots[branch_id] = None
+            new_state = self.compute_state(version_id)
+            changed_ids = None
+            write_snapshot = True
+
+        if changed_ids is not None:
+            reverse_deltas = {}
+            for record_id in changed_ids:
+                if record_id not in old_state:
+                    reverse_deltas[record_id] = None
+                elif record_id not in new_state:
+                    reverse_deltas[record_id] = old_state[record_id].as_raw()
+                else:
+                    record_reverse_delta = calculate_delta(new_state[record_id], old_state[record_id])
+                    if len(record_reverse_delta._data) > 0:
+                        reverse_deltas[record_id] = record_reverse_delta._data
+            self._reverse_deltas[version_id] = {'previous': version.previous, 'branch': branch_id, 'deltas': reverse_deltas}
+            self._snapshots_dirty['reverse deltas'].add(version_id)
+
+        self._tip_snapshots[branch_id] = (version_id, new_state)
+        self._snapshot_lags[branch_id] = self._snapshot_lags.get(branch_id, 0) + 1
+        if write_snapshot or self._snapshot_lags[branch_id] >= snapshot_lag_limit:
+            self._snapshot_lags[branch_id] = 0
+            self._snapshots_dirty['snapshots'].add(branch_id)
+
+    def _state_from_snapshot(self, version_id: VersionID, records: Optional[Set[RecordID]], attributes: Optional[Set[str]]) -> Optional[DBState]:
+        """Computes a state from the snapshot of the version's branch, or returns None if the snapshot can't be used.
+
+        The open version at the end of the branch is the snapshot plus its own deltas,
+        as long as no revision selection has changed since the branch was last committed.
+        Earlier versions on the branch are the snapshot with reverse deltas applied, going back one version at a time,
+        as long as they are at most snapshot_lag_limit versions back.
+        """
+
+        version = self._get_version(version_id)
+        snapshot = self._tip_snapshot(version.branch)
+        if snapshot is None:
+            return None
+        tip_id, tip_state = snapshot
+
+        pieces = []
+        if self._is_open(version):
+            if version.previous != tip_id or self._branch_revision_changes(version.branch) != {}:
+                return None
+            version_type = self._version_type(version)
+            if version_type == VersionType.merge:
+                return None
+            if version_type == VersionType.change and version.change.deltas is not None:
+                pieces.append(version.change.deltas._data)
+        else:
+            # Each version back is another reverse delta to read, so past the most a stored snapshot lags, the state is rebuilt instead
+            distance, current_id = 0, version_id
+            while current_id != tip_id:
+                current_id = self._get_version(current_id).next
+                distance += 1
+                if current_id is None or distance > snapshot_lag_limit:
+                    return None
+            current_id = tip_id
+            while current_id != version_id:
+                reverse_delta = self._reverse_delta(current_id)
+                if reverse_delta is None or reverse_delta['branch'] != version.branch:
+                    return None
+                pieces.append(reverse_delta['deltas'])
+                current_id = reverse_delta['previous']
+
+        if records is not None or attributes is not None:
+            tip_state = JSONDict(tip_state._type_name, tip_state._template, self._project_deltas(tip_state._data, records, attributes))
+            pieces = [self._project_deltas(piece, records, attributes) for piece in pieces]
+        self._count('versions replayed', len(pieces))
+        self._count('deltas applied', len(pieces))
+        with tracing.span(self._tracer, 'add_deltas', version=version_id, snapshot=tip_id, deltas=len(pieces)) as span_args:
+            state = add_deltas(tip_state, pieces)
+            span_args['records'] = len(state._data)
+        return state
+
+    @measured
+    def compute_state(self, id: ids.ID, revision_state: Optional[Dict[VersionID, VersionID]] = None,
+                      records: Optional[List[RecordID]] = None, attributes: Optional[List[str]] = None) -> DBState:
+        """Computes the state of the database at a version (or the end of a branch).
+
+        records, attributes: if given, only these records and only these attributes of each record are computed.
+        Versions whose deltas don't touch any of them are skipped, so a small view of a large database is much cheaper.
+        """
+
         version_id = self._to_version_id(id)
         version = self._get_version(version_id)
 
         if self._version_type(version) == VersionType.revision:
             raise YBDBException('Cannot compute the state of the database at a revision')
 
+        record_set = set(records) if records is not None else None
+        attribute_set = set(attributes) if attributes is not None else None
+
+        if self.tip_snapshots and revision_state is None:
+            state = self._state_from_snapshot(version_id, record_set, attribute_set)
+            if state is not None:
+                self._count('snapshot hits')
+                return state
+            self._count('snapshot misses')
+
         graph = self._graph(version_id, revision_state=revision_state)
+
+        # Whether a merge takes a record from the primary or the tributary can depend on edits to any of its attributes,
+        # so with merges in the history, attributes are only filtered out at the end
+        delta_attribute_set = attribute_set
+        if attribute_set is not None and any(len(parent_ids) > 1 for parent_ids in graph.values()):
+            delta_attribute_set = None
+        projected = record_set is not None or delta_attribute_set is not None
+
+        # Only some states have to be worked out: the one asked for, the root, and everything a merge uses
+        # The runs of committed change versions in between are skipped over with composed deltas
+        # A merge's LCA is only found when the merge is, but it's either one of its parents or a version that history forks at,
+        # since a version with one child has that child as a nearer common ancestor
+        needed: Set[VersionID] = {version_id, ids.root_version_id}
+        child_counts: Dict[VersionID, int] = {}
+        for ancestor_id, parent_ids in graph.items():
+            if len(parent_ids) > 1:
+                needed.update([ancestor_id, *parent_ids])
+            for parent_id in parent_ids:
+                child_counts[parent_id] = child_counts.get(parent_id, 0) + 1
+        needed.update(ancestor_id for ancestor_id, child_count in child_counts.items() if child_count > 1)
+
+        run_versions: Set[VersionID] = set()
+        for ancestor_id, parent_ids in graph.items():
+            ancestor_version = self._get_version(ancestor_id)
+            if len(parent_ids) == 1 and not self._is_open(ancestor_version) and self._version_type(ancestor_version) == VersionType.change:
+                run_versions.add(ancestor_id)
+
+        # The number of committed change versions in a row that end at each version
+        depths: Dict[VersionID, int] = {}
+        for ancestor_id in run_versions:
+            walked_ids = []
+            while ancestor_id in run_versions and ancestor_id not in depths:
+                walked_ids.append(ancestor_id)
+                ancestor_id = graph[ancestor_id][0]
+            depth = depths.get(ancestor_id, 0)
+            for walked_id in reversed(walked_ids):
+                depth += 1
+                depths[walked_id] = depth
+
+        # Each needed change (or empty open) version depends on the closest needed version before it, through a run of committed changes
+        needed_graph: Dict[VersionID, List[VersionID]] = {}
+        runs: Dict[VersionID, List[VersionID]] = {}
+        unconnected_ids = list(needed)
+        while unconnected_ids != []:
+            needed_id = unconnected_ids.pop()
+            parent_ids = graph[needed_id]
+            if len(parent_ids) != 1:
+                needed_graph[needed_id] = parent_ids
+            else:
+                run = [needed_id]
+                start_id = parent_ids[0]
+                while start_id not in needed and start_id in run_versions:
+                    run.append(start_id)
+                    start_id = graph[start_id][0]
+                run.append(start_id)
+                run.reverse()
+                runs[needed_id] = run
+                needed_graph[needed_id] = [start_id]
+                if start_id not in needed:
+                    needed.add(start_id)
+                    unconnected_ids.append(start_id)
+        graph = needed_graph
         
         calculated_versions: Dict[VersionID, DBState] = {}
         
@@ -820,31 +2993,62 @@ class Database:
                     del remaining_graph[ancestor_id]
 
                 elif all(parent_id in calculated_versions for parent_id in parent_ids):
-                    ancestor_version = self._get_version(ancestor_id)
-                    ancestor_type = self._version_type(ancestor_version)
-
-                    if ancestor_type == VersionType.change:
-                        assert(ancestor_version.previous == parent_ids[0])
-                        parent_state = calculated_versions[ancestor_version.previous]
-                        calculated_versions[ancestor_id] = add_delta(parent_state, ancestor_version.change.deltas)
+                    if ancestor_id in runs:
+                        # A change, or an open version with no edits yet, at the end of a run of committed changes
+                        # The start of the run may be a revision's selection rather than the literal previous version
+                        run = runs[ancestor_id]
+                        start_state = calculated_versions[run[0]]
+                        if run[-1] not in run_versions:
+                            committed_run = run[:-1]
+                        else:
+                            committed_run = run
+                        pieces = self._run_deltas(committed_run, depths.get(run[0], 0))
+                        if committed_run is not run and self._version_type(self._get_version(ancestor_id)) == VersionType.change:
+                            deltas = self._get_version(ancestor_id).change.deltas
+                            if deltas is not None:
+                                pieces.append(deltas._data)
+                        self._count('versions replayed', len(run) - 1)
+
+                        if projected:
+                            pieces = [self._project_deltas(piece, record_set, delta_attribute_set) for piece in pieces]
+                        pieces = [piece for piece in pieces if len(piece) > 0]
+                        if pieces == []:
+                            # Nothing here affects the state (or the part of it being computed)
+                            calculated_versions[ancestor_id] = start_state
+                        else:
+                            self._count('deltas applied', len(pieces))
+                            with tracing.span(self._tracer, 'add_deltas', version=ancestor_id, start=run[0], versions=len(run) - 1,
+                                              deltas=len(pieces)) as span_args:
+                                calculated_versions[ancestor_id] = add_deltas(start_state, pieces)
+                                span_args['records'] = len(calculated_versions[ancestor_id]._data)
 
                     else:
-                        assert(ancestor_type == VersionType.merge)
-                        primary_id = ancestor_version.previous
-                        tributary_id = ancestor_version.merge.tributary
-                        assert(parent_ids == [primary_id, tributary_id])
+                        ancestor_version = self._get_version(ancestor_id)
+                        assert(self._version_type(ancestor_version) == VersionType.merge)
+                        primary_id, tributary_id = parent_ids
 
                         primary_state = calculated_versions[primary_id]
                         tributary_state = calculated_versions[tributary_id]
-                        lca_id = self._find_LCA(primary_id, tributary_id)
-                        lca_state = calculated_versions[lca_id]
-                        calculated_versions[ancestor_id] = self._compute_merge(primary_state, tributary_state, lca_state, ancestor_version.merge)
+                        with tracing.span(self._tracer, 'merge', version=ancestor_id, primary_records=len(primary_state._data),
+                                          tributary_records=len(tributary_state._data)) as span_args:
+                            lca_id = self._find_LCA(primary_id, tributary_id)
+                            if lca_id in calculated_versions:
+                                lca_state = calculated_versions[lca_id]
+                            else:
+                                # Only if the revisions given lead somewhere other than those _find_LCA follows
+                                lca_state = self.compute_state(lca_id, revision_state, records)
+                            calculated_versions[ancestor_id] = self._merge(primary_state, tributary_state, lca_state, ancestor_version.merge,
+                                                                           self._merge_rule_table(ancestor_id))
+                            span_args['records'] = len(calculated_versions[ancestor_id]._data)
                     
                     del remaining_graph[ancestor_id]
             
             graph = remaining_graph
 
-        return calculated_versions[version_id]
+        state = calculated_versions[version_id]
+        if attribute_set is not None and delta_attribute_set is None:
+            state = JSONDict(state._type_name, state._template, self._project_deltas(state.as_raw(), None, attribute_set))
+        return state
 
     def print(self):
         if self.path is not None:
@@ -856,4 +3060,5 @@ class Database:
         print('\n\nBRANCHES --------------------')
         self._branches.print()
         print('\n\nVERSIONS --------------------')
+        self._load_all_versions()
         self._versions.print()
\ No newline at end of file
@@ -1,8 +1,84 @@
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
 import unittest
-from database import Database
+from copy import deepcopy
+from unittest import mock
+
+import database
+from database import Database, StorageOptions, ConflictError, YBDBException
+from async_database import AsyncDatabase
+import benchmark
+import compression
+import ids
+
+_repository_path = os.path.dirname(os.path.abspath(__file__))
 
 
 class TestDB(unittest.TestCase):
+    def setUp(self):
+        # Database directories are found through the folders.json in the working directory (see yearbook_setup),
+        # so each test runs from its own temporary folder, whose folders.json points back at this repository
+        self._test_folder_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._test_folder_path, True)
+        with open(os.path.join(self._test_folder_path, 'folders.json'), 'w') as file:
+            json.dump({'core': _repository_path, 'school': self._test_folder_path, 'year': self._test_folder_path}, file)
+        with open(os.path.join(self._test_folder_path, 'paths.json'), 'w') as file:
+            json.dump({}, file)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self._test_folder_path)
+
+        # yearbook_setup reads folders.json when it is imported, so database gets its paths from a copy imported here,
+        # and the module everything else imported is left alone
+        spec = importlib.util.find_spec('yearbook_setup')
+        paths = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(paths)
+        for name in ['core_path', 'construct_path', 'PS']:
+            patcher = mock.patch.object(database, name, getattr(paths, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _database_path(self, name: str = 'db') -> str:
+        """A path for a new database, in a directory which is removed when the test finishes"""
+
+        directory = tempfile.mkdtemp(dir=self._test_folder_path)
+        return os.path.join(directory, name)
+
+    def _new_database(self, *args, **kwargs) -> Database:
+        """A database set up at a new path (see _database_path), opened with the given options"""
+
+        db = Database(self._database_path(), *args, **kwargs)
+        db.setup()
+        return db
+
+    def _assert_reloads(self, db: Database, *args, **kwargs) -> Database:
+        """Loads db's database into a new Database, opened with the given options,
+        checks that every branch's state is the same as in db, and returns it
+        """
+
+        reloaded = Database(db.path, *args, **kwargs)
+        reloaded.load()
+        self.assertEqual(self._states(reloaded), self._states(db))
+        return reloaded
+
+    def _states(self, db: Database) -> dict:
+        return {branch_id: db.compute_state(branch_id).as_raw() for branch_id in db._branches._data}
+
+    def _abandon_branch(self, db: Database, branch_id: str) -> None:
+        """Removes a branch, leaving its versions for gc to find"""
+
+        branched_from = db._get_version(db._get_version(db._get_branch(branch_id).start).previous)
+        branched_from.branches_out.remove(branch_id)
+        if len(branched_from.branches_out) == 0:
+            del branched_from.branches_out
+        db._delete('branches', branch_id)
+        db.save()
+
     # def test_create_db(self):
     #     db = Database()
     #     db.data.print()
@@ -30,6 +106,7 @@ class TestDB(unittest.TestCase):
         self.assertEqual(db._ancestry('v,bu'), ['v,bu', 'v,bo', 'v,bi', 'v,ba'])
         self.assertEqual(db._ancestry('v,ci'), ['v,ci', 'v,bu', 'v,bo', 'v,ba'])
     
+
     def test_merge(self):
         db = Database()
         db.setup()
@@ -43,6 +120,900 @@ class TestDB(unittest.TestCase):
 
         self.assertEqual(db._ancestry('v,ca'), ['v,ca', 'v,bo', 'v,be', 'v,bi', 'v,ba'])
 
+    def test_incremental_revision_changes(self):
+        db = Database(None)
+        db.setup()
+
+        db.update('b,TRUNK', {'r,ba': {}})
+        db.commit('b,TRUNK')
+        branch_id = db.new_branch('v,ba', 'branch 2')
+        db.update(branch_id, {'r,ba': {'x': 1}})
+        db.commit(branch_id)
+        revision_id = db.setup_revision('v,ba')
+        db.update(branch_id, {'r,ba': {'x': 2}})
+        db.commit(branch_id)
+        db.revise(revision_id, ids.root_version_id)
+
+        end_id = db._get_branch(branch_id).end
+        current_revisions = db._revision_state(end_id)
+        previous_revisions = db._revision_state(db._get_version(end_id).previous)
+        expected = {revision_id: selection_id for revision_id, selection_id in current_revisions.items()
+                    if previous_revisions.get(revision_id) != selection_id}
+
+        self.assertEqual(db._branch_revision_changes(branch_id), expected)
+        self.assertEqual(expected, {revision_id: ids.root_version_id})
+
+    def test_random_revision_changes(self):
+        # The same random edits, once with the incremental revision states and once tracing back in full at each commit
+        def run(seed, full):
+            rng = random.Random(seed)
+            db = Database(None)
+            db.setup()
+            branch_ids = [ids.trunk_branch_id]
+            revision_ids = []
+            for step in range(60):
+                operation = rng.choice(['commit', 'commit', 'new branch', 'setup revision', 'revise'])
+                closed_ids = [version_id for version_id, version_data in db._versions._data.items()
+                              if version_data.get('next') is not None]
+                try:
+                    if operation == 'commit':
+                        branch_id = rng.choice(branch_ids)
+                        db.update(branch_id, {'r,ba': {'x': step}})
+                        if full:
+                            db._committed_revisions = {}
+                            db._current_revisions = {}
+                        db.commit(branch_id)
+                    elif operation == 'new branch':
+                        branch_ids.append(db.new_branch(rng.choice(closed_ids), f'branch {step}'))
+                    elif operation == 'setup revision':
+                        revision_ids.append(db.setup_revision(rng.choice(closed_ids)))
+                    elif revision_ids != []:
+                        db.revise(rng.choice(revision_ids), rng.choice(closed_ids + branch_ids))
+                except YBDBException:
+                    pass
+            return db
+
+        def revision_changes(db):
+            return {version_id: (version_data.get('change') or version_data.get('merge') or {}).get('revision changes')
+                    for version_id, version_data in db._versions.as_raw().items()}
+
+        for seed in range(20):
+            incremental_db = run(seed, False)
+            full_db = run(seed, True)
+            self.assertEqual(revision_changes(incremental_db), revision_changes(full_db))
+            self.assertEqual(self._states(incremental_db), self._states(full_db))
+
+    def test_save_only_changed(self):
+        db = self._new_database()
+        db.update('b,TRUNK', {'r,ba': {'x': 1}})
+
+        def written_paths(edit):
+            with mock.patch('database._write_json', wraps=database._write_json) as write_json:
+                edit()
+            return sorted(os.path.relpath(call.args[0], db.path) for call in write_json.call_args_list)
+
+        # An update only rewrites the open version it edits
+        end_id = db._get_branch('b,TRUNK').end
+        self.assertEqual(written_paths(lambda: db.update('b,TRUNK', {'r,ba': {'x': 2}})), [os.path.join('versions', f'{end_id}.json')])
+
+        # A commit rewrites the committed version, the new open version, the branch, and the id info (for the new version's ID)
+        written = written_paths(lambda: db.commit('b,TRUNK'))
+        new_end_id = db._get_branch('b,TRUNK').end
+        self.assertEqual(written, sorted([os.path.join('branches', 'b,TRUNK.json'), 'id_info.json',
+                                          os.path.join('versions', f'{end_id}.json'), os.path.join('versions', f'{new_end_id}.json')]))
+
+    def test_journal(self):
+        db = self._new_database(storage_options=StorageOptions(journal=True))
+        for i in range(3):
+            db.update('b,TRUNK', {'r,ba': {'x': i}})
+            db.commit('b,TRUNK')
+        self.assertFalse(os.path.exists(db._database_path('versions')))
+
+        # Reopening replays the journal on top of the (missing) files
+        self._assert_reloads(db, storage_options=StorageOptions(journal=True))
+
+        # A torn last line, from an append that was interrupted, is ignored, then cut off by the next append
+        journal_path = db._database_path('journal')
+        with open(journal_path, 'a') as file:
+            file.write('{"versions": {"v,z')
+        reopened = self._assert_reloads(db, storage_options=StorageOptions(journal=True))
+        reopened.update('b,TRUNK', {'r,be': {'y': 1}})
+        reopened.commit('b,TRUNK')
+        with open(journal_path) as file:
+            lines = file.read().split('\n')
+        self.assertEqual(lines[-1], '')
+        for line in lines[:-1]:
+            json.loads(line)
+
+        # Compacting folds the journal into the files and empties it
+        reopened.compact()
+        self.assertEqual(os.path.getsize(journal_path), 0)
+        self.assertTrue(os.path.exists(reopened._database_path('versions', f'{reopened._get_branch("b,TRUNK").end}.json')))
+        self._assert_reloads(reopened)
+
+    def test_compact_every(self):
+        db = self._new_database(storage_options=StorageOptions(journal=True, compact_every=3))
+        for i in range(4):
+            db.update('b,TRUNK', {'r,ba': {'x': i}})
+            db.commit('b,TRUNK')
+            self.assertLess(db._journal_entries, 3)
+
+        self.assertTrue(os.path.exists(db._database_path('versions')))
+        self._assert_reloads(db, storage_options=StorageOptions(journal=True))
+
+    def test_packs(self):
+        db = self._new_database()
+        for i in range(3):
+            db.update('b,TRUNK', {'r,ba': {'x': i}, f'r,b{i}': {'y': i}})
+            db.commit('b,TRUNK')
+        db.pack()
+        self.assertEqual(os.listdir(db._database_path('versions')), [])
+        self.assertEqual(len(db._packs), 1)
+
+        # Editing the open version after packing writes a loose file, which takes precedence over the packed one
+        end_id = db._get_branch('b,TRUNK').end
+        db.update('b,TRUNK', {'r,ba': {'x': 'edited'}})
+        self.assertTrue(os.path.exists(db._database_path('versions', f'{end_id}.json')))
+        self.assertIn(end_id, db._packs[0])
+        reopened = self._assert_reloads(db)
+        self.assertEqual(reopened.compute_state('b,TRUNK')['r,ba'].as_raw(), {'x': 'edited'})
+
+        # Repacking moves the loose file into a newer pack, which is read before the older one
+        db.commit('b,TRUNK')
+        db.pack()
+        self.assertEqual(os.listdir(db._database_path('versions')), [])
+        self.assertEqual(len(db._packs), 2)
+        for lazy in [False, True]:
+            self._assert_reloads(db, storage_options=StorageOptions(lazy=lazy))
+
+    def test_lazy_load(self):
+        db = self._new_database()
+        for i in range(20):
+            db.update('b,TRUNK', {f'r,b{i % 5}': {'x': i}})
+            db.commit('b,TRUNK')
+        branch_id = db.new_branch(db._get_version(db._get_branch('b,TRUNK').end).previous, 'side')
+        for i in range(5):
+            db.update(branch_id, {'r,bs': {'y': i}})
+            db.commit(branch_id)
+        for i in range(5):
+            db.update('b,TRUNK', {'r,ba': {'x': i}})
+            db.commit('b,TRUNK')
+
+        # Computing the tip's state only reads the versions it is built from, leaving the side branch's unread
+        lazy_db = Database(db.path, storage_options=StorageOptions(lazy=True))
+        lazy_db.load()
+        unread = set(lazy_db._unloaded_versions)
+        self.assertEqual(unread, set(db._versions._data))
+        end_id = db._get_branch('b,TRUNK').end
+        self.assertEqual(lazy_db.compute_state('b,TRUNK').as_raw(), db.compute_state('b,TRUNK').as_raw())
+        ancestors = db._trace_back(end_id, include_revisions=True)[0]
+        self.assertEqual(unread - set(lazy_db._unloaded_versions), {end_id, *ancestors})
+        self.assertTrue(any(version_id in lazy_db._unloaded_versions for version_id in db._trace_back(db._get_branch(branch_id).end)[0]))
+
+        # Everything else is read as it is needed, and matches an eager load
+        self.assertEqual(self._states(lazy_db), self._states(db))
+
+    def test_parallel_load(self):
+        db = self._new_database()
+        for i in range(10):
+            db.update('b,TRUNK', {f'r,b{i % 4}': {'x': i}})
+            db.commit('b,TRUNK')
+        branch_id = db.new_branch(db._get_version(db._get_branch('b,TRUNK').end).previous, 'side')
+        db.pack()
+        # Some versions packed and some loose, so both are read in parallel
+        for i in range(10):
+            db.update(branch_id, {f'r,s{i % 3}': {'y': i}})
+            db.commit(branch_id)
+
+        serial = self._assert_reloads(db)
+        for threads in [False, True]:
+            parallel = Database(db.path)
+            parallel.load(workers=2, threads=threads)
+            self.assertEqual(parallel._versions._data, serial._versions._data)
+            self.assertEqual(self._states(parallel), self._states(serial))
+
+    def test_convert_database(self):
+        db = self._new_database(storage_options=StorageOptions(blob_threshold=10))
+        db.update('b,TRUNK', {'r,ba': {'x': 1}, 'r,be': {'x': 'a long enough value to be a blob'}})
+        db.commit('b,TRUNK')
+        branch_id = db.new_branch('v,ba', 'branch 2')
+        db.update(branch_id, {'r,ba': {'x': 2}, 'r,bo': {'x': 2}})
+        db.commit(branch_id)
+        db.update('b,TRUNK', {'r,ba': {'x': 3}})
+        db.commit('b,TRUNK')
+        db.start_merge('b,TRUNK', db._get_version(db._get_branch(branch_id).end).previous, {'all': 't'}, {})
+        db.commit('b,TRUNK')
+
+        # Through SQLite and back, every branch's state comes out the same
+        sqlite_path = self._database_path('db.sqlite')
+        database.convert_database(db.path, sqlite_path)
+        converted = Database(sqlite_path)
+        converted.load()
+        self.assertEqual(self._states(converted), self._states(db))
+        converted.close()
+        round_trip_path = self._database_path()
+        database.convert_database(sqlite_path, round_trip_path)
+        round_trip = Database(round_trip_path)
+        round_trip.load()
+        self.assertEqual(self._states(round_trip), self._states(db))
+        self.assertEqual(round_trip._branches._data, db._branches._data)
+
+        # Options for the directory format aren't silently ignored for SQLite
+        for options in [{'journal': True}, {'compact_every': 3}, {'compression_method': 'zlib'}]:
+            with self.assertRaises(YBDBException):
+                Database(sqlite_path, storage_options=StorageOptions(**options))
+
+    def test_transaction_rollback(self):
+        db = Database(None)
+        db.setup()
+        db.update('b,TRUNK', {'r,ba': {'x': 1}})
+        db.commit('b,TRUNK')
+
+        versions_before = deepcopy(db._versions._data)
+        branches_before = deepcopy(db._branches._data)
+        id_info_before = deepcopy(db._id_info._data)
+
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                branch_id = db.new_branch('v,ba', 'branch 2')
+                db.update(branch_id, {'r,ba': {'x': 2}})
+                db.commit(branch_id)
+                raise ValueError()
+
+        self.assertEqual(db._versions._data, versions_before)
+        self.assertEqual(db._branches._data, branches_before)
+        self.assertEqual(db._id_info._data, id_info_before)
+        self.assertEqual(db.compute_state('b,TRUNK'), {'r,ba': {'x': 1}})
+
+        # Only what is edited is copied, not everything read along the way
+        with db.transaction():
+            db.compute_state('b,TRUNK')
+            self.assertEqual(db._transaction_originals, {'versions': {}, 'branches': {}, 'views': {}})
+            db.update('b,TRUNK', {'r,ba': {'x': 3}})
+            self.assertEqual(list(db._transaction_originals['versions']), [db._get_branch('b,TRUNK').end])
+            self.assertEqual(db._transaction_originals['branches'], {})
+
+        # The caches of tip snapshots, blobs, and published snapshots are put back too
+        db = self._new_database(storage_options=StorageOptions(blob_threshold=32), tip_snapshots=True, snapshot_reads=True)
+        db.update('b,TRUNK', {'r,ba': {'bio': 'words ' * 10}})
+        db.commit('b,TRUNK')
+        snapshot = db.snapshot()
+
+        def caches():
+            return (deepcopy(db._tip_snapshots), db._snapshot_lags.copy(), deepcopy(db._snapshots_dirty),
+                    deepcopy(db._unpublished), db._stored_blobs.copy())
+        caches_before = caches()
+
+        # A commit inside the transaction moves the tip snapshot on and adds a blob, which are all put back
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db.update('b,TRUNK', {'r,ba': {'bio': 'other words ' * 10}, 'r,be': {'x': 1}})
+                db.commit('b,TRUNK')
+                self.assertNotEqual(caches(), caches_before)
+                raise ValueError()
+        self.assertEqual(caches(), caches_before)
+        self.assertIs(db.snapshot(), snapshot)
+        self.assertEqual(snapshot.compute_state('b,TRUNK').as_raw(), {'r,ba': {'bio': 'words ' * 10}})
+
+        # The next commit picks up from where the database was before the transaction
+        db.update('b,TRUNK', {'r,bi': {'x': 2}})
+        db.commit('b,TRUNK')
+        self.assertEqual(db.compute_state('b,TRUNK').as_raw(), {'r,ba': {'bio': 'words ' * 10}, 'r,bi': {'x': 2}})
+        self.assertEqual(db.snapshot().compute_state('b,TRUNK').as_raw(), db.compute_state('b,TRUNK').as_raw())
+        self._assert_reloads(db, tip_snapshots=True)
+
+    def test_record_history(self):
+        db = Database(None)
+        db.setup()
+
+        db.update('b,TRUNK', {'r,ba': {'x': 1}, 'r,be': {'x': 1}})
+        db.commit('b,TRUNK')
+        branch_id = db.new_branch('v,ba', 'branch 2')
+        db.update(branch_id, {'r,ba': {'y': 2}})
+        db.commit(branch_id)
+        db.update('b,TRUNK', {'r,be': {'x': 2}})
+        db.commit('b,TRUNK')
+        db.update(branch_id, {'r,ba': None})
+
+        self.assertEqual(db.record_history('r,ba', branch_id), [('v,bo', []), ('v,bi', ['y']), ('v,ba', ['x'])])
+        self.assertEqual(db.record_history('r,ba', 'b,TRUNK'), [('v,ba', ['x'])])
+        self.assertEqual(db.record_history('r,be', 'b,TRUNK'), [('v,be', ['x']), ('v,ba', ['x'])])
+
+        # Only the history back to the oldest version that touched the record is walked
+        for i in range(20):
+            db.update('b,TRUNK', {'r,bi': {'x': i}})
+            db.commit('b,TRUNK')
+        db.update('b,TRUNK', {'r,bo': {'x': 1}})
+        recent_version_id = db.commit('b,TRUNK')
+        walked = []
+        walk_back = db._walk_back
+        with mock.patch.object(db, '_walk_back', lambda *args: (walked.append(step[0]) or step for step in walk_back(*args))):
+            self.assertEqual(db.record_history('r,bo', 'b,TRUNK'), [(recent_version_id, ['x'])])
+        self.assertEqual(walked, [db._get_branch('b,TRUNK').end, recent_version_id])
+
+    def test_projected_state(self):
+        db = Database(None)
+        db.setup()
+
+        db.update('b,TRUNK', {'r,ba': {'x': 1, 'y': 1}, 'r,be': {'x': 1}})
+        db.commit('b,TRUNK')
+        db.update('b,TRUNK', {'r,be': {'y': 2}, 'r,bi': {'y': 3}})
+        db.commit('b,TRUNK')
+
+        self.assertEqual(db.compute_state('b,TRUNK', records=['r,ba']), {'r,ba': {'x': 1, 'y': 1}})
+        self.assertEqual(db.compute_state('b,TRUNK', attributes=['x']), {'r,ba': {'x': 1}, 'r,be': {'x': 1}, 'r,bi': {}})
+        self.assertEqual(db.compute_state('b,TRUNK', records=['r,be', 'r,bo'], attributes=['y']), {'r,be': {'y': 2}})
+
+    def test_parallel_merge(self):
+        db = Database(None, merge_workers=2, merge_chunk_size=1)
+        db.setup()
+
+        # Enough records, created out of order, that a set of them wouldn't happen to iterate in sorted order
+        record_ids = ['r,ba']
+        for _ in range(39):
+            record_ids.append(ids.next_id(record_ids[-1]))
+        random.Random(0).shuffle(record_ids)
+        db.update('b,TRUNK', {record_id: {'x': 1} for record_id in record_ids})
+        db.commit('b,TRUNK')
+        branch_id = db.new_branch('v,ba', 'branch 2')
+        db.update(branch_id, {**{record_id: {'x': 2} for record_id in record_ids[::3]}, record_ids[1]: None, 'r,zo': {'x': 2}})
+        db.commit(branch_id)
+        db.update('b,TRUNK', {**{record_id: {'x': 3} for record_id in record_ids[::2]}, record_ids[4]: {'y': 3}})
+        db.commit('b,TRUNK')
+        db.start_merge('b,TRUNK', 'v,bi', {'all': 't'}, {record_ids[4]: {'all': 'p!'}})
+        db.commit('b,TRUNK')
+
+        parallel_state = db.compute_state('b,TRUNK')
+        db.close()
+        db.merge_workers = None
+        serial_state = db.compute_state('b,TRUNK')
+        self.assertEqual(parallel_state, serial_state)
+        self.assertEqual(list(parallel_state._data.items()), list(serial_state._data.items()))
+        self.assertEqual(list(serial_state._data), sorted(serial_state._data))
+
+    def test_edit_merge_rules(self):
+        db = Database(None)
+        db.setup()
+
+        db.update('b,TRUNK', {'r,ba': {'x': 1, 'y': 1}, 'r,be': {'x': 1}})
+        db.commit('b,TRUNK')
+        branch_id = db.new_branch('v,ba', 'branch 2')
+        db.update(branch_id, {'r,ba': {'x': 2, 'y': 2}, 'r,be': {'x': 2}})
+        db.commit(branch_id)
+        db.update('b,TRUNK', {'r,ba': {'x': 3, 'y': 3}, 'r,be': {'x': 3}})
+        db.commit('b,TRUNK')
+        db.start_merge('b,TRUNK', 'v,bi', {'all': 'p'}, {})
+        merge_version_id = db._get_branch('b,TRUNK').end
+        self.assertEqual(db.compute_state('b,TRUNK')['r,ba'], {'x': 3, 'y': 3})
+
+        db.edit_merge(merge_version_id, {'all': 'p'}, {'r,ba': {'all': 'p', 'fields': {'y': 't'}}})
+        self.assertEqual(db.compute_state('b,TRUNK')['r,ba'], {'x': 3, 'y': 2})
+        db.edit_merge(merge_version_id, {'all': 't'}, {'r,ba': {'all': 'p', 'fields': {'y': 't'}}})
+        state = db.compute_state('b,TRUNK')
+        self.assertEqual(state['r,ba'], {'x': 3, 'y': 2})
+        self.assertEqual(state['r,be'], {'x': 2})
+
+        db._merge_rule_tables = {}
+        self.assertEqual(state, db.compute_state('b,TRUNK'))
+
+
+    def test_delta_blocks(self):
+        db = Database(None)
+        db.setup()
+
+        expected_states = []
+        for i in range(12):
+            if i == 5:
+                db.update('b,TRUNK', {'r,ba': None, 'r,be': {'x': i}})
+            elif i == 6:
+                db.update('b,TRUNK', {'r,ba': {'y': i}})
+            else:
+                db.update('b,TRUNK', {'r,ba': {'x': i}, 'r,bi': {'x': i}})
+            db.commit('b,TRUNK')
+            expected_states.append(db.compute_state(db._get_version(db._get_branch('b,TRUNK').end).previous).as_raw())
+        self.assertEqual(expected_states[6]['r,ba'], {'y': 6})
+        self.assertEqual(expected_states[11]['r,ba'], {'x': 11, 'y': 6})
+
+        # Insert a revision partway along, and select a version from before the run
+        version_ids = db._ancestry(db._to_version_id('b,TRUNK', allow_open=False))
+        revision_id = db.setup_revision(version_ids[4])
+        self.assertEqual(db.compute_state('b,TRUNK').as_raw(), expected_states[11])
+        db.revise(revision_id, version_ids[9])
+        db.update('b,TRUNK', {})
+        db.commit('b,TRUNK')
+
+        end_id = db._to_version_id('b,TRUNK', allow_open=False)
+        state = db.compute_state(end_id)
+        db._delta_blocks = {}
+        self.assertEqual(state.as_raw(), db.compute_state(end_id).as_raw())
+        self.assertNotEqual(state.as_raw(), expected_states[11])
+
+
+    def test_tip_snapshots(self):
+        db = Database(None, tip_snapshots=True)
+        db.setup()
+        reference = Database(None)
+        reference.setup()
+
+        for i in range(6):
+            deltas = {'r,ba': {'x': i}, 'r,be': None if i % 2 else {'y': {'z': i}}}
+            for opened_db in [db, reference]:
+                opened_db.update('b,TRUNK', deltas)
+                opened_db.commit('b,TRUNK')
+        branch_id = db.new_branch('v,bo', 'branch 2')
+        reference.new_branch('v,bo', 'branch 2')
+        for opened_db in [db, reference]:
+            opened_db.update(branch_id, {'r,bi': {'x': 1}})
+            opened_db.commit(branch_id)
+            opened_db.update('b,TRUNK', {'r,ba': None})
+
+        self.assertEqual(db._tip_snapshots['b,TRUNK'][0], db._to_version_id('b,TRUNK', allow_open=False))
+        self.assertIsNotNone(db._reverse_delta(db._tip_snapshots['b,TRUNK'][0]))
+
+        # A version further back than a stored snapshot can lag is rebuilt rather than undone one commit at a time
+        first_id = db._to_version_id(branch_id, allow_open=False)
+        for opened_db in [db, reference]:
+            for i in range(database.snapshot_lag_limit + 1):
+                opened_db.update(branch_id, {'r,bi': {'x': i}})
+                opened_db.commit(branch_id)
+        with mock.patch.object(db, '_reverse_delta', wraps=db._reverse_delta) as reverse_delta:
+            self.assertEqual(db.compute_state(first_id).as_raw(), reference.compute_state(first_id).as_raw())
+        reverse_delta.assert_not_called()
+        for version_id in reference._versions:
+            self.assertEqual(db.compute_state(version_id).as_raw(), reference.compute_state(version_id).as_raw())
+        for id in ['b,TRUNK', branch_id]:
+            self.assertEqual(db.compute_state(id).as_raw(), reference.compute_state(id).as_raw())
+            self.assertEqual(db.compute_state(id, records=['r,ba'], attributes=['x']).as_raw(),
+                             reference.compute_state(id, records=['r,ba'], attributes=['x']).as_raw())
+
+    def test_tip_snapshot_writes(self):
+        db = self._new_database(tip_snapshots=True, collect_metrics=True)
+
+        def snapshot_writes(edit):
+            with mock.patch('database._write_json', wraps=database._write_json) as write_json:
+                edit()
+            return len([call for call in write_json.call_args_list if os.path.basename(os.path.dirname(call.args[0])) == 'snapshots'])
+
+        # Each commit applies its own deltas to the snapshot, which is only written out every snapshot_lag_limit commits
+        def commit_changes(branch_id, count):
+            for i in range(count):
+                db.update(branch_id, {f'r,b{i % 3}': {'x': i}})
+                db.commit(branch_id)
+        commit_count = 2 * database.snapshot_lag_limit + 3
+        self.assertEqual(snapshot_writes(lambda: commit_changes('b,TRUNK', commit_count)), 2)
+
+        # A new branch starts from the snapshot of the one it came from, and merging it back doesn't rebuild the state either
+        branch_id = db.new_branch(db._to_version_id('b,TRUNK', allow_open=False), 'branch 2')
+        commit_changes(branch_id, 2)
+        commit_changes('b,TRUNK', 1)
+        # The snapshot is moved once the commit is saved, so it's stored with the save after that
+        def merge():
+            db.start_merge('b,TRUNK', db._to_version_id(branch_id, allow_open=False), {'all': 't'}, {})
+            db.commit('b,TRUNK')
+        self.assertEqual(snapshot_writes(merge), 0)
+        self.assertEqual(snapshot_writes(db.save), 1)
+        self.assertEqual(db.metrics()['counters'].get('snapshot rebuilds', 0), 0)
+
+        # A snapshot that can't be moved is dropped without undoing the commit, and read back from its stored copy afterwards
+        db.update('b,TRUNK', {'r,by': {'x': 1}})
+        with mock.patch('database.add_delta', side_effect=RuntimeError('snapshot failed')):
+            failed_id = db.commit('b,TRUNK')
+        self.assertEqual(db.metrics()['counters']['snapshot failures'], 1)
+        self.assertNotIn('b,TRUNK', db._tip_snapshots)
+        saved = Database(db.path)
+        saved.load()
+        self.assertEqual(saved._get_version(failed_id).next, db._to_version_id('b,TRUNK'))
+
+        # After reopening, the stored snapshot catches up through the commits since it was written
+        commit_changes('b,TRUNK', 3)
+        reopened = self._assert_reloads(db, tip_snapshots=True, collect_metrics=True)
+        self.assertEqual(reopened._tip_snapshot('b,TRUNK')[0], db._to_version_id('b,TRUNK', allow_open=False))
+        reopened.update('b,TRUNK', {'r,bz': {'x': 1}})
+        reopened.commit('b,TRUNK')
+        self.assertEqual(reopened.metrics()['counters'].get('snapshot rebuilds', 0), 0)
+        reference = Database(db.path)
+        reference.load()
+        for version_id in reference._versions._data:
+            if db._version_type(reference._get_version(version_id)) != database.VersionType.revision:
+                self.assertEqual(reopened.compute_state(version_id).as_raw(), reference.compute_state(version_id).as_raw())
+
+    def test_async_database(self):
+        db = Database(None)
+        db.setup()
+        async_db = AsyncDatabase(db)
+
+        computations = []
+        compute_state = db.compute_state
+        def counting_compute_state(*args):
+            computations.append(args)
+            return compute_state(*args)
+        db.compute_state = counting_compute_state
+
+        async def edit_and_read():
+            await async_db.update('b,TRUNK', {'r,ba': {'x': 1}})
+            await async_db.commit('b,TRUNK')
+            first_states = await asyncio.gather(*[async_db.compute_state('b,TRUNK') for _ in range(5)])
+            await async_db.update('b,TRUNK', {'r,ba': {'x': 2}})
+            second_state = await async_db.compute_state('b,TRUNK')
+            await async_db.close()
+            return first_states, second_state
+
+        first_states, second_state = asyncio.run(edit_and_read())
+        self.assertEqual(len(computations), 2)
+        self.assertTrue(all(state.as_raw() == {'r,ba': {'x': 1}} for state in first_states))
+        self.assertEqual(len({id(state) for state in first_states}), 5)
+        self.assertEqual(second_state.as_raw(), {'r,ba': {'x': 2}})
+
+    def test_save_conflicts(self):
+        path = self._database_path('db.sqlite')
+        Database(path).setup()
+        first = Database(path)
+        first.load()
+        second = Database(path)
+        second.load()
+
+        first.update('b,TRUNK', {'r,ba': {'x': 1}})
+        first.commit('b,TRUNK')
+        # second loaded before first saved, so saving would lose first's commit
+        with self.assertRaises(ConflictError):
+            second.update('b,TRUNK', {'r,be': {'x': 2}})
+
+        second.load()
+        second.retry_on_conflict(lambda db: (db.update('b,TRUNK', {'r,be': {'x': 2}}), db.commit('b,TRUNK')))
+        first.retry_on_conflict(lambda db: (db.update('b,TRUNK', {'r,bi': {'x': 3}}), db.commit('b,TRUNK')))
+
+        reader = Database(path)
+        reader.load()
+        self.assertEqual(reader.compute_state('b,TRUNK').as_raw(), {'r,ba': {'x': 1}, 'r,be': {'x': 2}, 'r,bi': {'x': 3}})
+        for opened_db in [first, second, reader]:
+            opened_db.close()
+
+    def test_directory_conflicts(self):
+        db = self._new_database()
+        path = db.path
+        db.update('b,TRUNK', {'r,ba': {'x': 1}})
+        db.commit('b,TRUNK')
+        epoch_path = db._database_path('epoch')
+        epoch = database.locks.read_epoch(epoch_path)
+        self.assertEqual(epoch % 2, 0)
+
+        # A journal append moves the epoch on once, without making it odd first
+        journaled = Database(path, storage_options=StorageOptions(journal=True))
+        journaled.load()
+        with mock.patch('locks.write_epoch', wraps=database.locks.write_epoch) as write_epoch:
+            journaled.update('b,TRUNK', {'r,ba': {'x': 2}})
+        self.assertEqual([call.args[1] for call in write_epoch.call_args_list], [epoch + 2])
+        journaled.compact()
+        epoch = database.locks.read_epoch(epoch_path)
+
+        # While another process holds the lock with the epoch odd, loading waits for it, then gives up
+        with database.locks.exclusive_lock(db._database_path('lock')), \
+             mock.patch('database.time.sleep') as sleep:
+            database.locks.write_epoch(epoch_path, epoch + 1)
+            with self.assertRaises(ConflictError):
+                Database(path).load()
+            self.assertEqual(sleep.call_count, database.load_attempts - 1)
+            self.assertEqual(sleep.call_args_list[1].args[0], 2 * sleep.call_args_list[0].args[0])
+
+            # If the save finishes while loading waits, the next read goes ahead
+            sleep.reset_mock()
+            sleep.side_effect = lambda seconds: database.locks.write_epoch(epoch_path, epoch + 2)
+            reader = Database(path)
+            reader.load()
+            self.assertEqual(sleep.call_count, 1)
+            self.assertEqual(reader._epoch, epoch + 2)
+
+        # An odd epoch with no process holding the lock is left by an interrupted save, which the next save finishes
+        database.locks.write_epoch(epoch_path, epoch + 3)
+        recovered = Database(path)
+        recovered.load()
+        self.assertEqual(recovered.compute_state('b,TRUNK').as_raw(), {'r,ba': {'x': 2}})
+        recovered.update('b,TRUNK', {'r,be': {'x': 3}})
+        recovered.commit('b,TRUNK')
+        # Two saves, by two each, after the interrupted one is rounded up to even
+        self.assertEqual(database.locks.read_epoch(epoch_path), epoch + 8)
+        self._assert_reloads(recovered)
+
+    def test_snapshot_reads(self):
+        db = Database(None, snapshot_reads=True, tip_snapshots=True)
+        db.setup()
+        db.update('b,TRUNK', {'r,ba': {'x': 1}})
+        db.commit('b,TRUNK')
+
+        snapshot = db.snapshot()
+        states = []
+        reader = threading.Thread(target=lambda: states.append(snapshot.compute_state('b,TRUNK').as_raw()))
+        reader.start()
+        db.update('b,TRUNK', {'r,ba': {'x': 2}, 'r,be': {'x': 3}})
+        db.commit('b,TRUNK')
+        reader.join()
+
+        # The snapshot still shows the database as it was when it was taken
+        self.assertEqual(states, [{'r,ba': {'x': 1}}])
+        self.assertEqual(snapshot.compute_state('b,TRUNK').as_raw(), {'r,ba': {'x': 1}})
+        self.assertEqual(db.snapshot().compute_state('b,TRUNK').as_raw(), db.compute_state('b,TRUNK').as_raw())
+        with self.assertRaises(TypeError):
+            snapshot.update('b,TRUNK', {'r,bi': {'x': 4}})
+
+    def test_blob_store(self):
+        path = self._database_path('db.sqlite')
+        db = Database(path, storage_options=StorageOptions(blob_threshold=32))
+        db.setup()
+        record = {'name': 'a name long enough to go in a blob', 'year': 2024}
+        for record_id in ['r,ba', 'r,be', 'r,ba']:
+            db.update('b,TRUNK', {record_id: record, 'r,bi': {'n': record_id}})
+            db.commit('b,TRUNK')
+
+        # The same record body is stored once, and the small deltas stay inline
+        self.assertEqual(len(db._storage.list_ids('blobs')), 1)
+        self.assertEqual(db.collect_blobs(), 0)
+
+        reloaded = Database(path)
+        reloaded.load()
+        for version_id in db._versions._data:
+            self.assertEqual(reloaded.compute_state(version_id).as_raw(), db.compute_state(version_id).as_raw())
+        for opened_db in [db, reloaded]:
+            opened_db.close()
+
+    def test_compression(self):
+        data = {'id': 'v,ba', 'change': {'deltas': {'r,ba': {'bio': 'words ' * 200}}}}
+        for method in [None] + compression.methods:
+            for level in [None, 1]:
+                stored = compression.dumps(data, method, level, indent=4)
+                # Compressed and uncompressed data are told apart without being told which is which
+                self.assertEqual(compression.loads(stored), data)
+                if method is not None:
+                    self.assertLess(len(stored), len(compression.dumps(data, None)))
+
+    def test_compressed_reload(self):
+        db = self._new_database(storage_options=StorageOptions(compression_method='zlib', blob_threshold=32))
+        for i in range(4):
+            db.update('b,TRUNK', {'r,ba': {'bio': f'words {i} ' * 20}, f'r,b{i}': {'x': i}})
+            db.commit('b,TRUNK')
+        db.pack()
+
+        # Packed zlib records, then loose lzma files and loose uncompressed files over them
+        for method in ['lzma', None]:
+            opened_db = Database(db.path, storage_options=StorageOptions(compression_method=method, blob_threshold=32))
+            opened_db.load()
+            for i in range(2):
+                opened_db.update('b,TRUNK', {'r,ba': {'bio': f'{method} words {i} ' * 20}})
+                opened_db.commit('b,TRUNK')
+            end_id = opened_db._get_branch('b,TRUNK').end
+            with open(opened_db._database_path('versions', f'{opened_db._get_version(end_id).previous}.json'), 'rb') as file:
+                self.assertEqual(file.read(1) == b'{', method is None)
+        self.assertNotEqual(os.listdir(db._database_path('versions')), [])
+        self.assertNotEqual(os.listdir(db._database_path('packs')), [])
+
+        for lazy in [False, True]:
+            reopened = self._assert_reloads(opened_db, storage_options=StorageOptions(lazy=lazy))
+            self.assertEqual(reopened.compute_state('b,TRUNK')['r,ba'].bio, 'None words 1 ' * 20)
+
+    def test_gc(self):
+        db = self._new_database()
+        db.update('b,TRUNK', {'r,ba': {'x': 1}})
+        trunk_version_id = db.commit('b,TRUNK')
+        db.update('b,TRUNK', {'r,be': {'x': 1}})
+        revised_id = db.commit('b,TRUNK')
+        revision_id = db.setup_revision(revised_id)
+        branch_id = db.new_branch(trunk_version_id, 'draft')
+        db.update(branch_id, {'r,ba': {'x': 2}})
+        draft_version_id = db.commit(branch_id)
+        draft_version_ids = [id for id, data in db._versions._data.items() if data['branch'] == branch_id]
+
+        # The revision selects the draft for one commit, and then something else, which supersedes it
+        db.revise(revision_id, draft_version_id)
+        db.update('b,TRUNK', {'r,bi': {'x': 1}})
+        selecting_id = db.commit('b,TRUNK')
+        db.revise(revision_id, trunk_version_id)
+        db.update('b,TRUNK', {'r,bi': {'x': 2}})
+        db.commit('b,TRUNK')
+        selecting_state = db.compute_state(selecting_id).as_raw()
+        self._abandon_branch(db, branch_id)
+
+        # Nothing selects the draft now, but the commit that did still needs it, so it's archived rather than removed
+        removed, archived = db.gc()
+        self.assertIn(draft_version_id, archived)
+        self.assertEqual(sorted(removed + archived), sorted(draft_version_ids))
+        self.assertIsNone(db._get_version(trunk_version_id).branches_out)
+        self.assertEqual(db.compute_state(selecting_id).as_raw(), selecting_state)
+        self.assertEqual(selecting_state['r,ba'], {'x': 2})
+        self.assertEqual(db.gc(), ([], []))
+
+        # An abandoned branch that nothing ever selected is removed, even where there's no archive
+        db = Database(None)
+        db.setup()
+        db.update('b,TRUNK', {'r,ba': {'x': 1}})
+        trunk_version_id = db.commit('b,TRUNK')
+        branch_id = db.new_branch(trunk_version_id, 'draft')
+        db.update(branch_id, {'r,ba': {'x': 2}})
+        db.commit(branch_id)
+        draft_version_ids = [id for id, data in db._versions._data.items() if data['branch'] == branch_id]
+        self._abandon_branch(db, branch_id)
+        self.assertEqual(sorted(db.gc()[0]), sorted(draft_version_ids))
+        self.assertEqual(db.compute_state('b,TRUNK').as_raw(), {'r,ba': {'x': 1}})
+
+    def test_archive(self):
+        db = self._new_database(collect_metrics=True)
+        trunk_version_ids = []
+        for i in range(8):
+            db.update('b,TRUNK', {'r,ba': {'x': i}})
+            trunk_version_ids.append(db.commit('b,TRUNK'))
+        branch_id = db.new_branch(trunk_version_ids[0], 'draft')
+        db.update(branch_id, {'r,ba': {'x': 'draft'}})
+        db.commit(branch_id)
+        draft_version_ids = [id for id, data in db._versions._data.items() if data['branch'] == branch_id]
+        self._abandon_branch(db, branch_id)
+        # A view of an old version keeps it and the versions just before it out of the archive
+        db._views['w,ba'] = {'id': 'w,ba', 'version': trunk_version_ids[3]}
+        states = self._states(db)
+
+        removed, archived = db.gc(archive_unreachable=True, archive_depth=2)
+        self.assertEqual(removed, [])
+        self.assertTrue(set(draft_version_ids) <= set(archived))
+        for index in [0, 4, 5]:
+            self.assertIn(trunk_version_ids[index], archived)
+        for index in [1, 2, 3, 6, 7]:
+            self.assertNotIn(trunk_version_ids[index], archived)
+        for version_id in archived:
+            self.assertNotIn(version_id, db._versions._data)
+            self.assertFalse(os.path.exists(db._database_path('versions', f'{version_id}.json')))
+
+        # Collecting garbage again only reads the archive's links, not the archived versions
+        reopened = Database(db.path, collect_metrics=True, snapshot_reads=True)
+        reopened.load()
+        reopened._views['w,ba'] = {'id': 'w,ba', 'version': trunk_version_ids[3]}
+        self.assertEqual(reopened.gc(archive_unreachable=True, archive_depth=2), ([], []))
+        self.assertEqual(reopened.metrics()['counters'].get('pack records read', 0), 0)
+
+        # Without archive_unreachable, the archived versions nothing can reach are removed from the archive
+        # (though not from what a snapshot taken before then reads)
+        snapshot = reopened.snapshot()
+        removed, archived = reopened.gc(archive_depth=2)
+        self.assertEqual(sorted(removed), sorted(draft_version_ids))
+        self.assertEqual(archived, [])
+        for version_id in draft_version_ids:
+            self.assertNotIn(version_id, reopened._archives[0])
+        self.assertIsNone(reopened._get_version(trunk_version_ids[0]).branches_out)
+
+        # Archived versions are read when they're used, and states are unchanged
+        self.assertEqual(self._states(reopened), {branch_id: state for branch_id, state in states.items() if branch_id in reopened._branches._data})
+        self.assertEqual(reopened.compute_state(trunk_version_ids[0]).as_raw(), {'r,ba': {'x': 0}})
+
+        # A snapshot reads archived versions through its own handles on the archive, which reloading or closing the database leaves open
+        reopened.load()
+        reopened.close()
+        self.assertEqual(snapshot.compute_state(draft_version_ids[-1]).as_raw(), {'r,ba': {'x': 'draft'}})
+
+    def test_metrics(self):
+        log_path = self._database_path('metrics.jsonl')
+        db = Database(self._database_path('db.sqlite'), metrics_log=log_path)
+        db.setup()
+        for i in range(4):
+            db.update('b,TRUNK', {'r,ba': {'x': i}})
+            db.commit('b,TRUNK')
+        db.compute_state('b,TRUNK')
+
+        metrics = db.metrics(reset=True)
+        self.assertEqual(metrics['timings']['commit']['calls'], 4)
+        self.assertEqual(sum(metrics['timings']['compute_state']['histogram']), metrics['timings']['compute_state']['calls'])
+        self.assertGreater(metrics['counters']['versions replayed'], 0)
+        self.assertEqual(db.metrics()['counters'], {})
+        db.close()
+
+        with open(log_path) as file:
+            self.assertIn('commit', [json.loads(line)['method'] for line in file])
+
+        with self.assertRaises(YBDBException):
+            Database(None).metrics()
+
+    def test_tracing(self):
+        db = Database(None)
+        db.setup()
+        for i in range(3):
+            db.update('b,TRUNK', {'r,ba': {'x': i}})
+            db.commit('b,TRUNK')
+        branch_id = db.new_branch(db._to_version_id('b,TRUNK', allow_open=False), 'branch 2')
+        db.update(branch_id, {'r,be': {'x': 1}})
+        db.commit(branch_id)
+        db.update('b,TRUNK', {'r,bi': {'x': 1}})
+        db.commit('b,TRUNK')
+        db.start_merge('b,TRUNK', db._to_version_id(branch_id, allow_open=False), {'all': 't'}, {})
+        db.commit('b,TRUNK')
+
+        trace_path = self._database_path('trace.json')
+        with db.tracing(trace_path):
+            db.compute_state('b,TRUNK')
+        with open(trace_path) as file:
+            events = {event['name']: event for event in json.load(file)['traceEvents']}
+
+        def assert_within(inner, outer):
+            self.assertGreaterEqual(inner['ts'], outer['ts'])
+            self.assertLessEqual(inner['ts'] + inner['dur'], outer['ts'] + outer['dur'])
+
+        compute_state = events['compute_state']
+        self.assertEqual(compute_state['args'], {'id': 'b,TRUNK', 'records': 3})
+        # Spans within compute_state start and end within it, and finding a merge's LCA is part of the merge
+        for name in ['_trace_back', 'add_deltas', 'merge']:
+            assert_within(events[name], compute_state)
+        assert_within(events['_find_LCA'], events['merge'])
+        # Tracing was only on for the with block
+        self.assertIsNone(db._tracer)
+
+    def test_generate_history(self):
+        settings = {'records': 20, 'branches': 2, 'changes_per_branch': 6, 'merges': 1, 'revisions': 1, 'field_size': 30}
+        dbs = [Database(None), Database(None)]
+        for db in dbs:
+            db.setup()
+        history = benchmark.generate_history(dbs[0], **settings)
+        self.assertEqual(benchmark.generate_history(dbs[1], **settings), history)
+
+        self.assertEqual([len(history[key]) for key in ['branches', 'merges', 'revisions']], [2, 1, 1])
+        trunk_state = dbs[0].compute_state('b,TRUNK').as_raw()
+        self.assertEqual(len(trunk_state), 20)
+        self.assertEqual(dbs[1].compute_state('b,TRUNK').as_raw(), trunk_state)
+
+    def test_time_index(self):
+        db = Database(None)
+        db.setup()
+        trunk_version_ids = []
+        for i in range(3):
+            db.update('b,TRUNK', {'r,ba': {'x': i}})
+            trunk_version_ids.append(db.commit('b,TRUNK'))
+        timestamps = [db._get_version(version_id).timestamp for version_id in trunk_version_ids]
+
+        self.assertEqual(db.compute_state_at('b,TRUNK', timestamps[1]).as_raw(), {'r,ba': {'x': 1}})
+        with self.assertRaises(YBDBException):
+            db.version_at('b,TRUNK', db._get_version(ids.root_version_id).timestamp - 1)
+
+        # The index built above is kept up to date by later commits
+        branch_id = db.new_branch(trunk_version_ids[-1], 'branch')
+        self.assertEqual(db.version_at(branch_id, timestamps[-1]), trunk_version_ids[-1])
+        db.update(branch_id, {'r,ba': {'x': 3}})
+        branch_version_id = db.commit(branch_id)
+        end_timestamp = db._get_version(branch_version_id).timestamp
+
+        self.assertEqual(db.versions_between(timestamps[1], end_timestamp), trunk_version_ids[1:] + [branch_version_id])
+        self.assertEqual(db.versions_between(timestamps[1], end_timestamp, 'b,TRUNK'), trunk_version_ids[1:])
+        time_index = db._time_index
+        db._build_time_index()
+        self.assertEqual(db._time_index, time_index)
+
+        # A branch that starts from a revision started from the version the revision follows, which is the last one with a timestamp
+        revision_id = db.setup_revision(trunk_version_ids[0])
+        revision_branch_id = db.new_branch(revision_id, 'from revision')
+        self.assertEqual(db.version_at(revision_branch_id, timestamps[0]), trunk_version_ids[0])
+
+    def test_log(self):
+        db = Database(None)
+        db.setup()
+        benchmark.generate_history(db, records=10, branches=2, changes_per_branch=5, merges=1, revisions=1, field_size=10)
+        ancestry = db._ancestry(db._get_version(db._get_branch('b,TRUNK').end).previous)
+
+        pages = []
+        page, cursor = db.log('b,TRUNK', 4)
+        pages.append(page)
+        # Commits after the first page don't change the pages after it
+        db.update('b,TRUNK', {'r,ba': {'x': 1}})
+        db.commit('b,TRUNK')
+        while cursor is not None:
+            page, cursor = db.log('b,TRUNK', 4, cursor)
+            pages.append(page)
+
+        self.assertEqual([version_id for page in pages for version_id in page], ancestry)
+        self.assertTrue(all(0 < len(page) <= 4 for page in pages))
+
+        # A cursor only continues the log it came from
+        page, cursor = db.log('b,TRUNK', 4)
+        with self.assertRaises(YBDBException):
+            db.log(page[0], 4, cursor)
+
+        # Changing the version graph drops the walks kept going, so the next page walks the new graph
+        db.setup_revision(page[-1])
+        self.assertEqual(db._log_walks, {})
+        next_page, _ = db.log('b,TRUNK', 4, cursor)
+        self.assertEqual(next_page, db._ancestry(page[0])[4:8])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -155,9 +155,10 @@ def as_raw(data):
 
 class JSONDict(JSONValue):
     # Need this to prevent getattr from recurring infinitely
-    reserved_names = ['_type_name', '_template', '_template_value', '_any_keys', '_data', '_callback', '_static']
+    reserved_names = ['_type_name', '_template', '_template_value', '_any_keys', '_data', '_callback', '_before_change', '_static']
 
-    def __init__(self, type_name: str, template: Optional[dict], data: dict, callback: Optional[Callable] = None, static: bool = False):
+    def __init__(self, type_name: str, template: Optional[dict], data: dict, callback: Optional[Callable] = None, static: bool = False,
+                 before_change: Optional[Callable] = None):
         self._type_name: str = type_name
 
         if isinstance(template, list) and len(template) > 1:
@@ -191,6 +192,8 @@ class JSONDict(JSONValue):
 
         self._data: dict = data
         self._callback = callback
+        # Called just before each edit, while the data is still as it was
+        self._before_change = before_change
         self._static = static
 
         self._type_check()
@@ -252,6 +255,11 @@ class JSONDict(JSONValue):
         if self._static:
             raise TypeError('Cannot edit a static JSONDict')
 
+    def _start_change(self) -> None:
+        self._check_static()
+        if self._before_change is not None:
+            self._before_change()
+
     def make_static(self):
         self._static = True
     
@@ -305,6 +313,7 @@ class JSONDict(JSONValue):
         if name in JSONDict.reserved_names:
             super().__delattr__(name)
         else:
+            name = underscores_to_spaces(name)
             self.__delitem__(name)
     
     def __getitem__(self, name: str) -> Value:
@@ -332,13 +341,13 @@ class JSONDict(JSONValue):
             if isinstance(template_value, dict) or ((template_value is None or _could_be_dict(template_value)) and isinstance(data_value, dict)):
                 if template_value == {}:
                     template_value = None
-                return JSONDict(self._element_type_name(name), template_value, data_value, callback=self._callback, static=self._static)
+                return JSONDict(self._element_type_name(name), template_value, data_value, callback=self._callback, static=self._static, before_change=self._before_change)
             elif _is_list(template_value) or ((template_value is None or _could_be_list(template_value)) and isinstance(data_value, list)):
                 if template_value is None or template_value == []:
                     item_template = None
                 else:
                     item_template = template_value[0]
-                return JSONList(self._element_type_name(name), item_template, data_value, callback=self._callback, static=self._static)
+                return JSONList(self._element_type_name(name), item_template, data_value, callback=self._callback, static=self._static, before_change=self._before_change)
             # Otherwise just return the raw value
             else:
                 return data_value
@@ -350,7 +359,7 @@ class JSONDict(JSONValue):
         return name in self._data and self._data[name] is not None
     
     def __setitem__(self, name: str, value: Value) -> None:
-        self._check_static()
+        self._start_change()
         self._check_name(name)
         value = as_raw(value)
  
@@ -377,13 +386,13 @@ class JSONDict(JSONValue):
         self._do_callback()
     
     def __delitem__(self, name: str) -> None:
-        self._check_static()
+        self._start_change()
         self._check_name(name)
         del self._data[name]
         self._do_callback()
     
     def set_data(self, new_data: dict) -> None:
-        self._check_static()
+        self._start_change()
         """Sets the data of this object to new data"""
 
         # First try creating a new object with this data. If the type check fails, then this object's data will not be impacted.
@@ -428,7 +437,7 @@ class JSONDict(JSONValue):
         return self.as_raw().__repr__()
     
     def copy(self) -> 'JSONDict':
-        return JSONDict(self._type_name, deepcopy(self._template), deepcopy(self._data), callback=self._callback, static=self._static)
+        return JSONDict(self._type_name, deepcopy(self._template), deepcopy(self._data), callback=self._callback, static=self._static, before_change=self._before_change)
     
     def new(self, callback=None) -> 'JSONDict':
         """Create a new empty, mutable JSONDict with the same type name and template"""
@@ -440,7 +449,8 @@ class JSONDict(JSONValue):
 
 
 class JSONList(JSONValue):
-    def __init__(self, type_name: str, item_template: RawValue, data: list, callback: Optional[Callable] = None, static: bool = False):
+    def __init__(self, type_name: str, item_template: RawValue, data: list, callback: Optional[Callable] = None, static: bool = False,
+                 before_change: Optional[Callable] = None):
         self._type_name: str = type_name
 
         # TODO: I had this here to require all elements of a list to be the same thing. But I don’t think this is actually what I want. But why did I do it then?
@@ -465,6 +475,8 @@ class JSONList(JSONValue):
         self._data: list = data
         self._item_type_name: str = f'(item of {self._type_name})'
         self._callback = callback
+        # Called just before each edit, while the data is still as it was
+        self._before_change = before_change
         self._static = static
 
         self._type_check()
@@ -493,6 +505,11 @@ class JSONList(JSONValue):
     def _check_static(self):
         if self._static:
             raise TypeError('Cannot edit a static JSONList')
+
+    def _start_change(self) -> None:
+        self._check_static()
+        if self._before_change is not None:
+            self._before_change()
     
     def make_static(self):
         self._static = True
@@ -509,14 +526,14 @@ class JSONList(JSONValue):
             dict_template = self._item_template
             if dict_template == {}:
                 dict_template = None
-            return JSONDict(name, dict_template, item, callback=self._callback, static=self._static)
+            return JSONDict(name, dict_template, item, callback=self._callback, static=self._static, before_change=self._before_change)
         elif _is_list(self._item_template) or ((self._item_template is None or _could_be_list(self._item_template)) and isinstance(item, list)):
             if self._item_template is None or self._item_template == []:
                 item_template = None
             else:
                 self._item_template = cast(list, self._item_template)
                 item_template = self._item_template[0]
-            return JSONList(name, item_template, item, callback=self._callback, static=self._static)
+            return JSONList(name, item_template, item, callback=self._callback, static=self._static, before_change=self._before_change)
          # Otherwise just return the raw value
         else:
             return item
@@ -539,19 +556,19 @@ class JSONList(JSONValue):
             self._callback()
 
     def __setitem__(self, index: int, value: Value) -> None:
-        self._check_static()
+        self._start_change()
         value = as_raw(value)
         self._type_check_item(value)
         self._data[index] = value
         self._do_callback()
     
     def __delitem__(self, index: int) -> None:
-        self._check_static()
+        self._start_change()
         del self._data[index]
         self._do_callback()
     
     def append(self, value: Value) -> None:
-        self._check_static()
+        self._start_change()
         value = as_raw(value)
 
         self._type_check_item(value)
@@ -559,14 +576,15 @@ class JSONList(JSONValue):
         self._do_callback()
 
     def remove(self, value: Value) -> None:
-        self._check_static()
+        self._start_change()
         value = as_raw(value)
         
         if value in self._data:
             self._data.remove(value)
+            self._do_callback()
     
     def insert(self, index: int, value: Value) -> None:
-        self._check_static()
+        self._start_change()
         value = as_raw(value)
 
         self._type_check_item(value)
@@ -576,7 +594,7 @@ class JSONList(JSONValue):
     def set_data(self, new_data: list) -> None:
         """Sets the data of this object to new data"""
 
-        self._check_static()
+        self._start_change()
         
         # First try creating a new object with this data. If the type check fails, then this object's data will not be impacted.
         JSONList(self._type_name, self._item_template, new_data)
@@ -615,7 +633,7 @@ class JSONList(JSONValue):
         return self.__repr__()
 
     def copy(self) -> 'JSONList':
-        return JSONList(self._type_name, deepcopy(self._item_template), deepcopy(self._data), callback=self._callback, static=self._static)
+        return JSONList(self._type_name, deepcopy(self._item_template), deepcopy(self._data), callback=self._callback, static=self._static, before_change=self._before_change)
     
     def new(self, callback=None) -> 'JSONList':
         """Create a new empty, mutable JSONList with the same type name and template"""
@@ -687,7 +705,7 @@ def add_delta(old: JSONDict, delta: JSONDict) -> JSONDict:
         # Need to check "name in new" to distinguish between a nonexistent attribute (Which returns None) and an attribute with value None
         if delta_value is None and name in new:
             del new[name]
-        elif isinstance(delta_value, JSONDict):
+        elif isinstance(delta_value, JSONDict) and name in new:
             old_value = cast(JSONDict, new[name])
             new[name] = add_delta(old_value, delta_value)
         else:
@@ -696,6 +714,76 @@ def add_delta(old: JSONDict, delta: JSONDict) -> JSONDict:
     return new
 
 
+class ReplacedValue:
+    """A value in a composed delta that takes the place of whatever was there before, rather than being merged into it.
+
+    Plain deltas have no way to say this: a dict in a delta is merged into an existing dict.
+    But composing "delete this record" with "create this record" has to replace the old record outright.
+    """
+
+    def __init__(self, value: dict):
+        self.value = value
+
+
+def _delta_literal(value: RawValue) -> RawValue:
+    """The value a raw delta value sets when there is nothing to merge it into"""
+
+    if isinstance(value, ReplacedValue):
+        return deepcopy(value.value)
+    elif isinstance(value, dict):
+        return {name: _delta_literal(item) for name, item in value.items() if item is not None}
+    else:
+        return deepcopy(value)
+
+
+def _add_delta_data(data: dict, delta: dict) -> None:
+    """Applies a raw (possibly composed) delta to raw data in place"""
+
+    for name, delta_value in delta.items():
+        if delta_value is None:
+            data.pop(name, None)
+        elif isinstance(delta_value, dict) and isinstance(data.get(name), dict):
+            _add_delta_data(data[name], delta_value)
+        else:
+            data[name] = _delta_literal(delta_value)
+
+
+def compose_deltas(first: dict, second: dict) -> dict:
+    """Combines two raw deltas into one, so applying it has the same effect as applying first and then second.
+
+    Neither input is modified, but the output can share values with them, so it should not be modified either.
+    """
+
+    output = dict(first)
+    for name, second_value in second.items():
+        if name not in first or not isinstance(second_value, dict):
+            output[name] = second_value
+        else:
+            first_value = first[name]
+            if isinstance(first_value, ReplacedValue):
+                value = deepcopy(first_value.value)
+                _add_delta_data(value, second_value)
+                output[name] = ReplacedValue(value)
+            elif isinstance(first_value, dict):
+                output[name] = compose_deltas(first_value, second_value)
+            else:
+                # After the first delta there is no dict here to merge into, so the second sets its value outright
+                output[name] = ReplacedValue(_delta_literal(second_value))
+    return output
+
+
+def add_deltas(old: JSONDict, deltas: list[dict]) -> JSONDict:
+    """Applies several raw (possibly composed) deltas in order to produce a new JSONDict, copying old only once.
+
+    The deltas are assumed to have been type checked already, when they were first set.
+    """
+
+    new = old.copy()
+    for delta in deltas:
+        _add_delta_data(new._data, delta)
+    return new
+
+
 class JSONFile:
     reserved_names = ['path', 'type_name', 'template', 'data']
 
@@ -0,0 +1,69 @@
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (on Windows), locking does nothing, and only the epoch checks protect against other processes
+    fcntl = None
+
+
+@contextlib.contextmanager
+def exclusive_lock(path: str):
+    """Hold an exclusive lock on a lock file while the with block runs, waiting for any other process holding it"""
+
+    with open(path, 'a') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def is_locked(path: str) -> bool:
+    """Whether some process holds the lock on a lock file right now (without waiting for it)"""
+
+    if fcntl is None or not os.path.exists(path):
+        return False
+    with open(path, 'a') as file:
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        return False
+
+
+def read_epoch(path: str) -> int:
+    """Read a database's epoch, which goes up by one when a write starts and by one again when it finishes.
+
+    So an odd epoch means a write is in progress (or was interrupted).
+    """
+
+    if not os.path.exists(path):
+        return 0
+    with open(path) as file:
+        text = file.read().strip()
+    return int(text) if text != '' else 0
+
+
+def write_epoch(path: str, epoch: int) -> None:
+    write_atomically(path, str(epoch).encode())
+
+
+def write_atomically(path: str, data: bytes, fsync: bool = False) -> None:
+    """Replace a file's contents so that a process reading it at the same time sees either the old contents or the new, never part of them.
+
+    fsync: also flush the new contents to disk before they replace the old
+    """
+
+    # Written to a temporary file first, which os.replace then swaps in as a single step
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(data)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
+    os.replace(temporary_path, path)
@@ -0,0 +1,104 @@
+import bisect
+import functools
+import inspect
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+# The upper bounds, in seconds, of the latency histogram's buckets; the last bucket counts everything slower
+bucket_bounds = [0.0001, 0.001, 0.01, 0.1, 1.0, 10.0]
+
+
+class Metrics:
+    """Counts and times what a Database does.
+
+    Counters are named by what they count ('deltas applied', 'bytes written', ...).
+    Each measured method (see measured) gets a count of calls, the total and longest time taken,
+    and a histogram of how long its calls took, bucketed by bucket_bounds.
+    log_path: if given, each measured call is also appended to this file as a line of JSON
+    """
+
+    def __init__(self, log_path: Optional[str] = None):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._log_file = None
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters: Dict[str, int] = {}
+            self.timings: Dict[str, Dict[str, Any]] = {}
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_call(self, name: str, seconds: float) -> None:
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = {'calls': 0, 'total seconds': 0.0, 'max seconds': 0.0, 'histogram': [0] * (len(bucket_bounds) + 1)}
+                self.timings[name] = timing
+            timing['calls'] += 1
+            timing['total seconds'] += seconds
+            timing['max seconds'] = max(timing['max seconds'], seconds)
+            timing['histogram'][bisect.bisect_left(bucket_bounds, seconds)] += 1
+
+            if self.log_path is not None:
+                if self._log_file is None:
+                    self._log_file = open(self.log_path, 'a')
+                self._log_file.write(json.dumps({'time': time.time(), 'method': name, 'seconds': seconds}) + '\n')
+                self._log_file.flush()
+
+    def as_dict(self) -> dict:
+        """A copy of everything measured so far, as plain JSON-compatible data"""
+
+        with self._lock:
+            timings = {}
+            for name, timing in self.timings.items():
+                timings[name] = {**timing, 'histogram': list(timing['histogram']),
+                                 'mean seconds': timing['total seconds'] / timing['calls']}
+            return {'counters': dict(self.counters), 'timings': timings, 'histogram bounds': list(bucket_bounds)}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+
+
+def measured(method: Callable) -> Callable:
+    """Decorates a Database method so its calls are timed whenever the database has metrics turned on,
+    and recorded as spans whenever it has a tracer (see tracing.Tracer).
+
+    A span's arguments are the method's ID arguments (any given as strings) and, for a method that returns
+    a database state, the number of records in it. Without metrics or a tracer, the only cost is checking for them.
+    """
+
+    name = method.__name__
+    parameter_names = list(inspect.signature(method).parameters)[1:]
+
+    @functools.wraps(method)
+    def measured_method(self, *args, **kwargs):
+        metrics = self._metrics
+        tracer = self._tracer
+        if metrics is None and tracer is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            if tracer is None:
+                return method(self, *args, **kwargs)
+            span_args = {parameter_name: value for parameter_name, value in [*zip(parameter_names, args), *kwargs.items()]
+                         if isinstance(value, str)}
+            with tracer.span(name, **span_args) as span_args:
+                result = method(self, *args, **kwargs)
+                if isinstance(getattr(result, '_data', None), dict):
+                    span_args['records'] = len(result._data)
+                return result
+        finally:
+            if metrics is not None:
+                metrics.record_call(name, time.perf_counter() - start)
+
+    return measured_method
@@ -0,0 +1,165 @@
+import copy
+import json
+import mmap
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import compression
+import locks
+
+
+pack_extension = '.pack'
+index_extension = '.idx'
+
+
+class Pack:
+    """A read-only file holding many records one after another, along with an index of where each record is.
+
+    The pack file is the records' JSON (each compressed on its own, if the database compresses), each followed by a newline.
+    The index file maps each record's ID to the [offset, length] of its JSON in the pack file.
+    Records are read through an mmap of the pack file, so reading one record does not read the others.
+    """
+
+    def __init__(self, path: str):
+        # path is the pack's location without an extension
+        self.path = path
+        self._closed = False
+        self._pack_file = _PackFile()
+        with open(path + index_extension) as file:
+            self.index: Dict[str, Tuple[int, int]] = json.load(file)
+
+    def _open(self) -> Optional[mmap.mmap]:
+        pack_file = self._pack_file
+        # Readers on several threads can get here at once, and only one of them should open the file
+        if pack_file.file is None:
+            with pack_file.lock:
+                if pack_file.file is None:
+                    file = open(self.path + pack_extension, 'rb')
+                    if os.fstat(file.fileno()).st_size > 0:
+                        pack_file.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    pack_file.file = file
+        return pack_file.mmap
+
+    def handle(self) -> 'Pack':
+        """Returns another handle on this pack, which reads through the same open file but has its own copy of the index.
+
+        The file stays open until every handle on it is closed, so closing this one doesn't affect readers of the other.
+        """
+
+        # Opened now, while the file is surely still there
+        self._open()
+        handle = copy.copy(self)
+        handle.index = dict(self.index)
+        handle._closed = False
+        with self._pack_file.lock:
+            self._pack_file.handles += 1
+        return handle
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.index
+
+    def ids(self) -> List[str]:
+        return list(self.index.keys())
+
+    def read_bytes(self, id: str) -> bytes:
+        """Returns the stored bytes of the record with a given ID"""
+
+        offset, length = self.index[id]
+        return self._open()[offset:offset + length]
+
+    def read(self, id: str) -> dict:
+        """Returns the data of the record with a given ID"""
+
+        return compression.loads(self.read_bytes(id))
+
+    def remove(self, id: str) -> None:
+        """Drops a record from the index, so it can no longer be read from this pack"""
+
+        self.remove_all([id])
+
+    def remove_all(self, ids: Iterable[str]) -> None:
+        """Drops several records from the index, rewriting it once"""
+
+        ids = [id for id in ids if id in self.index]
+        if ids == []:
+            return
+        for id in ids:
+            del self.index[id]
+        _write_index(self.path, self.index)
+
+    def close(self) -> None:
+        pack_file = self._pack_file
+        with pack_file.lock:
+            if not self._closed:
+                self._closed = True
+                pack_file.handles -= 1
+            if pack_file.handles == 0:
+                if pack_file.mmap is not None:
+                    pack_file.mmap.close()
+                    pack_file.mmap = None
+                if pack_file.file is not None:
+                    pack_file.file.close()
+                    pack_file.file = None
+
+    def __del__(self) -> None:
+        # A handle that is dropped without being closed (like those of a snapshot no reader uses any more) lets go of the file
+        if hasattr(self, '_pack_file'):
+            self.close()
+
+
+class _PackFile:
+    """A pack file's open file and mmap, shared by the handles on the pack (see Pack.handle)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handles = 1
+        self.file = None
+        self.mmap: Optional[mmap.mmap] = None
+
+
+def _write_index(path: str, index: Dict[str, Tuple[int, int]]) -> None:
+    locks.write_atomically(path + index_extension, json.dumps(index).encode(), fsync=True)
+
+
+def write_pack(path: str, records: Dict[str, bytes]) -> Pack:
+    """Writes records (already encoded) to a new pack at a given path (without an extension), and returns it.
+
+    The pack file is written and flushed before its index, so an index never points into a missing pack.
+    """
+
+    index: Dict[str, Tuple[int, int]] = {}
+    offset = 0
+    with open(path + pack_extension, 'wb') as file:
+        for id in sorted(records):
+            data = records[id]
+            file.write(data)
+            file.write(b'\n')
+            index[id] = (offset, len(data))
+            offset += len(data) + 1
+        file.flush()
+        os.fsync(file.fileno())
+    _write_index(path, index)
+    return Pack(path)
+
+
+def pack_paths(directory: str) -> List[str]:
+    """Returns the paths (without extensions) of the complete packs in a directory, oldest first"""
+
+    if not os.path.exists(directory):
+        return []
+    paths = []
+    for filename in os.listdir(directory):
+        root, extension = os.path.splitext(filename)
+        if extension == index_extension and os.path.exists(os.path.join(directory, root + pack_extension)):
+            paths.append(os.path.join(directory, root))
+    return sorted(paths, key=lambda path: int(os.path.basename(path).split('-')[-1]))
+
+
+def next_pack_path(directory: str) -> str:
+    existing = pack_paths(directory)
+    if existing == []:
+        number = 0
+    else:
+        number = int(os.path.basename(existing[-1]).split('-')[-1]) + 1
+    return os.path.join(directory, f'pack-{number}')
@@ -0,0 +1,190 @@
+from abc import ABC, abstractmethod
+import contextlib
+import json
+import os
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+
+sqlite_extensions = ['.sqlite', '.sqlite3', '.db']
+
+
+def is_sqlite_path(path: Optional[str]) -> bool:
+    """Whether a database path refers to a SQLite database rather than a database directory"""
+
+    return path is not None and os.path.splitext(path)[1] in sqlite_extensions
+
+
+class StorageOptions:
+    """How a Database is stored and loaded.
+
+    backend: 'directory' or 'sqlite'; by default, paths ending in .sqlite, .sqlite3, or .db use SQLite
+    journal: save appends the changes to a journal instead of rewriting files; fsync flushes each append to disk,
+        and compact_every compacts the journal after that many appends
+    lazy: each version is read the first time it is used, rather than on load
+    blob_threshold: record deltas whose JSON is at least this long are stored once, in the blob store (see Database.collect_blobs)
+    compression_method, compression_level: 'zlib' or 'lzma', and its level from 0 to 9, for the files and packs written
+    The journal and compression only apply to the directory format.
+    """
+
+    def __init__(self, backend: Optional[str] = None, journal: bool = False, fsync: bool = False, compact_every: Optional[int] = None,
+                 lazy: bool = False, blob_threshold: Optional[int] = None,
+                 compression_method: Optional[str] = None, compression_level: Optional[int] = None):
+        self.backend = backend
+        self.journal = journal
+        self.fsync = fsync
+        self.compact_every = compact_every
+        self.lazy = lazy
+        self.blob_threshold = blob_threshold
+        self.compression_method = compression_method
+        self.compression_level = compression_level
+
+
+class Storage(ABC):
+    """Where a Database's versions, branches, views, and id info are persisted.
+
+    Things are grouped into kinds, named the same way as the database directories: 'versions', 'branches', 'views',
+    plus the 'snapshots' and 'reverse deltas' that a database with tip snapshots keeps, and the 'blobs' that versions can refer to.
+    """
+
+    @abstractmethod
+    def read_id_info(self) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def list_ids(self, kind: str) -> List[str]:
+        ...
+
+    @abstractmethod
+    def read(self, kind: str, id: str) -> dict:
+        ...
+
+    @abstractmethod
+    def read_all(self, kind: str) -> Iterator[Tuple[str, dict]]:
+        ...
+
+    @abstractmethod
+    def write(self, id_info: Optional[dict], changed: Dict[str, Dict[str, dict]], deleted: Dict[str, Set[str]],
+              epoch: Optional[int] = None) -> None:
+        """Persist a set of changes all at once: either all of them are stored or none of them are.
+
+        id_info: the new id info, or None if it hasn't changed
+        changed: for each kind, the new data of each thing that has changed
+        deleted: for each kind, the IDs of the things that have been deleted
+        epoch: if given, the new epoch of the database, stored along with the changes
+        """
+        ...
+
+    @abstractmethod
+    def read_epoch(self) -> int:
+        """The number of the last write to the database (see Database._writing)"""
+        ...
+
+    @contextlib.contextmanager
+    def reading(self):
+        """Within the with block, reads see the database as it was when the block started, even if another process writes to it"""
+
+        yield
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteStorage(Storage):
+    """Stores everything in one SQLite file, in WAL mode, with each save written as a single transaction.
+
+    Versions are indexed by branch, previous version, and timestamp, so those can be queried without reading every version.
+    """
+
+    kinds = ['versions', 'branches', 'views', 'snapshots', 'reverse deltas', 'blobs']
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS id_info (key INTEGER PRIMARY KEY CHECK (key = 0), data TEXT NOT NULL)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS epoch (key INTEGER PRIMARY KEY CHECK (key = 0), value INTEGER NOT NULL)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS versions (id TEXT PRIMARY KEY, branch TEXT, previous TEXT, timestamp REAL, data TEXT NOT NULL)')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS versions_branch ON versions (branch)')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS versions_previous ON versions (previous)')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS versions_timestamp ON versions (timestamp)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS branches (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS views (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS snapshots (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS reverse_deltas (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS blobs (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        return self._connection
+
+    def _table(self, kind: str) -> str:
+        # The table name is put directly into the SQL, so the kind can only be one of the known ones
+        if kind not in SQLiteStorage.kinds:
+            raise ValueError(f'Unknown kind of stored data: {kind}')
+        return kind.replace(' ', '_')
+
+    def read_id_info(self) -> Optional[dict]:
+        row = self._connect().execute('SELECT data FROM id_info WHERE key = 0').fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def read_epoch(self) -> int:
+        row = self._connect().execute('SELECT value FROM epoch WHERE key = 0').fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    @contextlib.contextmanager
+    def reading(self):
+        # In WAL mode, a read transaction sees one consistent version of the database and doesn't block writers
+        connection = self._connect()
+        connection.execute('BEGIN')
+        try:
+            yield
+        finally:
+            connection.execute('COMMIT')
+
+    def list_ids(self, kind: str) -> List[str]:
+        table = self._table(kind)
+        return [row[0] for row in self._connect().execute(f'SELECT id FROM {table} ORDER BY id')]
+
+    def read(self, kind: str, id: str) -> dict:
+        table = self._table(kind)
+        row = self._connect().execute(f'SELECT data FROM {table} WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return json.loads(row[0])
+
+    def read_all(self, kind: str) -> Iterator[Tuple[str, dict]]:
+        table = self._table(kind)
+        for id, data in self._connect().execute(f'SELECT id, data FROM {table} ORDER BY id'):
+            yield id, json.loads(data)
+
+    def write(self, id_info: Optional[dict], changed: Dict[str, Dict[str, dict]], deleted: Dict[str, Set[str]],
+              epoch: Optional[int] = None) -> None:
+        connection = self._connect()
+        # The connection as a context manager commits if the block finishes and rolls back if it raises
+        with connection:
+            if epoch is not None:
+                connection.execute('INSERT OR REPLACE INTO epoch (key, value) VALUES (0, ?)', (epoch,))
+            if id_info is not None:
+                connection.execute('INSERT OR REPLACE INTO id_info (key, data) VALUES (0, ?)', (json.dumps(id_info),))
+            for kind in SQLiteStorage.kinds:
+                table = self._table(kind)
+                for id in deleted.get(kind, set()):
+                    connection.execute(f'DELETE FROM {table} WHERE id = ?', (id,))
+                for id, data in changed.get(kind, {}).items():
+                    if kind == 'versions':
+                        connection.execute('INSERT OR REPLACE INTO versions (id, branch, previous, timestamp, data) VALUES (?, ?, ?, ?, ?)',
+                                           (id, data.get('branch'), data.get('previous'), data.get('timestamp'), json.dumps(data)))
+                    else:
+                        connection.execute(f'INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)', (id, json.dumps(data)))
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
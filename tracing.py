@@ -0,0 +1,55 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+class Tracer:
+    """Records nested, timed spans of what a Database does, to be written out in the Chrome trace format.
+
+    The file written by write can be opened in chrome://tracing or https://ui.perfetto.dev,
+    where each thread's spans are shown nested inside the spans they happened during.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.events: List[Dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        """Within the with block, time a span with the given name and arguments.
+
+        The block can add to the span's arguments through the dict it gets, for things only known at the end.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            event = {'name': name, 'ph': 'X', 'ts': (start - self._start) * 1e6, 'dur': (end - start) * 1e6,
+                     'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+            with self._lock:
+                self.events.append(event)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.events = []
+
+    def write(self, path: str) -> None:
+        with self._lock:
+            # Spans are appended as they end, so sort them by when they started, which is how viewers expect them
+            events = sorted(self.events, key=lambda event: event['ts'])
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, default=str)
+
+
+def span(tracer: Optional[Tracer], name: str, **args):
+    """A span of tracer, or a with block that does nothing if tracer is None"""
+
+    if tracer is None:
+        return contextlib.nullcontext(args)
+    return tracer.span(name, **args)
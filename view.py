@@ -19,7 +19,7 @@ class View(ABC):
 class AtomicView(View):
     def __init__(self, db: Database, version_id: database.VersionID):
         super().__init__(db)
-        if version_id not in self.db._versions:
+        if not self.db._has_version(version_id):
             raise YBDBException(f'There is no version with id {version_id}')
         self.version_id: str = version_id
         self.sync_from_db()
@@ -159,8 +159,15 @@ class OpenMergeView(OpenView, MergeView):
     
     def sync_from_db(self) -> None:
         super().sync_from_db()
-        self.default_rules._callback = self.sync_from_db
-        self.record_rules._callback = self.sync_from_db
+        # Edit copies of the rules, so the database can tell what changed when they are synced back
+        self.default_rules = self.default_rules.copy()
+        self.record_rules = self.record_rules.copy()
+        self.default_rules._callback = self._rules_edited
+        self.record_rules._callback = self._rules_edited
+
+    def _rules_edited(self) -> None:
+        self.sync_to_db()
+        self.sync_from_db()
 
 
 class RevisionView(EditableView):